@@ -24,6 +24,8 @@ import { Link } from 'react-router-dom'
 
 export function Pacientes() {
   const [pacientes, setPacientes] = useState([])
+  const [proximoCursor, setProximoCursor] = useState(null)
+  const [carregandoMais, setCarregandoMais] = useState(false)
   const [filtros, setFiltros] = useState({
     nome: '',
     ativo: true,
@@ -49,18 +51,24 @@ export function Pacientes() {
     carregarPacientes()
   }, [filtros])
 
-  const carregarPacientes = async () => {
+  // Sem cursor recarrega a lista do início; com cursor acrescenta a próxima página
+  const carregarPacientes = async (cursor = null) => {
     try {
       const params = new URLSearchParams()
       if (filtros.nome) params.append('nome', filtros.nome)
       if (filtros.ativo !== null) params.append('ativo', filtros.ativo)
       if (filtros.arquivado !== null) params.append('arquivado', filtros.arquivado)
+      if (cursor) params.append('cursor', cursor)
 
+      if (cursor) setCarregandoMais(true)
       const response = await fetch(`http://localhost:5000/api/pacientes?${params}`)
       const data = await response.json()
-      setPacientes(data)
+      setPacientes(anteriores => cursor ? [...anteriores, ...data.pacientes] : data.pacientes)
+      setProximoCursor(data.next_cursor)
     } catch (error) {
       console.error('Erro ao carregar pacientes:', error)
+      if (cursor) return
+      setProximoCursor(null)
       // Mock data para desenvolvimento
       setPacientes([
         {
@@ -86,6 +94,8 @@ export function Pacientes() {
           data_criacao: '2024-01-20T14:30:00'
         }
       ])
+    } finally {
+      setCarregandoMais(false)
     }
   }
 
@@ -466,6 +476,18 @@ export function Pacientes() {
         ))}
       </div>
 
+      {proximoCursor && (
+        <div className="flex justify-center">
+          <Button
+            variant="outline"
+            onClick={() => carregarPacientes(proximoCursor)}
+            disabled={carregandoMais}
+          >
+            {carregandoMais ? 'Carregando...' : 'Carregar mais'}
+          </Button>
+        </div>
+      )}
+
       {pacientes.length === 0 && (
         <Card>
           <CardContent className="text-center py-12">
@@ -0,0 +1,100 @@
+"""Benchmark: montagem do prontuário via ORM x consulta única em SQL (JSON1)
+
+Uso:
+    python benchmarks/benchmark_prontuario.py [evolucoes] [repeticoes]
+
+Usa um banco SQLite em memória; não altera src/database/app.db.
+"""
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask, current_app
+from src.models.fisio_models import db, Fisioterapeuta, Paciente, Avaliacao, Evolucao, Agendamento
+from src.prontuario.prontuario_service import ProntuarioService
+import src.routes.pacientes  # noqa: F401 - registra os eventos de busca e cache
+
+
+def popular(total_evolucoes):
+    fisioterapeuta = Fisioterapeuta(nome='Benchmark', email='bench@fisio.com',
+                                    senha_hash=b'x', crefito='CREFITO-BENCH')
+    db.session.add(fisioterapeuta)
+    db.session.flush()
+
+    paciente = Paciente(nome_completo='Paciente Benchmark', data_nascimento=datetime(1970, 1, 1).date(),
+                        fisioterapeuta_id=fisioterapeuta.id, endereco_residencial='Rua A, 100')
+    db.session.add(paciente)
+    db.session.flush()
+
+    inicio = datetime(2020, 1, 6, 8, 0)
+    for i in range(max(1, total_evolucoes // 50)):
+        db.session.add(Avaliacao(paciente_id=paciente.id, queixa_principal='Lombalgia ' * 20,
+                                 data_avaliacao=inicio + timedelta(days=30 * i)))
+    db.session.execute(Evolucao.__table__.insert(), [
+        {
+            'paciente_id': paciente.id,
+            'data_sessao': inicio + timedelta(days=i),
+            'procedimentos_realizados': 'Cinesioterapia, TENS, liberação miofascial',
+            'resposta_paciente': 'Relata melhora parcial da dor ' * 5,
+            'observacoes': 'Sem intercorrências',
+            'data_criacao': inicio + timedelta(days=i),
+            'data_atualizacao': inicio + timedelta(days=i)
+        }
+        for i in range(total_evolucoes)
+    ])
+    db.session.execute(Agendamento.__table__.insert(), [
+        {
+            'paciente_id': paciente.id,
+            'data_hora': inicio + timedelta(days=i, hours=2),
+            'duracao_minutos': 60,
+            'status': 'realizado',
+            'data_criacao': inicio,
+            'data_atualizacao': inicio
+        }
+        for i in range(total_evolucoes)
+    ])
+    db.session.commit()
+    return paciente.id
+
+
+def medir(funcao, repeticoes):
+    funcao()
+    inicio = time.perf_counter()
+    for _ in range(repeticoes):
+        funcao()
+    return (time.perf_counter() - inicio) / repeticoes * 1000
+
+
+def main():
+    total_evolucoes = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    repeticoes = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
+    db.init_app(app)
+
+    with app.app_context():
+        db.create_all()
+        paciente_id = popular(total_evolucoes)
+
+        def via_orm():
+            db.session.expunge_all()
+            current_app.json.dumps(ProntuarioService.montar(paciente_id)).encode('utf-8')
+
+        def via_sql():
+            ProntuarioService.montar_json(paciente_id)
+
+        tempo_orm = medir(via_orm, repeticoes)
+        tempo_sql = medir(via_sql, repeticoes)
+
+        print(f'{total_evolucoes} evoluções / {total_evolucoes} agendamentos, {repeticoes} repetições')
+        print(f'ORM + to_dict + jsonify: {tempo_orm:8.2f} ms')
+        print(f'SQL (JSON1, 1 consulta):  {tempo_sql:8.2f} ms')
+        print(f'Ganho: {tempo_orm / tempo_sql:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,370 @@
+from datetime import datetime, time, timedelta
+from flask import current_app
+from sqlalchemy import and_, case, func, insert, literal, or_, select, update
+from sqlalchemy.exc import IntegrityError
+from src.models.fisio_models import (
+    Agendamento, Fisioterapeuta, Paciente, SerieAgendamento, DURACAO_MAXIMA_MINUTOS, TRANSICOES_STATUS, db
+)
+from src.agenda.ics import EVENTOS_POR_BLOCO
+from src.agenda.recorrencia import expandir_regra, interpretar_regra
+
+# Mensagem levantada pelos gatilhos de sobreposição (ver GATILHOS_AGENDAMENTO)
+ERRO_CONFLITO = 'conflito_agendamento'
+
+# Expediente por dia da semana (0 = segunda-feira), sobrescrito por
+# app.config['AGENDA_EXPEDIENTE'] no mesmo formato
+EXPEDIENTE_PADRAO = {
+    0: (('08:00', '12:00'), ('13:00', '18:00')),
+    1: (('08:00', '12:00'), ('13:00', '18:00')),
+    2: (('08:00', '12:00'), ('13:00', '18:00')),
+    3: (('08:00', '12:00'), ('13:00', '18:00')),
+    4: (('08:00', '12:00'), ('13:00', '18:00')),
+    5: (('08:00', '12:00'),),
+}
+
+# Maior intervalo aceito na busca de horários livres
+MAX_DIAS_HORARIOS_LIVRES = 31
+
+# Sessões passadas mantidas no feed iCalendar
+FEED_DIAS_PASSADOS = 90
+
+# Maior quantidade de agendamentos por alteração de status em lote
+MAX_LOTE_STATUS = 1000
+
+
+class AgendaService:
+    @staticmethod
+    def filtro_sobreposicao(fisioterapeuta_id, inicio, fim):
+        """Condições de sobreposição com [inicio, fim) em uma faixa do índice de ocupação"""
+        return (
+            Agendamento.fisioterapeuta_id == fisioterapeuta_id,
+            Agendamento.filtro_status_ativo(),
+            Agendamento.data_hora > inicio - timedelta(minutes=DURACAO_MAXIMA_MINUTOS),
+            Agendamento.data_hora < fim,
+            Agendamento.data_hora_fim > inicio
+        )
+
+    @staticmethod
+    def conflitos(fisioterapeuta_id, inicio, fim, ignorar_id=None):
+        """Agendamentos ativos do fisioterapeuta que se sobrepõem a [inicio, fim)"""
+        query = Agendamento.query.filter(*AgendaService.filtro_sobreposicao(fisioterapeuta_id, inicio, fim))
+        if ignorar_id is not None:
+            query = query.filter(Agendamento.id != ignorar_id)
+        return query.order_by(Agendamento.data_hora).all()
+
+    @staticmethod
+    def conflitos_em_lote(fisioterapeuta_id, intervalos, ignorar_ids=()):
+        """Conflitos de cada intervalo (ordenados por início) com uma única consulta ao índice de ocupação"""
+        if not intervalos:
+            return []
+        query = select(Agendamento.id, Agendamento.data_hora, Agendamento.data_hora_fim).where(
+            *AgendaService.filtro_sobreposicao(
+                fisioterapeuta_id, intervalos[0][0], max(fim for _, fim in intervalos)
+            )
+        )
+        if ignorar_ids:
+            query = query.where(Agendamento.id.notin_(ignorar_ids))
+        existentes = db.session.execute(query.order_by(Agendamento.data_hora)).all()
+
+        # Varredura única: ambos em ordem de início e nenhuma sessão dura
+        # mais que DURACAO_MAXIMA_MINUTOS
+        janela = timedelta(minutes=DURACAO_MAXIMA_MINUTOS)
+        conflitos = []
+        j = 0
+        for inicio, fim in intervalos:
+            while j < len(existentes) and existentes[j].data_hora <= inicio - janela:
+                j += 1
+            encontrados = []
+            k = j
+            while k < len(existentes) and existentes[k].data_hora < fim:
+                if existentes[k].data_hora_fim > inicio:
+                    encontrados.append(existentes[k])
+                k += 1
+            conflitos.append(encontrados)
+        return conflitos
+
+    @staticmethod
+    def criar_serie(paciente, data_hora, duracao_minutos, regra, fisioterapeuta_id=None, observacoes=None):
+        """Expandir a regra e inserir as ocorrências livres; retorna (serie, ocorrências puladas)
+
+        Levanta RegraInvalida. A gravação fica para o chamador (uma única transação).
+        """
+        inicios = expandir_regra(interpretar_regra(regra), data_hora)
+        duracao = timedelta(minutes=duracao_minutos)
+        intervalos = [(inicio, inicio + duracao) for inicio in inicios]
+        fisioterapeuta_id = fisioterapeuta_id or paciente.fisioterapeuta_id
+
+        livres = []
+        puladas = []
+        for intervalo, conflitos in zip(intervalos, AgendaService.conflitos_em_lote(fisioterapeuta_id, intervalos)):
+            if conflitos:
+                puladas.append((intervalo, conflitos))
+            else:
+                livres.append(intervalo)
+        if not livres:
+            return None, puladas
+
+        serie = SerieAgendamento(
+            paciente_id=paciente.id,
+            fisioterapeuta_id=fisioterapeuta_id,
+            regra=regra,
+            data_inicio=data_hora,
+            duracao_minutos=duracao_minutos,
+            observacoes=observacoes
+        )
+        db.session.add(serie)
+        db.session.flush()
+
+        db.session.execute(insert(Agendamento), [
+            {
+                'paciente_id': paciente.id,
+                'fisioterapeuta_id': fisioterapeuta_id,
+                'serie_id': serie.id,
+                'data_hora': inicio,
+                'data_hora_fim': fim,
+                'duracao_minutos': duracao_minutos,
+                'status': 'agendado',
+                'observacoes': observacoes
+            }
+            for inicio, fim in livres
+        ])
+        return serie, puladas
+
+    @staticmethod
+    def atualizar_serie(serie, a_partir_de, valores):
+        """Aplicar `valores` às ocorrências ativas da série a partir de `a_partir_de`
+
+        Retorna (total atualizado, conflitos). Uma única instrução UPDATE; se a
+        duração ou o fisioterapeuta mudarem, a sobreposição é verificada antes
+        em uma única consulta.
+        """
+        alvos = db.session.execute(
+            select(Agendamento.id, Agendamento.data_hora).where(
+                Agendamento.serie_id == serie.id,
+                Agendamento.data_hora >= a_partir_de,
+                Agendamento.filtro_status_ativo()
+            ).order_by(Agendamento.data_hora)
+        ).all()
+        if not alvos:
+            return 0, []
+
+        ids = [alvo.id for alvo in alvos]
+        duracao_minutos = valores.get('duracao_minutos')
+        fisioterapeuta_id = valores.get('fisioterapeuta_id', serie.fisioterapeuta_id)
+        ativo = valores.get('status', 'agendado') in ('agendado', 'confirmado')
+
+        if ativo and ('duracao_minutos' in valores or 'fisioterapeuta_id' in valores):
+            duracao = timedelta(minutes=duracao_minutos or serie.duracao_minutos)
+            intervalos = [(alvo.data_hora, alvo.data_hora + duracao) for alvo in alvos]
+            conflitos = AgendaService.conflitos_em_lote(fisioterapeuta_id, intervalos, ignorar_ids=ids)
+            conflitos = [(intervalo, c) for intervalo, c in zip(intervalos, conflitos) if c]
+            if conflitos:
+                return 0, conflitos
+
+        valores = dict(valores, data_atualizacao=datetime.utcnow())
+        if duracao_minutos is not None:
+            # data_hora_fim depende de cada data_hora: UPDATE por chave em lote (executemany)
+            duracao = timedelta(minutes=duracao_minutos)
+            db.session.execute(update(Agendamento), [
+                dict(valores, id=alvo.id, data_hora_fim=alvo.data_hora + duracao) for alvo in alvos
+            ])
+        else:
+            db.session.execute(
+                update(Agendamento).where(Agendamento.id.in_(ids)).values(**valores)
+                .execution_options(synchronize_session=False)
+            )
+
+        for campo in ('duracao_minutos', 'fisioterapeuta_id', 'observacoes'):
+            if campo in valores:
+                setattr(serie, campo, valores[campo])
+        return len(ids), []
+
+    @staticmethod
+    def alterar_status_em_lote(alteracoes):
+        """Aplicar {id: novo status} com um único UPDATE, respeitando TRANSICOES_STATUS
+
+        Retorna (aplicados, rejeitados): aplicados é uma lista de
+        (id, status anterior, novo status); rejeitados, de dicts com id e
+        motivo. Não faz commit.
+        """
+        atuais = dict(db.session.execute(
+            select(Agendamento.id, Agendamento.status).where(Agendamento.id.in_(list(alteracoes)))
+        ).all())
+
+        rejeitados = []
+        por_destino = {}
+        for agendamento_id, destino in alteracoes.items():
+            atual = atuais.get(agendamento_id)
+            if atual is None:
+                rejeitados.append({'id': agendamento_id, 'motivo': 'nao_encontrado'})
+            elif destino not in TRANSICOES_STATUS.get(atual, ()):
+                rejeitados.append({'id': agendamento_id, 'motivo': 'transicao_invalida', 'status_atual': atual})
+            else:
+                por_destino.setdefault(destino, []).append(agendamento_id)
+        if not por_destino:
+            return [], rejeitados
+
+        # O WHERE repete as origens permitidas: se outro usuário alterou o
+        # status entre a leitura e a gravação, a linha simplesmente não muda
+        origens = {
+            destino: [origem for origem, destinos in TRANSICOES_STATUS.items() if destino in destinos]
+            for destino in por_destino
+        }
+        atualizados = db.session.execute(
+            update(Agendamento)
+            .where(or_(*[
+                and_(Agendamento.id.in_(ids), Agendamento.status.in_(origens[destino]))
+                for destino, ids in por_destino.items()
+            ]))
+            .values(
+                status=case(*[(Agendamento.id.in_(ids), literal(destino)) for destino, ids in por_destino.items()]),
+                data_atualizacao=datetime.utcnow()
+            )
+            .returning(Agendamento.id, Agendamento.status)
+            .execution_options(synchronize_session=False)
+        ).all()
+
+        novos = dict(atualizados)
+        aplicados = [(agendamento_id, atuais[agendamento_id], status) for agendamento_id, status in novos.items()]
+        for ids in por_destino.values():
+            for agendamento_id in ids:
+                if agendamento_id not in novos:
+                    rejeitados.append({'id': agendamento_id, 'motivo': 'alterado_concorrentemente'})
+        return aplicados, rejeitados
+
+    @staticmethod
+    def versao_feed(fisioterapeuta_id):
+        """Nome do fisioterapeuta, última alteração e total da sua agenda, em uma consulta
+
+        A última alteração inclui os pacientes da agenda, cujo nome vai nos
+        eventos (renomeação ou anonimização muda o feed).
+        """
+        da_agenda = Agendamento.fisioterapeuta_id == fisioterapeuta_id
+        return db.session.execute(
+            select(
+                Fisioterapeuta.nome,
+                select(func.max(Agendamento.data_atualizacao)).where(da_agenda)
+                .scalar_subquery().label('atualizacao'),
+                select(func.max(Paciente.data_atualizacao))
+                .where(Paciente.id.in_(select(Agendamento.paciente_id).where(da_agenda)))
+                .scalar_subquery().label('atualizacao_pacientes'),
+                select(func.count()).select_from(Agendamento).where(da_agenda)
+                .scalar_subquery().label('total')
+            ).where(Fisioterapeuta.id == fisioterapeuta_id)
+        ).first()
+
+    @staticmethod
+    def linhas_feed(fisioterapeuta_id, inicio):
+        """Cursor sobre a agenda do fisioterapeuta a partir de `inicio`, lido em blocos"""
+        return db.session.execute(
+            select(
+                Agendamento.id, Agendamento.data_hora, Agendamento.data_hora_fim, Agendamento.status,
+                Agendamento.observacoes, Agendamento.data_criacao, Agendamento.data_atualizacao,
+                Paciente.nome_completo
+            )
+            .join(Paciente, Paciente.id == Agendamento.paciente_id)
+            .where(Agendamento.fisioterapeuta_id == fisioterapeuta_id, Agendamento.data_hora >= inicio)
+            .order_by(Agendamento.data_hora)
+            .execution_options(yield_per=EVENTOS_POR_BLOCO)
+        )
+
+    @staticmethod
+    def verificar_antes_de_gravar():
+        """Sem gatilhos (bancos que não são SQLite), verificar na aplicação"""
+        return db.engine.dialect.name != 'sqlite'
+
+    @staticmethod
+    def e_conflito(erro):
+        """Indica se o erro de integridade veio do gatilho de sobreposição"""
+        return isinstance(erro, IntegrityError) and ERRO_CONFLITO in str(erro.orig)
+
+    @staticmethod
+    def validar_duracao(duracao_minutos):
+        """Validar duração da sessão; retorna mensagem de erro ou None"""
+        if not isinstance(duracao_minutos, int) or isinstance(duracao_minutos, bool):
+            return 'Duração deve ser um número inteiro de minutos'
+        if not 1 <= duracao_minutos <= DURACAO_MAXIMA_MINUTOS:
+            return f'Duração deve estar entre 1 e {DURACAO_MAXIMA_MINUTOS} minutos'
+        return None
+
+    @staticmethod
+    def periodos_expediente(inicio, fim):
+        """Períodos de expediente dentro de [inicio, fim), em ordem cronológica"""
+        expediente = current_app.config.get('AGENDA_EXPEDIENTE', EXPEDIENTE_PADRAO)
+        periodos = []
+        dia = inicio.date()
+        while dia <= fim.date():
+            for abertura, fechamento in expediente.get(dia.weekday(), ()):
+                a = max(datetime.combine(dia, time.fromisoformat(abertura)), inicio)
+                b = min(datetime.combine(dia, time.fromisoformat(fechamento)), fim)
+                if a < b:
+                    periodos.append((a, b))
+            dia += timedelta(days=1)
+        return periodos
+
+    @staticmethod
+    def ocupacoes(fisioterapeutas_ids, inicio, fim):
+        """Intervalos ocupados por fisioterapeuta, lidos em uma única varredura do índice de ocupação"""
+        linhas = db.session.execute(
+            select(Agendamento.fisioterapeuta_id, Agendamento.data_hora, Agendamento.data_hora_fim)
+            .where(
+                Agendamento.fisioterapeuta_id.in_(fisioterapeutas_ids),
+                Agendamento.filtro_status_ativo(),
+                Agendamento.data_hora > inicio - timedelta(minutes=DURACAO_MAXIMA_MINUTOS),
+                Agendamento.data_hora < fim,
+                Agendamento.data_hora_fim > inicio
+            )
+            .order_by(Agendamento.fisioterapeuta_id, Agendamento.data_hora)
+        )
+        ocupacoes = {fisioterapeuta_id: [] for fisioterapeuta_id in fisioterapeutas_ids}
+        for fisioterapeuta_id, data_hora, data_hora_fim in linhas:
+            ocupacoes[fisioterapeuta_id].append((data_hora, data_hora_fim))
+        return ocupacoes
+
+    @staticmethod
+    def janelas_livres(periodos, ocupados, duracao):
+        """Varrer períodos e ocupações (ambos ordenados) e devolver as janelas com pelo menos `duracao`"""
+        livres = []
+        j = 0
+        for abertura, fechamento in periodos:
+            cursor = abertura
+            # Ocupações já encerradas não afetam este nem os próximos períodos
+            while j < len(ocupados) and ocupados[j][1] <= cursor:
+                j += 1
+            k = j
+            while k < len(ocupados) and ocupados[k][0] < fechamento:
+                ocupado_inicio, ocupado_fim = ocupados[k]
+                if ocupado_inicio - cursor >= duracao:
+                    livres.append((cursor, ocupado_inicio))
+                cursor = max(cursor, ocupado_fim)
+                k += 1
+            if fechamento - cursor >= duracao:
+                livres.append((cursor, fechamento))
+        return livres
+
+    @staticmethod
+    def horarios_livres(inicio, fim, duracao_minutos, fisioterapeuta_id=None):
+        """Janelas livres de cada fisioterapeuta ativo (ou do informado) em [inicio, fim)"""
+        query = select(Fisioterapeuta.id, Fisioterapeuta.nome).order_by(Fisioterapeuta.id)
+        if fisioterapeuta_id is not None:
+            query = query.where(Fisioterapeuta.id == fisioterapeuta_id)
+        else:
+            query = query.where(Fisioterapeuta.ativo == True)
+        fisioterapeutas = db.session.execute(query).all()
+        if not fisioterapeutas:
+            return []
+
+        periodos = AgendaService.periodos_expediente(inicio, fim)
+        ocupacoes = AgendaService.ocupacoes([f.id for f in fisioterapeutas], inicio, fim)
+        duracao = timedelta(minutes=duracao_minutos)
+        return [
+            {
+                'fisioterapeuta_id': fisioterapeuta.id,
+                'nome': fisioterapeuta.nome,
+                'horarios': [
+                    {'inicio': a.isoformat(), 'fim': b.isoformat()}
+                    for a, b in AgendaService.janelas_livres(periodos, ocupacoes[fisioterapeuta.id], duracao)
+                ]
+            }
+            for fisioterapeuta in fisioterapeutas
+        ]
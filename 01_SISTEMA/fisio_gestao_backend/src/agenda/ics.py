@@ -0,0 +1,91 @@
+from datetime import timezone
+
+# Eventos acumulados antes de cada envio ao cliente
+EVENTOS_POR_BLOCO = 200
+
+_STATUS_ICS = {
+    'agendado': 'TENTATIVE',
+    'confirmado': 'CONFIRMED',
+    'realizado': 'CONFIRMED',
+    # Falta: a sessão não aconteceu, não deve aparecer como pendente
+    'faltou': 'CANCELLED',
+    'cancelado': 'CANCELLED',
+}
+
+
+def escapar_texto(texto):
+    """Escapar valor TEXT conforme RFC 5545 (3.3.11)"""
+    return (
+        (texto or '')
+        .replace('\\', '\\\\')
+        .replace(';', '\\;')
+        .replace(',', '\\,')
+        .replace('\r\n', '\\n')
+        .replace('\n', '\\n')
+    )
+
+
+def dobrar_linha(linha):
+    """Dobrar linhas com mais de 75 octetos (RFC 5545, 3.1), sem cortar caracteres UTF-8"""
+    dados = linha.encode('utf-8')
+    if len(dados) <= 75:
+        return dados + b'\r\n'
+    partes = []
+    inicio = 0
+    limite = 75
+    while inicio < len(dados):
+        fim = min(inicio + limite, len(dados))
+        # Não cortar no meio de um caractere multibyte
+        while fim < len(dados) and (dados[fim] & 0xC0) == 0x80:
+            fim -= 1
+        partes.append(dados[inicio:fim])
+        inicio = fim
+        limite = 74  # linhas de continuação começam com um espaço
+    return b'\r\n '.join(partes) + b'\r\n'
+
+
+def _data_local(valor):
+    # Horários da agenda são gravados sem fuso (hora local da clínica)
+    return valor.strftime('%Y%m%dT%H%M%S')
+
+
+def _data_utc(valor):
+    # data_atualizacao é gravada em UTC (datetime.utcnow)
+    return valor.replace(tzinfo=timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+
+
+def _evento(linha):
+    linhas = [
+        'BEGIN:VEVENT',
+        f'UID:agendamento-{linha.id}@fisiogestao',
+        f'DTSTAMP:{_data_utc(linha.data_atualizacao or linha.data_criacao)}',
+        f'LAST-MODIFIED:{_data_utc(linha.data_atualizacao or linha.data_criacao)}',
+        f'DTSTART:{_data_local(linha.data_hora)}',
+        f'DTEND:{_data_local(linha.data_hora_fim)}',
+        f'SUMMARY:{escapar_texto(linha.nome_completo)}',
+        f'STATUS:{_STATUS_ICS.get(linha.status, "TENTATIVE")}',
+    ]
+    if linha.observacoes:
+        linhas.append(f'DESCRIPTION:{escapar_texto(linha.observacoes)}')
+    linhas.append('END:VEVENT')
+    return b''.join(dobrar_linha(item) for item in linhas)
+
+
+def gerar_ics(nome_calendario, linhas):
+    """Gerar o calendário em blocos de bytes a partir de um iterável de linhas da agenda"""
+    yield b''.join(dobrar_linha(item) for item in (
+        'BEGIN:VCALENDAR',
+        'VERSION:2.0',
+        'PRODID:-//FisioGestao//Agenda//PT-BR',
+        'CALSCALE:GREGORIAN',
+        'METHOD:PUBLISH',
+        f'X-WR-CALNAME:{escapar_texto(nome_calendario)}',
+    ))
+    bloco = []
+    for linha in linhas:
+        bloco.append(_evento(linha))
+        if len(bloco) >= EVENTOS_POR_BLOCO:
+            yield b''.join(bloco)
+            bloco = []
+    bloco.append(dobrar_linha('END:VCALENDAR'))
+    yield b''.join(bloco)
@@ -0,0 +1,229 @@
+from datetime import date, datetime, time, timedelta
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import DDL, case, delete, event, func, insert, select
+from src.models.fisio_models import Agendamento, DURACAO_PADRAO_MINUTOS, STATUS_ATIVOS, db
+from src.agenda.agenda_service import EXPEDIENTE_PADRAO
+
+
+class ResumoDiarioAgenda(db.Model):
+    """Resumo diário da agenda por fisioterapeuta (mantido pelos gatilhos de agendamentos, só no SQLite)"""
+    __tablename__ = 'agenda_resumo_diario'
+    __table_args__ = (
+        db.Index('ix_agenda_resumo_dia', 'dia'),
+    )
+
+    fisioterapeuta_id = db.Column(db.Integer, db.ForeignKey('fisioterapeutas.id'), primary_key=True)
+    dia = db.Column(db.Date, primary_key=True)
+    total = db.Column(db.Integer, nullable=False, default=0)
+    ativos = db.Column(db.Integer, nullable=False, default=0)  # agendados ou confirmados
+    realizados = db.Column(db.Integer, nullable=False, default=0)
+    faltas = db.Column(db.Integer, nullable=False, default=0)
+    cancelados = db.Column(db.Integer, nullable=False, default=0)
+    minutos_ocupados = db.Column(db.Integer, nullable=False, default=0)  # sessões não canceladas
+
+    def to_dict(self):
+        return {
+            'fisioterapeuta_id': self.fisioterapeuta_id,
+            'dia': self.dia.isoformat() if self.dia else None,
+            'total': self.total,
+            'ativos': self.ativos,
+            'realizados': self.realizados,
+            'faltas': self.faltas,
+            'cancelados': self.cancelados,
+            'minutos_ocupados': self.minutos_ocupados
+        }
+
+
+_CONTADORES = ('total', 'ativos', 'realizados', 'faltas', 'cancelados', 'minutos_ocupados')
+
+
+def _contribuicao(linha, sinal):
+    """Somar (sinal 1) ou subtrair (sinal -1) a linha NEW/OLD do resumo do seu dia"""
+    status = f"COALESCE({linha}.status, 'agendado')"
+    ativos = ', '.join(f"'{item}'" for item in STATUS_ATIVOS)
+    return f"""
+        INSERT INTO agenda_resumo_diario (fisioterapeuta_id, dia, {', '.join(_CONTADORES)})
+        SELECT {linha}.fisioterapeuta_id, date({linha}.data_hora), {sinal},
+               {sinal} * ({status} IN ({ativos})),
+               {sinal} * ({status} = 'realizado'),
+               {sinal} * ({status} = 'faltou'),
+               {sinal} * ({status} = 'cancelado'),
+               {sinal} * CASE WHEN {status} = 'cancelado' THEN 0
+                              ELSE COALESCE({linha}.duracao_minutos, {DURACAO_PADRAO_MINUTOS}) END
+        WHERE {linha}.fisioterapeuta_id IS NOT NULL
+        ON CONFLICT (fisioterapeuta_id, dia) DO UPDATE SET
+            {', '.join(f'{contador} = {contador} + excluded.{contador}' for contador in _CONTADORES)};
+    """
+
+
+# Cada escrita em agendamentos (ORM, INSERT/UPDATE em lote ou SQL direto)
+# ajusta apenas o(s) dia(s) afetado(s) no resumo
+GATILHOS_RESUMO_AGENDA = (
+    f"""CREATE TRIGGER IF NOT EXISTS tg_agendamentos_resumo_insert
+    AFTER INSERT ON agendamentos
+    BEGIN {_contribuicao('NEW', 1)} END""",
+    f"""CREATE TRIGGER IF NOT EXISTS tg_agendamentos_resumo_update
+    AFTER UPDATE OF status, data_hora, duracao_minutos, fisioterapeuta_id ON agendamentos
+    BEGIN {_contribuicao('OLD', -1)} {_contribuicao('NEW', 1)} END""",
+    f"""CREATE TRIGGER IF NOT EXISTS tg_agendamentos_resumo_delete
+    AFTER DELETE ON agendamentos
+    BEGIN {_contribuicao('OLD', -1)} END""",
+)
+
+for _gatilho in GATILHOS_RESUMO_AGENDA:
+    event.listen(Agendamento.__table__, 'after_create', DDL(_gatilho).execute_if(dialect='sqlite'))
+
+
+def _minutos(horario):
+    valor = time.fromisoformat(horario)
+    return valor.hour * 60 + valor.minute
+
+
+def _indicadores(contagem, capacidade_minutos):
+    total = contagem['total']
+    encerrados = contagem['realizados'] + contagem['faltas']
+    return {
+        **contagem,
+        'capacidade_minutos': capacidade_minutos,
+        'taxa_ocupacao': round(contagem['minutos_ocupados'] / capacidade_minutos, 4) if capacidade_minutos else None,
+        'taxa_cancelamento': round(contagem['cancelados'] / total, 4) if total else None,
+        'taxa_faltas': round(contagem['faltas'] / encerrados, 4) if encerrados else None
+    }
+
+
+class IndicadoresAgendaService:
+    @staticmethod
+    def resumo_mantido_por_gatilhos():
+        """Os gatilhos do resumo só existem no SQLite; nos demais bancos os indicadores vêm dos agendamentos"""
+        return db.engine.dialect.name == 'sqlite'
+
+    @staticmethod
+    def contagens(inicio=None, fim=None, fisioterapeuta_id=None):
+        """Consulta com as colunas do resumo calculadas a partir de agendamentos, por fisioterapeuta e dia"""
+        filtros = [Agendamento.fisioterapeuta_id.isnot(None)]
+        if inicio is not None:
+            filtros.append(Agendamento.data_hora >= datetime.combine(inicio, time.min))
+        if fim is not None:
+            filtros.append(Agendamento.data_hora < datetime.combine(fim + timedelta(days=1), time.min))
+        if fisioterapeuta_id is not None:
+            filtros.append(Agendamento.fisioterapeuta_id == fisioterapeuta_id)
+
+        status = func.coalesce(Agendamento.status, 'agendado')
+        dia = func.date(Agendamento.data_hora)
+        contar = lambda condicao: func.sum(case((condicao, 1), else_=0))
+        return (
+            select(
+                Agendamento.fisioterapeuta_id.label('fisioterapeuta_id'),
+                dia.label('dia'),
+                func.count().label('total'),
+                contar(status.in_(STATUS_ATIVOS)).label('ativos'),
+                contar(status == 'realizado').label('realizados'),
+                contar(status == 'faltou').label('faltas'),
+                contar(status == 'cancelado').label('cancelados'),
+                func.sum(case(
+                    (status == 'cancelado', 0),
+                    else_=func.coalesce(Agendamento.duracao_minutos, DURACAO_PADRAO_MINUTOS)
+                )).label('minutos_ocupados')
+            )
+            .where(*filtros)
+            .group_by(Agendamento.fisioterapeuta_id, dia)
+        )
+
+    @staticmethod
+    def recalcular(connection, inicio=None, fim=None):
+        """Reconstruir o resumo a partir de agendamentos (todo o histórico ou os dias [inicio, fim])"""
+        remover = delete(ResumoDiarioAgenda)
+        if inicio is not None:
+            remover = remover.where(ResumoDiarioAgenda.dia >= inicio)
+        if fim is not None:
+            remover = remover.where(ResumoDiarioAgenda.dia <= fim)
+        connection.execute(remover)
+
+        resultado = connection.execute(
+            insert(ResumoDiarioAgenda).from_select(
+                ['fisioterapeuta_id', 'dia', *_CONTADORES], IndicadoresAgendaService.contagens(inicio, fim)
+            )
+        )
+        return resultado.rowcount
+
+    @staticmethod
+    def capacidade_por_dia_semana():
+        """Minutos de expediente de cada dia da semana (0 = segunda-feira)"""
+        expediente = current_app.config.get('AGENDA_EXPEDIENTE', EXPEDIENTE_PADRAO)
+        return {
+            dia_semana: sum(_minutos(fechamento) - _minutos(abertura) for abertura, fechamento in periodos)
+            for dia_semana, periodos in expediente.items()
+        }
+
+    @staticmethod
+    def indicadores(inicio, fim, fisioterapeuta_id=None):
+        """Indicadores por fisioterapeuta e dia da semana nos dias [inicio, fim]
+
+        Lidos do resumo diário no SQLite; nos demais bancos, sem os gatilhos que
+        o mantêm, agregados dos agendamentos do período na própria consulta.
+        """
+        if IndicadoresAgendaService.resumo_mantido_por_gatilhos():
+            query = select(
+                ResumoDiarioAgenda.fisioterapeuta_id, ResumoDiarioAgenda.dia,
+                *[getattr(ResumoDiarioAgenda, contador) for contador in _CONTADORES]
+            ).where(ResumoDiarioAgenda.dia >= inicio, ResumoDiarioAgenda.dia <= fim)
+            if fisioterapeuta_id is not None:
+                query = query.where(ResumoDiarioAgenda.fisioterapeuta_id == fisioterapeuta_id)
+            query = query.order_by(ResumoDiarioAgenda.fisioterapeuta_id, ResumoDiarioAgenda.dia)
+        else:
+            contagens = IndicadoresAgendaService.contagens(inicio, fim, fisioterapeuta_id).subquery()
+            query = select(contagens).order_by(contagens.c.fisioterapeuta_id, contagens.c.dia)
+        resumos = db.session.execute(query).all()
+
+        # Dias de cada dia da semana no intervalo (independe de haver sessões)
+        total_dias = (fim - inicio).days + 1
+        dias_por_semana = {
+            dia_semana: total_dias // 7 + (1 if (dia_semana - inicio.weekday()) % 7 < total_dias % 7 else 0)
+            for dia_semana in range(7)
+        }
+        capacidade = IndicadoresAgendaService.capacidade_por_dia_semana()
+
+        acumulado = {}
+        for resumo in resumos:
+            por_dia_semana = acumulado.setdefault(resumo.fisioterapeuta_id, {})
+            # date() do SQLite devolve texto
+            dia = resumo.dia if isinstance(resumo.dia, date) else date.fromisoformat(resumo.dia)
+            contagem = por_dia_semana.setdefault(dia.weekday(), dict.fromkeys(_CONTADORES, 0))
+            for contador in _CONTADORES:
+                contagem[contador] += getattr(resumo, contador)
+
+        resultado = []
+        for fisio_id, por_dia_semana in acumulado.items():
+            geral = dict.fromkeys(_CONTADORES, 0)
+            dias_semana = []
+            for dia_semana in range(7):
+                contagem = por_dia_semana.get(dia_semana, dict.fromkeys(_CONTADORES, 0))
+                capacidade_minutos = capacidade.get(dia_semana, 0) * dias_por_semana[dia_semana]
+                for contador in _CONTADORES:
+                    geral[contador] += contagem[contador]
+                if contagem['total'] or capacidade_minutos:
+                    dias_semana.append({'dia_semana': dia_semana, **_indicadores(contagem, capacidade_minutos)})
+            capacidade_total = sum(capacidade.get(d, 0) * dias_por_semana[d] for d in range(7))
+            resultado.append({
+                'fisioterapeuta_id': fisio_id,
+                'geral': _indicadores(geral, capacidade_total),
+                'por_dia_semana': dias_semana
+            })
+        return resultado
+
+
+@click.command('agenda-resumo')
+@click.option('--inicio', type=click.DateTime(formats=['%Y-%m-%d']), default=None, help='Primeiro dia (padrão: todo o histórico)')
+@click.option('--fim', type=click.DateTime(formats=['%Y-%m-%d']), default=None, help='Último dia')
+@with_appcontext
+def comando_resumo_agenda(inicio, fim):
+    """Reconstruir o resumo diário da agenda a partir dos agendamentos"""
+    total = IndicadoresAgendaService.recalcular(
+        db.session.connection(),
+        inicio.date() if inicio else None,
+        fim.date() if fim else None
+    )
+    db.session.commit()
+    click.echo(f'{total} dias de agenda recalculados')
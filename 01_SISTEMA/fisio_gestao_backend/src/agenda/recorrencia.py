@@ -0,0 +1,125 @@
+from datetime import datetime, timedelta
+
+# Subconjunto de RRULE (RFC 5545) aceito para séries de agendamentos:
+# FREQ=DAILY|WEEKLY, INTERVAL, COUNT, UNTIL e BYDAY (apenas em WEEKLY),
+# com semanas começando na segunda-feira (WKST=MO)
+FREQUENCIAS = ('DAILY', 'WEEKLY')
+DIAS_SEMANA = ('MO', 'TU', 'WE', 'TH', 'FR', 'SA', 'SU')
+
+# Limite de ocorrências de uma série (ex.: 2x por semana durante 1 ano)
+MAX_OCORRENCIAS = 104
+
+
+class RegraInvalida(ValueError):
+    """Regra de recorrência fora do subconjunto suportado"""
+
+
+def _interpretar_until(valor):
+    formatos = ('%Y%m%dT%H%M%SZ', '%Y%m%dT%H%M%S', '%Y%m%d')
+    for formato in formatos:
+        try:
+            until = datetime.strptime(valor, formato)
+        except ValueError:
+            continue
+        # Apenas a data em UNTIL inclui o dia inteiro
+        if formato == '%Y%m%d':
+            until += timedelta(days=1) - timedelta(microseconds=1)
+        return until
+    raise RegraInvalida(f'UNTIL inválido: {valor}')
+
+
+def interpretar_regra(texto):
+    """Converter texto RRULE em dicionário com freq, intervalo, total, ate e dias"""
+    if not texto or not isinstance(texto, str):
+        raise RegraInvalida('Regra de recorrência é obrigatória')
+
+    texto = texto.strip()
+    if texto.upper().startswith('RRULE:'):
+        texto = texto[len('RRULE:'):]
+
+    partes = {}
+    for parte in texto.split(';'):
+        if not parte:
+            continue
+        chave, separador, valor = parte.partition('=')
+        chave = chave.strip().upper()
+        if not separador or not valor.strip():
+            raise RegraInvalida(f'Parte inválida na regra: {parte}')
+        if chave in partes:
+            raise RegraInvalida(f'{chave} repetido na regra')
+        partes[chave] = valor.strip().upper()
+
+    suportadas = {'FREQ', 'INTERVAL', 'COUNT', 'UNTIL', 'BYDAY'}
+    nao_suportadas = set(partes) - suportadas
+    if nao_suportadas:
+        raise RegraInvalida(f'Partes não suportadas: {", ".join(sorted(nao_suportadas))}')
+
+    freq = partes.get('FREQ')
+    if freq not in FREQUENCIAS:
+        raise RegraInvalida(f'FREQ deve ser um de: {", ".join(FREQUENCIAS)}')
+
+    try:
+        intervalo = int(partes.get('INTERVAL', '1'))
+        total = int(partes['COUNT']) if 'COUNT' in partes else None
+    except ValueError:
+        raise RegraInvalida('INTERVAL e COUNT devem ser inteiros')
+    if intervalo < 1:
+        raise RegraInvalida('INTERVAL deve ser maior que zero')
+    if total is not None and not 1 <= total <= MAX_OCORRENCIAS:
+        raise RegraInvalida(f'COUNT deve estar entre 1 e {MAX_OCORRENCIAS}')
+
+    ate = _interpretar_until(partes['UNTIL']) if 'UNTIL' in partes else None
+    if total is None and ate is None:
+        raise RegraInvalida('Informe COUNT ou UNTIL')
+    if total is not None and ate is not None:
+        raise RegraInvalida('COUNT e UNTIL não podem ser usados juntos')
+
+    dias = None
+    if 'BYDAY' in partes:
+        if freq != 'WEEKLY':
+            raise RegraInvalida('BYDAY é suportado apenas com FREQ=WEEKLY')
+        dias = set()
+        for dia in partes['BYDAY'].split(','):
+            if dia not in DIAS_SEMANA:
+                raise RegraInvalida(f'Dia inválido em BYDAY: {dia}')
+            dias.add(DIAS_SEMANA.index(dia))
+        dias = sorted(dias)
+
+    return {'freq': freq, 'intervalo': intervalo, 'total': total, 'ate': ate, 'dias': dias}
+
+
+def _candidatas(regra, inicio):
+    """Gerar candidatas em ordem, sem limite (o chamador aplica COUNT/UNTIL)"""
+    if regra['freq'] == 'DAILY':
+        passo = timedelta(days=regra['intervalo'])
+        ocorrencia = inicio
+        while True:
+            yield ocorrencia
+            ocorrencia += passo
+
+    dias = regra['dias'] or [inicio.weekday()]
+    semana = inicio - timedelta(days=inicio.weekday())
+    passo = timedelta(weeks=regra['intervalo'])
+    while True:
+        for dia in dias:
+            ocorrencia = semana + timedelta(days=dia)
+            if ocorrencia >= inicio:
+                yield ocorrencia
+        semana += passo
+
+
+def expandir_regra(regra, inicio):
+    """Datas de início das ocorrências, em ordem, a partir de `inicio` (DTSTART)
+
+    Segue o horário de `inicio`; DTSTART só é incluído se casar com a regra.
+    """
+    ocorrencias = []
+    for ocorrencia in _candidatas(regra, inicio):
+        if regra['ate'] is not None and ocorrencia > regra['ate']:
+            break
+        if regra['total'] is not None and len(ocorrencias) == regra['total']:
+            break
+        if len(ocorrencias) == MAX_OCORRENCIAS:
+            raise RegraInvalida(f'A série ultrapassa o limite de {MAX_OCORRENCIAS} ocorrências')
+        ocorrencias.append(ocorrencia)
+    return ocorrencias
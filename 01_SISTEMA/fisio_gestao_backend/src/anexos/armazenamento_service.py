@@ -0,0 +1,296 @@
+import fcntl
+import hashlib
+import os
+import threading
+import uuid
+from datetime import datetime, timedelta
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import delete, event, select, update
+from sqlalchemy.orm import Session, object_session
+from src.models.fisio_models import AnexoAvaliacao, ObjetoAnexo, UploadAnexo, db
+
+# Leitura e escrita em blocos: o arquivo nunca é carregado inteiro na memória
+TAMANHO_BLOCO = 1024 * 1024
+# Uploads sem nenhuma parte recebida há mais que isso são considerados abandonados
+VALIDADE_UPLOADS_HORAS = 72
+_SUFIXO_REMOVIDO = '.removido'
+
+
+class UploadOcupado(Exception):
+    """Outra requisição está gravando o mesmo upload"""
+
+
+class ParteInvalida(ValueError):
+    """Parte fora de ordem ou além do tamanho declarado"""
+
+
+# Hash incremental de cada upload em andamento neste processo: (bytes já
+# incluídos, objeto sha256). Sem ele (outro processo, reinício), o hash é
+# recalculado a partir do arquivo parcial ao concluir
+_hashes = {}
+_hashes_lock = threading.Lock()
+
+
+class ArmazenamentoAnexos:
+    """Arquivos em ANEXOS_DIRETORIO: objetos/ab/cd/<sha256>, seus derivados
+    (<sha256>.<tipo>.jpg, ao lado do original) e uploads/<id> (parciais)"""
+
+    @staticmethod
+    def raiz():
+        return current_app.config['ANEXOS_DIRETORIO']
+
+    @staticmethod
+    def chave(sha256):
+        return f'objetos/{sha256[:2]}/{sha256[2:4]}/{sha256}'
+
+    @staticmethod
+    def caminho(sha256):
+        return os.path.join(ArmazenamentoAnexos.raiz(), *ArmazenamentoAnexos.chave(sha256).split('/'))
+
+    @staticmethod
+    def chave_derivado(sha256, tipo):
+        return f'{ArmazenamentoAnexos.chave(sha256)}.{tipo}.jpg'
+
+    @staticmethod
+    def caminho_derivado(sha256, tipo):
+        return ArmazenamentoAnexos.caminho(sha256) + f'.{tipo}.jpg'
+
+    @staticmethod
+    def caminho_parcial(upload_id):
+        return os.path.join(ArmazenamentoAnexos.raiz(), 'uploads', upload_id)
+
+    @staticmethod
+    def referenciar(sha256, tamanho_bytes):
+        """Somar uma referência ao objeto, criando-o se ainda não existir; retorna True se é novo"""
+        resultado = db.session.execute(
+            update(ObjetoAnexo).where(ObjetoAnexo.sha256 == sha256)
+            .values(referencias=ObjetoAnexo.referencias + 1)
+        )
+        if resultado.rowcount:
+            return False
+        db.session.add(ObjetoAnexo(sha256=sha256, tamanho_bytes=tamanho_bytes, referencias=1))
+        db.session.flush()
+        return True
+
+    @staticmethod
+    def liberar(connection, sha256):
+        """Subtrair uma referência; sem referências, o objeto sai do banco e os arquivos
+        (original e derivados) são renomeados, para serem apagados só após o commit.
+        Retorna os caminhos renomeados."""
+        connection.execute(
+            update(ObjetoAnexo).where(ObjetoAnexo.sha256 == sha256)
+            .values(referencias=ObjetoAnexo.referencias - 1)
+        )
+        objeto = connection.execute(
+            select(ObjetoAnexo.referencias, ObjetoAnexo.derivados).where(ObjetoAnexo.sha256 == sha256)
+        ).first()
+        if objeto is None or objeto.referencias > 0:
+            return []
+        connection.execute(delete(ObjetoAnexo).where(ObjetoAnexo.sha256 == sha256))
+        caminhos = [ArmazenamentoAnexos.caminho(sha256)]
+        caminhos += [ArmazenamentoAnexos.caminho_derivado(sha256, tipo) for tipo in objeto.derivados or {}]
+        removidos = []
+        for caminho in caminhos:
+            try:
+                os.replace(caminho, caminho + _SUFIXO_REMOVIDO)
+            except FileNotFoundError:
+                continue
+            removidos.append(caminho + _SUFIXO_REMOVIDO)
+        return removidos
+
+
+class UploadAnexoService:
+    @staticmethod
+    def iniciar(avaliacao_id, nome_arquivo, tamanho_bytes, tipo_arquivo=None, categoria=None):
+        upload = UploadAnexo(
+            id=uuid.uuid4().hex,
+            avaliacao_id=avaliacao_id,
+            nome_arquivo=nome_arquivo,
+            tipo_arquivo=tipo_arquivo,
+            categoria=categoria,
+            tamanho_bytes=tamanho_bytes,
+            recebidos=0
+        )
+        caminho = ArmazenamentoAnexos.caminho_parcial(upload.id)
+        os.makedirs(os.path.dirname(caminho), exist_ok=True)
+        open(caminho, 'wb').close()
+        db.session.add(upload)
+        return upload
+
+    @staticmethod
+    def receber(upload, inicio, fluxo, tamanho_parte):
+        """Anexar uma parte ao arquivo parcial, lendo o corpo da requisição em blocos
+
+        A parte deve começar em `upload.recebidos`. Retorna o AnexoAvaliacao
+        quando a última parte chega, senão None.
+        """
+        if inicio != upload.recebidos:
+            raise ParteInvalida(f'Parte deve começar em {upload.recebidos}')
+        if inicio + tamanho_parte > upload.tamanho_bytes:
+            raise ParteInvalida('Parte ultrapassa o tamanho declarado do arquivo')
+
+        caminho = ArmazenamentoAnexos.caminho_parcial(upload.id)
+        with open(caminho, 'r+b') as arquivo:
+            try:
+                fcntl.flock(arquivo, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise UploadOcupado('Upload em gravação por outra requisição')
+
+            with _hashes_lock:
+                estado = _hashes.pop(upload.id, None)
+            if inicio == 0:
+                estado = (0, hashlib.sha256())
+            elif estado is not None and estado[0] != inicio:
+                estado = None
+
+            # Descarta bytes de uma parte anterior interrompida antes do commit
+            arquivo.truncate(inicio)
+            arquivo.seek(inicio)
+            gravados = 0
+            while gravados < tamanho_parte:
+                bloco = fluxo.read(min(TAMANHO_BLOCO, tamanho_parte - gravados))
+                if not bloco:
+                    break
+                arquivo.write(bloco)
+                if estado is not None:
+                    estado[1].update(bloco)
+                gravados += len(bloco)
+            if gravados != tamanho_parte:
+                arquivo.truncate(inicio)
+                raise ParteInvalida('Corpo menor que o intervalo informado')
+            arquivo.flush()
+            os.fsync(arquivo.fileno())
+
+        upload.recebidos = inicio + gravados
+        if upload.recebidos < upload.tamanho_bytes:
+            if estado is not None:
+                with _hashes_lock:
+                    _hashes[upload.id] = (upload.recebidos, estado[1])
+            return None
+        return UploadAnexoService.concluir(upload, estado[1] if estado is not None else None)
+
+    @staticmethod
+    def concluir(upload, hash_sha256=None):
+        """Mover o arquivo completo para o armazenamento por hash e criar o anexo"""
+        caminho_parcial = ArmazenamentoAnexos.caminho_parcial(upload.id)
+        if hash_sha256 is None:
+            hash_sha256 = hashlib.sha256()
+            with open(caminho_parcial, 'rb') as arquivo:
+                for bloco in iter(lambda: arquivo.read(TAMANHO_BLOCO), b''):
+                    hash_sha256.update(bloco)
+        sha256 = hash_sha256.hexdigest()
+
+        # A referência é gravada antes de mover o arquivo: a transação que
+        # libera o mesmo objeto espera por esta, e não apaga o arquivo novo
+        if ArmazenamentoAnexos.referenciar(sha256, upload.tamanho_bytes):
+            # Conteúdo novo: miniaturas e prévias são geradas após o commit
+            db.session.info.setdefault('objetos_novos', []).append(sha256)
+        # Mesmo conteúdo já armazenado: o parcial é descartado após o commit,
+        # junto com o upload, e continua disponível se a transação falhar
+        destino = ArmazenamentoAnexos.caminho(sha256)
+        if not os.path.exists(destino):
+            os.makedirs(os.path.dirname(destino), exist_ok=True)
+            os.replace(caminho_parcial, destino)
+            # Em caso de rollback o arquivo volta a ser o parcial, e o upload pode ser retomado
+            db.session.info.setdefault('objetos_gravados', []).append((destino, caminho_parcial))
+
+        anexo = AnexoAvaliacao(
+            avaliacao_id=upload.avaliacao_id,
+            nome_arquivo=upload.nome_arquivo,
+            tipo_arquivo=upload.tipo_arquivo,
+            categoria=upload.categoria,
+            tamanho_bytes=upload.tamanho_bytes,
+            url_arquivo=ArmazenamentoAnexos.chave(sha256),
+            sha256=sha256
+        )
+        db.session.add(anexo)
+        db.session.delete(upload)
+        return anexo
+
+    @staticmethod
+    def cancelar(upload):
+        # O arquivo parcial é apagado após o commit (ver _descartar_parcial)
+        db.session.delete(upload)
+
+    @staticmethod
+    def expirar(antes):
+        """Cancelar uploads sem atividade desde `antes` e apagar parciais sem upload; retorna quantos"""
+        abandonados = UploadAnexo.query.filter(UploadAnexo.data_atualizacao < antes).all()
+        for upload in abandonados:
+            UploadAnexoService.cancelar(upload)
+        db.session.flush()
+
+        # Parciais cujo upload nunca chegou ao banco (falha no commit de iniciar)
+        diretorio = os.path.join(ArmazenamentoAnexos.raiz(), 'uploads')
+        try:
+            nomes = os.listdir(diretorio)
+        except FileNotFoundError:
+            nomes = []
+        limite = antes.timestamp()
+        conhecidos = set(db.session.execute(select(UploadAnexo.id).where(UploadAnexo.id.in_(nomes))).scalars())
+        for nome in nomes:
+            caminho = os.path.join(diretorio, nome)
+            if nome not in conhecidos and os.path.getmtime(caminho) < limite:
+                db.session.info.setdefault('uploads_descartados', []).append(caminho)
+        return len(abandonados)
+
+
+# Exclusão de anexos (inclusive em cascata, ao excluir avaliação ou paciente):
+# o objeto sem referências é removido na mesma transação e o arquivo só é
+# apagado depois do commit, ou restaurado em caso de rollback
+@event.listens_for(AnexoAvaliacao, 'after_delete')
+def _liberar_objeto(mapper, connection, anexo):
+    if not anexo.sha256:
+        return
+    removidos = ArmazenamentoAnexos.liberar(connection, anexo.sha256)
+    if removidos:
+        object_session(anexo).info.setdefault('anexos_removidos', []).extend(removidos)
+
+
+# Upload concluído, cancelado ou excluído com a avaliação: o parcial é descartado após o commit
+@event.listens_for(UploadAnexo, 'after_delete')
+def _descartar_parcial(mapper, connection, upload):
+    with _hashes_lock:
+        _hashes.pop(upload.id, None)
+    object_session(upload).info.setdefault('uploads_descartados', []).append(
+        ArmazenamentoAnexos.caminho_parcial(upload.id)
+    )
+
+
+@event.listens_for(Session, 'after_commit')
+def _apagar_removidos(session):
+    session.info.pop('objetos_gravados', None)
+    for caminho in session.info.pop('anexos_removidos', []) + session.info.pop('uploads_descartados', []):
+        try:
+            os.remove(caminho)
+        except FileNotFoundError:
+            pass
+
+
+@event.listens_for(Session, 'after_rollback')
+def _restaurar_removidos(session):
+    session.info.pop('uploads_descartados', None)
+    for destino, caminho_parcial in session.info.pop('objetos_gravados', []):
+        try:
+            os.replace(destino, caminho_parcial)
+        except FileNotFoundError:
+            pass
+    for caminho in session.info.pop('anexos_removidos', []):
+        try:
+            os.replace(caminho, caminho[:-len(_SUFIXO_REMOVIDO)])
+        except FileNotFoundError:
+            pass
+
+
+@click.command('anexos-limpar-uploads')
+@click.option('--horas', type=int, default=None,
+              help='Idade mínima sem atividade (padrão: ANEXOS_UPLOADS_VALIDADE_HORAS)')
+@with_appcontext
+def comando_limpar_uploads(horas):
+    """Apagar uploads em partes abandonados e seus arquivos parciais (para uso em cron)"""
+    horas = horas or current_app.config.get('ANEXOS_UPLOADS_VALIDADE_HORAS', VALIDADE_UPLOADS_HORAS)
+    removidos = UploadAnexoService.expirar(datetime.utcnow() - timedelta(hours=horas))
+    db.session.commit()
+    click.echo(f'{removidos} uploads abandonados removidos')
@@ -0,0 +1,231 @@
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import event, select, update
+from sqlalchemy.orm import Session
+from src.anexos.armazenamento_service import ArmazenamentoAnexos, ObjetoAnexo
+from src.models.fisio_models import db
+
+logger = logging.getLogger(__name__)
+
+# Maior lado, em pixels, de cada derivado gerado para imagens e PDFs
+TAMANHOS_DERIVADOS = {
+    'miniatura': 256,
+    'previa': 1280,
+}
+QUALIDADE_JPEG = 85
+TAMANHO_LOTE = 20
+WORKERS = 2
+
+# Sinalizado após o commit de conteúdo novo, para o agendador não esperar o intervalo
+_novos = threading.Event()
+
+
+def _medidas(imagem, caminho):
+    return {'largura': imagem.width, 'altura': imagem.height, 'tamanho_bytes': os.path.getsize(caminho)}
+
+
+def _primeira_pagina(caminho, lado):
+    import pypdfium2 as pdfium
+    documento = pdfium.PdfDocument(caminho)
+    try:
+        pagina = documento[0]
+        largura, altura = pagina.get_size()
+        return pagina.render(scale=lado / max(largura, altura)).to_pil()
+    finally:
+        documento.close()
+
+
+def _decodificar(caminho, lado):
+    """Imagem RGB do conteúdo (primeira página, se PDF), já próxima do maior lado pedido"""
+    from PIL import Image, ImageOps
+    with open(caminho, 'rb') as arquivo:
+        pdf = arquivo.read(5) == b'%PDF-'
+    if pdf:
+        imagem = _primeira_pagina(caminho, lado)
+    else:
+        imagem = Image.open(caminho)
+        # JPEG: decodificado direto em escala reduzida, sem montar a resolução total
+        imagem.draft('RGB', (lado, lado))
+        # Fotos de celular: a orientação vem no EXIF
+        imagem = ImageOps.exif_transpose(imagem)
+    if imagem.mode in ('RGBA', 'LA', 'PA') or (imagem.mode == 'P' and 'transparency' in imagem.info):
+        imagem = imagem.convert('RGBA')
+        fundo = Image.new('RGB', imagem.size, 'white')
+        fundo.paste(imagem, mask=imagem.getchannel('A'))
+        return fundo
+    return imagem.convert('RGB')
+
+
+def gerar_derivados(caminho, destinos):
+    """Executada nos processos do pool: grava os derivados ausentes e retorna as medidas de todos
+
+    `destinos` é {tipo: (maior lado, caminho)}. Derivados já gravados não são
+    refeitos; conteúdo que não é imagem nem PDF (ou não decodifica) resulta em {}.
+    """
+    from PIL import Image
+    derivados = {}
+    for tipo, (_, destino) in destinos.items():
+        if os.path.exists(destino):
+            with Image.open(destino) as imagem:
+                derivados[tipo] = _medidas(imagem, destino)
+    faltantes = sorted(
+        ((lado, tipo, destino) for tipo, (lado, destino) in destinos.items() if tipo not in derivados),
+        reverse=True
+    )
+    if not faltantes:
+        return derivados
+
+    try:
+        imagem = _decodificar(caminho, faltantes[0][0])
+    except FileNotFoundError:
+        raise
+    except Exception as e:
+        logger.info('Sem prévia para %s: %s', caminho, e)
+        return {}
+
+    # Do maior para o menor, reduzindo a mesma imagem
+    for lado, tipo, destino in faltantes:
+        imagem.thumbnail((lado, lado), Image.Resampling.LANCZOS)
+        temporario = f'{destino}.{os.getpid()}.tmp'
+        imagem.save(temporario, 'JPEG', quality=QUALIDADE_JPEG, optimize=True, progressive=True)
+        os.replace(temporario, destino)
+        derivados[tipo] = _medidas(imagem, destino)
+    return derivados
+
+
+class DerivadosService:
+    @staticmethod
+    def destinos(sha256):
+        return {
+            tipo: (lado, ArmazenamentoAnexos.caminho_derivado(sha256, tipo))
+            for tipo, lado in TAMANHOS_DERIVADOS.items()
+        }
+
+    @staticmethod
+    def pendentes(apos=None, limite=TAMANHO_LOTE):
+        """Hashes de objetos ainda sem derivados, em ordem"""
+        consulta = select(ObjetoAnexo.sha256).where(ObjetoAnexo.derivados.is_(None))
+        if apos is not None:
+            consulta = consulta.where(ObjetoAnexo.sha256 > apos)
+        return db.session.execute(consulta.order_by(ObjetoAnexo.sha256).limit(limite)).scalars().all()
+
+    @staticmethod
+    def registrar(sha256, derivados):
+        resultado = db.session.execute(
+            update(ObjetoAnexo).where(ObjetoAnexo.sha256 == sha256).values(derivados=derivados)
+        )
+        if resultado.rowcount:
+            return True
+        # Objeto excluído durante a geração: os arquivos gravados não têm dono
+        for tipo in derivados:
+            try:
+                os.remove(ArmazenamentoAnexos.caminho_derivado(sha256, tipo))
+            except FileNotFoundError:
+                pass
+        return False
+
+
+class GeradorDerivados:
+    """Pool de processos que gera miniaturas e prévias dos objetos pendentes
+
+    Decodificar e reduzir imagens é trabalho de CPU: em processos, não disputa
+    o GIL com as requisições. Vários geradores (um por processo da aplicação)
+    podem rodar juntos; o pior caso é gerar o mesmo objeto duas vezes, com
+    gravação atômica dos arquivos.
+    """
+
+    def __init__(self, app, workers=WORKERS, tamanho_lote=TAMANHO_LOTE):
+        self.app = app
+        self.workers = workers
+        self.tamanho_lote = tamanho_lote
+
+    def processar_pendentes(self):
+        """Gerar os derivados de todos os objetos pendentes; retorna quantos foram registrados"""
+        with self.app.app_context():
+            total = 0
+            apos = None
+            pool = None
+            try:
+                while True:
+                    lote = DerivadosService.pendentes(apos, self.tamanho_lote)
+                    if not lote:
+                        return total
+                    # Falhas ficam pendentes para o próximo ciclo, sem repetir nesta execução
+                    apos = lote[-1]
+                    if pool is None:
+                        # Chamado de uma thread da aplicação: fork copiaria locks e conexões do pai
+                        pool = ProcessPoolExecutor(
+                            max_workers=self.workers, mp_context=multiprocessing.get_context('forkserver')
+                        )
+                    futuros = {
+                        pool.submit(gerar_derivados, ArmazenamentoAnexos.caminho(sha256),
+                                    DerivadosService.destinos(sha256)): sha256
+                        for sha256 in lote
+                    }
+                    for futuro in as_completed(futuros):
+                        try:
+                            derivados = futuro.result()
+                        except Exception:
+                            logger.exception('Falha ao gerar derivados de %s', futuros[futuro])
+                            continue
+                        if DerivadosService.registrar(futuros[futuro], derivados):
+                            total += 1
+                    db.session.commit()
+            finally:
+                if pool is not None:
+                    pool.shutdown()
+
+
+class AgendadorDerivados(threading.Thread):
+    """Thread que gera os derivados após cada upload de conteúdo novo e, periodicamente, os pendentes"""
+
+    def __init__(self, app, intervalo_segundos=300):
+        super().__init__(name='derivados-anexos', daemon=True)
+        self.intervalo_segundos = intervalo_segundos
+        self.parar = threading.Event()
+        self.gerador = GeradorDerivados(app, app.config.get('ANEXOS_DERIVADOS_WORKERS', WORKERS))
+
+    def run(self):
+        while not self.parar.is_set():
+            _novos.clear()
+            try:
+                self.gerador.processar_pendentes()
+            except Exception:
+                logger.exception('Falha no ciclo de derivados de anexos')
+            _novos.wait(self.intervalo_segundos)
+
+
+def iniciar_derivados(app):
+    """Iniciar a geração em segundo plano se app.config['ANEXOS_DERIVADOS_ATIVOS']"""
+    if not app.config.get('ANEXOS_DERIVADOS_ATIVOS'):
+        return None
+    agendador = AgendadorDerivados(app, app.config.get('ANEXOS_DERIVADOS_INTERVALO_SEGUNDOS', 300))
+    agendador.start()
+    return agendador
+
+
+@event.listens_for(Session, 'after_commit')
+def _avisar_novos(session):
+    if session.info.pop('objetos_novos', None):
+        _novos.set()
+
+
+@event.listens_for(Session, 'after_rollback')
+def _descartar_novos(session):
+    session.info.pop('objetos_novos', None)
+
+
+@click.command('anexos-derivados')
+@click.option('--workers', type=int, default=None, help='Processos do pool (padrão: ANEXOS_DERIVADOS_WORKERS)')
+@with_appcontext
+def comando_derivados(workers):
+    """Gerar miniaturas e prévias pendentes dos anexos (carga inicial ou cron)"""
+    app = current_app._get_current_object()
+    gerados = GeradorDerivados(app, workers or app.config.get('ANEXOS_DERIVADOS_WORKERS', WORKERS)).processar_pendentes()
+    click.echo(f'{gerados} objetos processados')
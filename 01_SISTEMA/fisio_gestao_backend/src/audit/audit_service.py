@@ -6,6 +6,9 @@ from sqlalchemy import Column, Integer, String, DateTime, Text, Boolean
 class LogAuditoria(db.Model):
     """Modelo para logs de auditoria - LGPD compliance"""
     __tablename__ = 'logs_auditoria'
+    __table_args__ = (
+        db.Index('ix_logs_auditoria_registro', 'tabela', 'registro_id', 'data_hora'),
+    )
     
     id = Column(Integer, primary_key=True)
     fisioterapeuta_id = Column(Integer, db.ForeignKey('fisioterapeutas.id'), nullable=True)
@@ -70,6 +73,37 @@ class AuditoriaService:
             # Em caso de erro no log, não deve afetar a operação principal
             print(f"Erro ao registrar log de auditoria: {str(e)}")
     
+    @staticmethod
+    def log_acoes_em_lote(acao, tabela, registros, fisioterapeuta_id=None, observacoes=None):
+        """Registrar uma entrada por registro com um único INSERT em lote, na transação corrente
+
+        `registros` é uma lista de dicts com registro_id, dados_anteriores e dados_novos.
+        """
+        if not registros:
+            return
+        ip_address = request.remote_addr if request else None
+        user_agent = request.headers.get('User-Agent') if request else None
+        if not fisioterapeuta_id and hasattr(request, 'current_fisioterapeuta'):
+            fisioterapeuta_id = request.current_fisioterapeuta.id
+        
+        agora = datetime.utcnow()
+        db.session.execute(LogAuditoria.__table__.insert(), [
+            {
+                'fisioterapeuta_id': fisioterapeuta_id,
+                'acao': acao,
+                'tabela': tabela,
+                'registro_id': registro['registro_id'],
+                'dados_anteriores': registro.get('dados_anteriores'),
+                'dados_novos': registro.get('dados_novos'),
+                'ip_address': ip_address,
+                'user_agent': user_agent,
+                'data_hora': agora,
+                'sucesso': True,
+                'observacoes': observacoes
+            }
+            for registro in registros
+        ])
+    
     @staticmethod
     def log_acesso_dados_pessoais(paciente_id, tipo_acesso, fisioterapeuta_id=None):
         """Log específico para acesso a dados pessoais - LGPD"""
@@ -0,0 +1,248 @@
+import html
+import re
+from sqlalchemy import column, event, inspect, select, table, text
+from src.models.fisio_models import Avaliacao, Evolucao, Paciente, db
+from src.busca.busca_service import BuscaPacienteService, normalizar_nome
+
+# Uma linha por avaliação ou evolução; `escopo` guarda o fisioterapeuta do
+# paciente como termo indexado, para que o MATCH já restrinja a busca aos
+# pacientes de quem pesquisa
+TABELA_NOTAS = 'notas_clinicas_busca'
+
+# Campos narrativos indexados de cada tipo, na ordem das colunas texto_1..3
+CAMPOS_NOTAS = {
+    'avaliacao': (Avaliacao, 'data_avaliacao', ('queixa_principal', 'diagnostico_fisioterapeutico',
+                                                'historia_atual_doenca')),
+    'evolucao': (Evolucao, 'data_sessao', ('resposta_paciente', 'intercorrencias', 'observacoes')),
+}
+# rowid = id * 2 + tipo: remoção e substituição pelo rowid, sem varrer o índice
+_TIPO_ROWID = {'avaliacao': 0, 'evolucao': 1}
+
+MARCA_INICIO = '<mark>'
+MARCA_FIM = '</mark>'
+# Delimitadores pedidos ao snippet(): o texto clínico é escapado para HTML
+# e só então eles viram as marcas acima
+_DELIMITADOR_INICIO = '\x02'
+_DELIMITADOR_FIM = '\x03'
+PALAVRAS_TRECHO = 12
+
+# Sufixos flexionais removidos dos termos (já sem acentos), do mais longo ao
+# mais curto; o radical é buscado por prefixo, então "irradiada" também
+# encontra "irradiação" e "irradiado"
+_SUFIXOS = (
+    'amentos', 'imentos', 'amento', 'imento', 'acoes', 'icoes', 'mente', 'idades', 'idade',
+    'acao', 'icao', 'adas', 'ados', 'idas', 'idos', 'ivas', 'ivos', 'oes', 'aes', 'ais', 'eis',
+    'ada', 'ado', 'ida', 'ido', 'iva', 'ivo', 'ao', 'as', 'os', 'es', 'a', 'o', 'e', 's',
+)
+_RADICAL_MINIMO = 4
+
+
+def radical(palavra):
+    """Radical aproximado de uma palavra em português (sem acentos, minúscula)"""
+    for sufixo in _SUFIXOS:
+        if palavra.endswith(sufixo) and len(palavra) - len(sufixo) >= _RADICAL_MINIMO:
+            return palavra[:-len(sufixo)]
+    return palavra
+
+
+def destacar(trecho):
+    """Trecho do snippet() como HTML seguro: texto escapado, termos entre MARCA_INICIO e MARCA_FIM"""
+    return (
+        html.escape(trecho)
+        .replace(_DELIMITADOR_INICIO, MARCA_INICIO)
+        .replace(_DELIMITADOR_FIM, MARCA_FIM)
+    )
+
+
+def _escopo(fisioterapeuta_id):
+    return f'fisio{fisioterapeuta_id}'
+
+
+def _rowid(tipo, registro_id):
+    return registro_id * 2 + _TIPO_ROWID[tipo]
+
+
+def expressao_busca(termo, fisioterapeuta_id):
+    """Expressão MATCH: escopo do fisioterapeuta E todos os radicais do termo nos campos de texto"""
+    radicais = [radical(palavra) for palavra in re.findall(r'\w+', normalizar_nome(termo))]
+    if not radicais:
+        return None
+    termos = ' AND '.join(f'"{item}"*' for item in radicais)
+    return f'escopo : "{_escopo(fisioterapeuta_id)}" AND {{texto_1 texto_2 texto_3}} : ({termos})'
+
+
+class BuscaClinicaService:
+    @staticmethod
+    def criar_indice(connection):
+        """Criar a tabela FTS5 e indexar notas ainda não indexadas"""
+        connection.execute(text(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {TABELA_NOTAS} USING fts5("
+            "escopo, paciente_id UNINDEXED, data UNINDEXED, texto_1, texto_2, texto_3, "
+            "tokenize='unicode61 remove_diacritics 2')"
+        ))
+        for tipo, (modelo, nome_data, campos) in CAMPOS_NOTAS.items():
+            pendentes = connection.execute(
+                select(modelo.id, modelo.paciente_id, Paciente.fisioterapeuta_id, getattr(modelo, nome_data),
+                       *[getattr(modelo, campo) for campo in campos])
+                .join(Paciente, Paciente.id == modelo.paciente_id)
+                .where(~(modelo.id * 2 + _TIPO_ROWID[tipo]).in_(
+                    select(column('rowid')).select_from(table(TABELA_NOTAS))
+                ))
+            ).fetchall()
+            BuscaClinicaService.indexar_lote(connection, tipo, pendentes)
+
+    @staticmethod
+    def remover_indice(connection):
+        connection.execute(text(f"DROP TABLE IF EXISTS {TABELA_NOTAS}"))
+
+    @staticmethod
+    def indexar_lote(connection, tipo, linhas):
+        """Indexar linhas (id, paciente_id, fisioterapeuta_id, data, texto_1, texto_2, texto_3)"""
+        if not linhas:
+            return
+        connection.execute(
+            text(f"INSERT INTO {TABELA_NOTAS}(rowid, escopo, paciente_id, data, texto_1, texto_2, texto_3) "
+                 "VALUES (:rowid, :escopo, :paciente_id, :data, :texto_1, :texto_2, :texto_3)"),
+            [
+                {
+                    'rowid': _rowid(tipo, registro_id),
+                    'escopo': _escopo(fisioterapeuta_id),
+                    'paciente_id': paciente_id,
+                    'data': data.isoformat() if data else None,
+                    'texto_1': textos[0] or '',
+                    'texto_2': textos[1] or '',
+                    'texto_3': textos[2] or ''
+                }
+                for registro_id, paciente_id, fisioterapeuta_id, data, *textos in linhas
+            ]
+        )
+
+    @staticmethod
+    def indexar(connection, tipo, registro):
+        """Inserir ou substituir a nota de uma avaliação ou evolução"""
+        _, nome_data, campos = CAMPOS_NOTAS[tipo]
+        BuscaClinicaService.remover(connection, tipo, registro.id)
+        fisioterapeuta_id = connection.execute(
+            select(Paciente.fisioterapeuta_id).where(Paciente.id == registro.paciente_id)
+        ).scalar()
+        BuscaClinicaService.indexar_lote(connection, tipo, [(
+            registro.id, registro.paciente_id, fisioterapeuta_id, getattr(registro, nome_data),
+            *[getattr(registro, campo) for campo in campos]
+        )])
+
+    @staticmethod
+    def remover(connection, tipo, registro_id):
+        connection.execute(text(f"DELETE FROM {TABELA_NOTAS} WHERE rowid = :rowid"),
+                           {'rowid': _rowid(tipo, registro_id)})
+
+    @staticmethod
+    def reindexar_paciente(connection, paciente_id):
+        """Reindexar todas as notas do paciente (ex.: troca de fisioterapeuta)"""
+        for tipo, (modelo, nome_data, campos) in CAMPOS_NOTAS.items():
+            linhas = connection.execute(
+                select(modelo.id, modelo.paciente_id, Paciente.fisioterapeuta_id, getattr(modelo, nome_data),
+                       *[getattr(modelo, campo) for campo in campos])
+                .join(Paciente, Paciente.id == modelo.paciente_id)
+                .where(modelo.paciente_id == paciente_id)
+            ).fetchall()
+            for linha in linhas:
+                BuscaClinicaService.remover(connection, tipo, linha[0])
+            BuscaClinicaService.indexar_lote(connection, tipo, linhas)
+
+    @staticmethod
+    def buscar(termo, fisioterapeuta_id, limite=20):
+        """Notas dos pacientes do fisioterapeuta que contêm o termo, por relevância (bm25), com trecho"""
+        expressao = expressao_busca(termo, fisioterapeuta_id)
+        if expressao is None:
+            return []
+
+        # bm25 com peso zero para o escopo (presente em todas as linhas do fisioterapeuta);
+        # um trecho por coluna de texto, para indicar o campo onde o termo aparece
+        trechos = ', '.join(
+            f"snippet({TABELA_NOTAS}, {coluna}, :inicio, :fim, '…', :palavras) AS trecho_{coluna}" for coluna in (3, 4, 5)
+        )
+        sql = (
+            f"SELECT rowid, paciente_id, data, {trechos}, "
+            f"bm25({TABELA_NOTAS}, 0, 0, 0, 1, 1, 1) AS pontuacao "
+            f"FROM {TABELA_NOTAS} WHERE {TABELA_NOTAS} MATCH :expressao "
+            f"ORDER BY pontuacao LIMIT :limite"
+        )
+        linhas = db.session.execute(text(sql), {
+            'expressao': expressao,
+            'inicio': _DELIMITADOR_INICIO,
+            'fim': _DELIMITADOR_FIM,
+            'palavras': PALAVRAS_TRECHO,
+            'limite': limite
+        }).fetchall()
+
+        tipos = {ordem: tipo for tipo, ordem in _TIPO_ROWID.items()}
+        nomes = dict(db.session.execute(
+            select(Paciente.id, Paciente.nome_completo)
+            .where(Paciente.id.in_({int(linha.paciente_id) for linha in linhas}))
+        ).all()) if linhas else {}
+
+        def trecho(linha):
+            campos = CAMPOS_NOTAS[tipos[linha.rowid % 2]][2]
+            for campo, valor in zip(campos, (linha.trecho_3, linha.trecho_4, linha.trecho_5)):
+                if _DELIMITADOR_INICIO in (valor or ''):
+                    return campo, destacar(valor)
+            return None, None
+
+        resultados = []
+        for linha in linhas:
+            campo, valor = trecho(linha)
+            resultados.append({
+                'tipo': tipos[linha.rowid % 2],
+                'id': linha.rowid // 2,
+                'paciente_id': int(linha.paciente_id),
+                'nome_paciente': nomes.get(int(linha.paciente_id)),
+                'data': linha.data,
+                'campo': campo,
+                'trecho': valor,
+                'pontuacao': round(-linha.pontuacao, 4)
+            })
+        return resultados
+
+
+@event.listens_for(db.metadata, 'after_create')
+def _criar_indice_notas(target, connection, **kw):
+    if BuscaPacienteService.disponivel(connection):
+        BuscaClinicaService.criar_indice(connection)
+
+
+@event.listens_for(db.metadata, 'before_drop')
+def _remover_indice_notas(target, connection, **kw):
+    if BuscaPacienteService.disponivel(connection):
+        BuscaClinicaService.remover_indice(connection)
+
+
+def _registrar_eventos(tipo, modelo, nome_data, campos):
+    @event.listens_for(modelo, 'after_insert')
+    def _indexar_inserido(mapper, connection, registro):
+        if BuscaPacienteService.disponivel(connection):
+            BuscaClinicaService.indexar(connection, tipo, registro)
+
+    @event.listens_for(modelo, 'after_update')
+    def _indexar_atualizado(mapper, connection, registro):
+        if not BuscaPacienteService.disponivel(connection):
+            return
+        estado = inspect(registro)
+        if any(estado.attrs[campo].history.has_changes() for campo in (*campos, nome_data, 'paciente_id')):
+            BuscaClinicaService.indexar(connection, tipo, registro)
+
+    @event.listens_for(modelo, 'after_delete')
+    def _remover_excluido(mapper, connection, registro):
+        if BuscaPacienteService.disponivel(connection):
+            BuscaClinicaService.remover(connection, tipo, registro.id)
+
+
+for _tipo, (_modelo, _nome_data, _campos) in CAMPOS_NOTAS.items():
+    _registrar_eventos(_tipo, _modelo, _nome_data, _campos)
+
+
+@event.listens_for(Paciente, 'after_update')
+def _reindexar_troca_fisioterapeuta(mapper, connection, paciente):
+    if not BuscaPacienteService.disponivel(connection):
+        return
+    if inspect(paciente).attrs.fisioterapeuta_id.history.has_changes():
+        BuscaClinicaService.reindexar_paciente(connection, paciente.id)
@@ -0,0 +1,221 @@
+import re
+import unicodedata
+from sqlalchemy import Integer, event, inspect, text
+from src.models.fisio_models import Paciente, db
+
+# Índice por prefixo de palavra (acentos removidos pelo próprio tokenizador)
+TABELA_PREFIXO = 'pacientes_busca_prefixo'
+# Índice por trigramas sobre o nome normalizado (busca no meio da palavra)
+TABELA_TRIGRAMA = 'pacientes_busca_trigrama'
+# Máximo de correspondências lidas de cada índice antes da ordenação
+CANDIDATOS_POR_INDICE = 200
+
+
+def normalizar_nome(nome):
+    """Remover acentos e caixa para comparação de nomes em português"""
+    if not nome:
+        return ''
+    decomposto = unicodedata.normalize('NFKD', nome)
+    sem_acentos = ''.join(c for c in decomposto if not unicodedata.combining(c))
+    return sem_acentos.casefold()
+
+
+def _tokens(termo):
+    return re.findall(r'\w+', normalizar_nome(termo))
+
+
+def _expressao_prefixo(tokens):
+    return ' '.join(f'"{token}"*' for token in tokens)
+
+
+def _expressao_trigrama(tokens):
+    # O tokenizador trigram só indexa sequências de 3 ou mais caracteres
+    return ' '.join(f'"{token}"' for token in tokens if len(token) >= 3)
+
+
+def _ramo_trigrama(tokens, coluna_id):
+    """Condição do ramo por trigrama e seus parâmetros, ou None se nenhum token tem 3 caracteres
+
+    Tokens curtos não entram no trigrama; para a busca continuar exigindo
+    todas as palavras ("jo silva"), eles viram condição de prefixo.
+    """
+    expressao_trigrama = _expressao_trigrama(tokens)
+    if not expressao_trigrama:
+        return None
+    condicao = 'MATCH :expr_trigrama'
+    parametros = {'expr_trigrama': expressao_trigrama}
+    curtos = [token for token in tokens if len(token) < 3]
+    if curtos:
+        condicao += (f' AND {coluna_id} IN (SELECT rowid FROM {TABELA_PREFIXO} '
+                     f'WHERE {TABELA_PREFIXO} MATCH :expr_curtos)')
+        parametros['expr_curtos'] = _expressao_prefixo(curtos)
+    return condicao, parametros
+
+
+class BuscaPacienteService:
+    @staticmethod
+    def disponivel(bind):
+        """Índice FTS5 disponível apenas no SQLite"""
+        return bind.dialect.name == 'sqlite'
+
+    @staticmethod
+    def criar_indices(connection):
+        """Criar tabelas FTS5 e indexar pacientes ainda não indexados"""
+        connection.execute(text(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {TABELA_PREFIXO} USING fts5("
+            "nome, tokenize='unicode61 remove_diacritics 2', prefix='1 2 3')"
+        ))
+        connection.execute(text(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {TABELA_TRIGRAMA} USING fts5("
+            "nome, tokenize='trigram')"
+        ))
+
+        pendentes = connection.execute(text(
+            f"SELECT id, nome_completo FROM pacientes "
+            f"WHERE id NOT IN (SELECT rowid FROM {TABELA_PREFIXO})"
+        )).fetchall()
+        BuscaPacienteService.indexar_lote(connection, pendentes)
+
+    @staticmethod
+    def remover_indices(connection):
+        """Remover tabelas FTS5"""
+        connection.execute(text(f"DROP TABLE IF EXISTS {TABELA_PREFIXO}"))
+        connection.execute(text(f"DROP TABLE IF EXISTS {TABELA_TRIGRAMA}"))
+
+    @staticmethod
+    def indexar(connection, paciente_id, nome):
+        """Inserir ou substituir o nome do paciente nos índices de busca"""
+        BuscaPacienteService.remover(connection, paciente_id)
+        connection.execute(
+            text(f"INSERT INTO {TABELA_PREFIXO}(rowid, nome) VALUES (:id, :nome)"),
+            {'id': paciente_id, 'nome': nome or ''}
+        )
+        connection.execute(
+            text(f"INSERT INTO {TABELA_TRIGRAMA}(rowid, nome) VALUES (:id, :nome)"),
+            {'id': paciente_id, 'nome': normalizar_nome(nome)}
+        )
+
+    @staticmethod
+    def indexar_lote(connection, pacientes):
+        """Indexar pacientes recém-inseridos, dados como pares (id, nome)"""
+        if not pacientes:
+            return
+        connection.execute(
+            text(f"INSERT INTO {TABELA_PREFIXO}(rowid, nome) VALUES (:id, :nome)"),
+            [{'id': paciente_id, 'nome': nome or ''} for paciente_id, nome in pacientes]
+        )
+        connection.execute(
+            text(f"INSERT INTO {TABELA_TRIGRAMA}(rowid, nome) VALUES (:id, :nome)"),
+            [{'id': paciente_id, 'nome': normalizar_nome(nome)} for paciente_id, nome in pacientes]
+        )
+
+    @staticmethod
+    def remover(connection, paciente_id):
+        """Remover paciente dos índices de busca"""
+        for tabela in (TABELA_PREFIXO, TABELA_TRIGRAMA):
+            connection.execute(text(f"DELETE FROM {tabela} WHERE rowid = :id"), {'id': paciente_id})
+
+    @staticmethod
+    def _consulta_ranqueada(tokens, filtros_sql, limite):
+        """Montar SQL que une correspondências por prefixo (primeiro) e por trigrama"""
+        # bm25 pontua todas as correspondências antes do LIMIT; com nomes curtos
+        # e termos comuns isso custa dezenas de ms. Limitamos os candidatos de
+        # cada índice e ordenamos pelo nome mais curto (mais próximo do termo).
+        ramos = [
+            f"SELECT * FROM (SELECT p.id AS id, 0 AS grupo "
+            f"FROM {TABELA_PREFIXO} b JOIN pacientes p ON p.id = b.rowid "
+            f"WHERE b.nome MATCH :expr_prefixo{filtros_sql} LIMIT :candidatos)"
+        ]
+        parametros = {
+            'expr_prefixo': _expressao_prefixo(tokens),
+            'candidatos': CANDIDATOS_POR_INDICE,
+            'limite': limite
+        }
+
+        trigrama = _ramo_trigrama(tokens, 'p.id')
+        if trigrama:
+            condicao, parametros_trigrama = trigrama
+            ramos.append(
+                f"SELECT * FROM (SELECT p.id AS id, 1 AS grupo "
+                f"FROM {TABELA_TRIGRAMA} b JOIN pacientes p ON p.id = b.rowid "
+                f"WHERE b.nome {condicao}{filtros_sql} LIMIT :candidatos)"
+            )
+            parametros.update(parametros_trigrama)
+
+        sql = (
+            "SELECT c.id AS id, MIN(c.grupo) AS grupo, p.nome_completo, "
+            "p.data_nascimento, p.telefone "
+            f"FROM ({' UNION ALL '.join(ramos)}) c JOIN pacientes p ON p.id = c.id "
+            "GROUP BY c.id "
+            "ORDER BY grupo, length(p.nome_completo), p.nome_completo LIMIT :limite"
+        )
+        return sql, parametros
+
+    @staticmethod
+    def buscar(termo, limite=20, fisioterapeuta_id=None, apenas_ativos=False):
+        """Buscar pacientes por nome, ranqueados por relevância"""
+        tokens = _tokens(termo)
+        if not tokens:
+            return []
+
+        filtros_sql = ''
+        parametros_filtro = {}
+        if fisioterapeuta_id:
+            filtros_sql += ' AND p.fisioterapeuta_id = :fisioterapeuta_id'
+            parametros_filtro['fisioterapeuta_id'] = fisioterapeuta_id
+        if apenas_ativos:
+            filtros_sql += ' AND p.ativo = 1'
+
+        sql, parametros = BuscaPacienteService._consulta_ranqueada(tokens, filtros_sql, limite)
+        parametros.update(parametros_filtro)
+        return db.session.execute(text(sql), parametros).fetchall()
+
+    @staticmethod
+    def filtro_ids(termo):
+        """Subconsulta de ids de pacientes cujo nome corresponde ao termo"""
+        tokens = _tokens(termo)
+        if not tokens:
+            return text("SELECT id FROM pacientes WHERE 0").columns(id=Integer)
+
+        sql = f"SELECT rowid AS id FROM {TABELA_PREFIXO} WHERE {TABELA_PREFIXO} MATCH :expr_prefixo"
+        parametros = {'expr_prefixo': _expressao_prefixo(tokens)}
+
+        trigrama = _ramo_trigrama(tokens, 'rowid')
+        if trigrama:
+            condicao, parametros_trigrama = trigrama
+            sql += f" UNION SELECT rowid FROM {TABELA_TRIGRAMA} WHERE {TABELA_TRIGRAMA} {condicao}"
+            parametros.update(parametros_trigrama)
+
+        return text(sql).bindparams(**parametros).columns(id=Integer)
+
+
+@event.listens_for(db.metadata, 'after_create')
+def _criar_indices_busca(target, connection, **kw):
+    if BuscaPacienteService.disponivel(connection):
+        BuscaPacienteService.criar_indices(connection)
+
+
+@event.listens_for(db.metadata, 'before_drop')
+def _remover_indices_busca(target, connection, **kw):
+    if BuscaPacienteService.disponivel(connection):
+        BuscaPacienteService.remover_indices(connection)
+
+
+@event.listens_for(Paciente, 'after_insert')
+def _indexar_paciente_inserido(mapper, connection, paciente):
+    if BuscaPacienteService.disponivel(connection):
+        BuscaPacienteService.indexar(connection, paciente.id, paciente.nome_completo)
+
+
+@event.listens_for(Paciente, 'after_update')
+def _indexar_paciente_atualizado(mapper, connection, paciente):
+    if not BuscaPacienteService.disponivel(connection):
+        return
+    if inspect(paciente).attrs.nome_completo.history.has_changes():
+        BuscaPacienteService.indexar(connection, paciente.id, paciente.nome_completo)
+
+
+@event.listens_for(Paciente, 'after_delete')
+def _remover_paciente_excluido(mapper, connection, paciente):
+    if BuscaPacienteService.disponivel(connection):
+        BuscaPacienteService.remover(connection, paciente.id)
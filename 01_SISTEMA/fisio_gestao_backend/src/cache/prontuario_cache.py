@@ -0,0 +1,95 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from sqlalchemy import event, func, select, union_all
+from sqlalchemy.orm import Session
+from src.models.fisio_models import Paciente, Avaliacao, Evolucao, Agendamento, db
+
+# Quantidade máxima de prontuários mantidos em memória por processo
+MAX_PRONTUARIOS = 256
+
+_MODELOS_PRONTUARIO = (Avaliacao, Evolucao, Agendamento)
+
+
+class ProntuarioCache:
+    """Cache em memória dos prontuários serializados, por paciente"""
+
+    _entradas = OrderedDict()
+    _lock = threading.Lock()
+
+    @staticmethod
+    def versao(paciente_id):
+        """Calcular versão do prontuário em uma única consulta
+
+        A versão combina a data_atualizacao mais recente entre o paciente e
+        seus registros com a contagem de cada tabela, para que exclusões
+        também mudem a versão.
+        """
+        partes = [
+            select(
+                func.max(Paciente.data_atualizacao).label('atualizacao'),
+                func.count().label('total')
+            ).where(Paciente.id == paciente_id)
+        ]
+        for modelo in _MODELOS_PRONTUARIO:
+            partes.append(
+                select(
+                    func.max(modelo.data_atualizacao).label('atualizacao'),
+                    func.count().label('total')
+                ).where(modelo.paciente_id == paciente_id)
+            )
+
+        linhas = db.session.execute(union_all(*partes)).fetchall()
+        if not linhas[0].total:
+            return None
+        return tuple((str(linha.atualizacao), linha.total) for linha in linhas)
+
+    @staticmethod
+    def etag(paciente_id, versao):
+        """Gerar ETag forte a partir da versão do prontuário"""
+        resumo = hashlib.sha1(repr((paciente_id, versao)).encode('utf-8')).hexdigest()
+        return f'prontuario-{paciente_id}-{resumo[:20]}'
+
+    @classmethod
+    def obter(cls, paciente_id, versao):
+        """Obter corpo serializado em cache se a versão ainda for a mesma"""
+        with cls._lock:
+            entrada = cls._entradas.get(paciente_id)
+            if entrada is None or entrada[0] != versao:
+                return None
+            cls._entradas.move_to_end(paciente_id)
+            return entrada[1]
+
+    @classmethod
+    def armazenar(cls, paciente_id, versao, corpo):
+        """Guardar corpo serializado do prontuário"""
+        with cls._lock:
+            cls._entradas[paciente_id] = (versao, corpo)
+            cls._entradas.move_to_end(paciente_id)
+            while len(cls._entradas) > MAX_PRONTUARIOS:
+                cls._entradas.popitem(last=False)
+
+    @classmethod
+    def invalidar(cls, *pacientes_ids):
+        """Descartar prontuários em cache dos pacientes informados"""
+        with cls._lock:
+            for paciente_id in pacientes_ids:
+                cls._entradas.pop(paciente_id, None)
+
+    @classmethod
+    def limpar(cls):
+        """Descartar todo o cache"""
+        with cls._lock:
+            cls._entradas.clear()
+
+
+@event.listens_for(Session, 'after_flush')
+def _invalidar_prontuarios_alterados(session, flush_context):
+    pacientes_ids = set()
+    for instancia in (*session.new, *session.dirty, *session.deleted):
+        if isinstance(instancia, _MODELOS_PRONTUARIO):
+            pacientes_ids.add(instancia.paciente_id)
+        elif isinstance(instancia, Paciente):
+            pacientes_ids.add(instancia.id)
+    if pacientes_ids:
+        ProntuarioCache.invalidar(*pacientes_ids)
@@ -0,0 +1,235 @@
+import re
+from sqlalchemy import delete, event, exists, inspect, insert, select
+from sqlalchemy.orm import aliased
+from src.models.fisio_models import Avaliacao, CAMPOS_CIF, Paciente, db
+
+# Código da CIF: componente (b, s, d, e) seguido de 3 a 5 dígitos
+_PADRAO_CODIGO = re.compile(r'^[bsde]\d{3,5}$')
+# Qualificador textual: "3", "+2" (facilitador) ou o código completo "b280.3"
+_PADRAO_QUALIFICADOR = re.compile(r'^(?:[bsde]\d{3,5})?\.?([+-]?\d)')
+# 8 (não especificado, também +8) e 9 (não aplicável) não são graus: no índice
+# ficam NULL, fora dos filtros de faixa de qualificador
+SEM_GRAU = frozenset({8, 9, -8})
+
+
+class IndiceCif(db.Model):
+    """Índice invertido dos códigos da CIF de cada avaliação (mantido pelos eventos de Avaliacao)"""
+    __tablename__ = 'avaliacoes_cif'
+    __table_args__ = (
+        db.Index('ix_avaliacoes_cif_codigo', 'codigo', 'qualificador', 'data_avaliacao'),
+    )
+
+    avaliacao_id = db.Column(db.Integer, db.ForeignKey('avaliacoes.id'), primary_key=True)
+    codigo = db.Column(db.String(6), primary_key=True)
+    paciente_id = db.Column(db.Integer, db.ForeignKey('pacientes.id'), nullable=False)
+    # Primeiro qualificador do código; facilitadores dos fatores ambientais
+    # (+1 a +4) ficam negativos, para que o intervalo meça sempre a barreira.
+    # NULL sem qualificador ou com 8/9 (ver SEM_GRAU)
+    qualificador = db.Column(db.Integer)
+    data_avaliacao = db.Column(db.DateTime)
+
+    def to_dict(self):
+        return {
+            'avaliacao_id': self.avaliacao_id,
+            'codigo': self.codigo,
+            'paciente_id': self.paciente_id,
+            'qualificador': self.qualificador,
+            'data_avaliacao': self.data_avaliacao.isoformat() if self.data_avaliacao else None
+        }
+
+
+def _qualificador_bruto(valor):
+    if isinstance(valor, dict):
+        valor = valor.get('qualificador', valor.get('qualificadores'))
+    if isinstance(valor, (list, tuple)):
+        valor = valor[0] if valor else None
+    return None if valor == '' else valor
+
+
+def converter_qualificador(valor):
+    """Qualificador bruto como inteiro (facilitador negativo) ou None se ilegível"""
+    if isinstance(valor, bool) or valor is None:
+        return None
+    if isinstance(valor, (int, float)):
+        return int(valor)
+    correspondencia = _PADRAO_QUALIFICADOR.match(str(valor).strip().lower())
+    if not correspondencia:
+        return None
+    texto = correspondencia.group(1)
+    return -int(texto[1:]) if texto.startswith('+') else int(texto)
+
+
+def entradas_cif(documento):
+    """Entradas (código normalizado, qualificador bruto) de um campo da CIF
+
+    Aceita {código: qualificador}, {código: {'qualificador': ...}}, lista de
+    códigos ou lista de {'codigo': ..., 'qualificador': ...}; outros
+    formatos (como texto livre legado) não têm entradas.
+    """
+    if isinstance(documento, dict):
+        itens = documento.items()
+    elif isinstance(documento, list):
+        itens = [
+            (item.get('codigo'), item) if isinstance(item, dict) else (item, None)
+            for item in documento
+        ]
+    else:
+        return
+    for codigo, valor in itens:
+        if not isinstance(codigo, str):
+            continue
+        # Notação da OMS: o qualificador pode vir no próprio código ("b280.3")
+        codigo, _, sufixo = codigo.strip().lower().partition('.')
+        bruto = _qualificador_bruto(valor)
+        yield codigo, bruto if bruto is not None else sufixo or None
+
+
+def codigos_cif(documento):
+    """Pares (código, qualificador) de um campo da CIF
+
+    Entradas sem código válido são ignoradas; códigos repetidos ficam com a
+    última ocorrência.
+    """
+    return {
+        codigo: converter_qualificador(bruto)
+        for codigo, bruto in entradas_cif(documento)
+        if _PADRAO_CODIGO.match(codigo)
+    }
+
+
+def _linhas(avaliacao_id, paciente_id, data_avaliacao, documentos):
+    pares = {}
+    for documento in documentos:
+        pares.update(codigos_cif(documento))
+    return [
+        {'avaliacao_id': avaliacao_id, 'codigo': codigo, 'paciente_id': paciente_id,
+         'qualificador': None if qualificador in SEM_GRAU else qualificador, 'data_avaliacao': data_avaliacao}
+        for codigo, qualificador in pares.items()
+    ]
+
+
+class IndiceCifService:
+    @staticmethod
+    def indexar(connection, avaliacao):
+        """Substituir as linhas do índice de uma avaliação"""
+        connection.execute(delete(IndiceCif).where(IndiceCif.avaliacao_id == avaliacao.id))
+        linhas = _linhas(avaliacao.id, avaliacao.paciente_id, avaliacao.data_avaliacao,
+                         [getattr(avaliacao, campo) for campo in CAMPOS_CIF])
+        if linhas:
+            connection.execute(insert(IndiceCif), linhas)
+
+    @staticmethod
+    def remover(connection, avaliacao_id):
+        connection.execute(delete(IndiceCif).where(IndiceCif.avaliacao_id == avaliacao_id))
+
+    @staticmethod
+    def reindexar(connection):
+        """Indexar as avaliações ainda ausentes do índice (carga inicial)"""
+        pendentes = connection.execute(
+            select(Avaliacao.id, Avaliacao.paciente_id, Avaliacao.data_avaliacao,
+                   *[getattr(Avaliacao, campo) for campo in CAMPOS_CIF])
+            .where(~Avaliacao.id.in_(select(IndiceCif.avaliacao_id)))
+        )
+        total = 0
+        while True:
+            lote = pendentes.fetchmany(1000)
+            if not lote:
+                return total
+            linhas = [item for linha in lote for item in _linhas(linha[0], linha[1], linha[2], linha[3:])]
+            if linhas:
+                connection.execute(insert(IndiceCif), linhas)
+            total += len(lote)
+
+    @staticmethod
+    def coorte(fisioterapeuta_id, condicoes, inicio=None, fim=None, apos=None, limite=50):
+        """Pacientes do fisioterapeuta que atendem a todas as condições, com a trajetória de cada código
+
+        `condicoes` é uma lista de (código, qualificador_min, qualificador_max):
+        o paciente entra se, para cada uma, tem alguma avaliação no período com
+        o código na faixa. As faixas só selecionam pacientes; a trajetória traz
+        todas as avaliações do período com o código, em ordem de data, para
+        comparar o primeiro e o último qualificador. Paginado por paciente_id;
+        retorna (pacientes, tem_mais).
+        """
+        def filtros_condicao(tabela, codigo, qualificador_min, qualificador_max):
+            filtros = [tabela.codigo == codigo]
+            if qualificador_min is not None:
+                filtros.append(tabela.qualificador >= qualificador_min)
+            if qualificador_max is not None:
+                filtros.append(tabela.qualificador <= qualificador_max)
+            if inicio is not None:
+                filtros.append(tabela.data_avaliacao >= inicio)
+            if fim is not None:
+                filtros.append(tabela.data_avaliacao <= fim)
+            return filtros
+
+        # A primeira condição percorre o índice; as demais são EXISTS por paciente
+        filtros = [*filtros_condicao(IndiceCif, *condicoes[0]), Paciente.fisioterapeuta_id == fisioterapeuta_id]
+        for condicao in condicoes[1:]:
+            outra = aliased(IndiceCif)
+            filtros.append(exists().where(outra.paciente_id == IndiceCif.paciente_id,
+                                          *filtros_condicao(outra, *condicao)))
+        if apos is not None:
+            filtros.append(IndiceCif.paciente_id > apos)
+
+        ids = db.session.execute(
+            select(IndiceCif.paciente_id).join(Paciente, Paciente.id == IndiceCif.paciente_id)
+            .where(*filtros).distinct().order_by(IndiceCif.paciente_id).limit(limite + 1)
+        ).scalars().all()
+        tem_mais = len(ids) > limite
+        ids = ids[:limite]
+        if not ids:
+            return [], False
+
+        codigos = list(dict.fromkeys(codigo for codigo, _, _ in condicoes))
+        trajetoria = [IndiceCif.paciente_id.in_(ids), IndiceCif.codigo.in_(codigos)]
+        if inicio is not None:
+            trajetoria.append(IndiceCif.data_avaliacao >= inicio)
+        if fim is not None:
+            trajetoria.append(IndiceCif.data_avaliacao <= fim)
+        linhas = db.session.execute(
+            select(IndiceCif.paciente_id, Paciente.nome_completo, IndiceCif.codigo, IndiceCif.avaliacao_id,
+                   IndiceCif.qualificador, IndiceCif.data_avaliacao)
+            .join(Paciente, Paciente.id == IndiceCif.paciente_id)
+            .where(*trajetoria)
+            .order_by(IndiceCif.paciente_id, IndiceCif.data_avaliacao, IndiceCif.avaliacao_id)
+        ).all()
+
+        pacientes = {}
+        for linha in linhas:
+            paciente = pacientes.setdefault(linha.paciente_id, {
+                'paciente_id': linha.paciente_id,
+                'nome_paciente': linha.nome_completo,
+                'codigos': {codigo: {'avaliacoes': []} for codigo in codigos}
+            })
+            paciente['codigos'][linha.codigo]['avaliacoes'].append({
+                'avaliacao_id': linha.avaliacao_id,
+                'qualificador': linha.qualificador,
+                'data_avaliacao': linha.data_avaliacao.isoformat() if linha.data_avaliacao else None
+            })
+        for paciente in pacientes.values():
+            for codigo in paciente['codigos'].values():
+                # Avaliações sem grau (NULL) não entram na comparação
+                graus = [item['qualificador'] for item in codigo['avaliacoes'] if item['qualificador'] is not None]
+                codigo['primeiro_qualificador'] = graus[0] if graus else None
+                codigo['ultimo_qualificador'] = graus[-1] if graus else None
+        return list(pacientes.values()), tem_mais
+
+
+@event.listens_for(Avaliacao, 'after_insert')
+def _indexar_inserida(mapper, connection, avaliacao):
+    IndiceCifService.indexar(connection, avaliacao)
+
+
+@event.listens_for(Avaliacao, 'after_update')
+def _indexar_atualizada(mapper, connection, avaliacao):
+    estado = inspect(avaliacao)
+    if any(estado.attrs[campo].history.has_changes()
+           for campo in (*CAMPOS_CIF, 'paciente_id', 'data_avaliacao')):
+        IndiceCifService.indexar(connection, avaliacao)
+
+
+# Antes da exclusão, para não deixar linhas apontando para a avaliação removida
+@event.listens_for(Avaliacao, 'before_delete')
+def _remover_excluida(mapper, connection, avaliacao):
+    IndiceCifService.remover(connection, avaliacao.id)
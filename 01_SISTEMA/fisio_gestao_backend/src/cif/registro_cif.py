@@ -0,0 +1,126 @@
+import bisect
+import csv
+import os
+import re
+from src.cif.indice_cif_service import converter_qualificador, entradas_cif
+
+# Códigos e títulos da CIF (OMS, tradução brasileira), capítulos incluídos
+ARQUIVO_CODIGOS = os.path.join(os.path.dirname(__file__), 'codigos_cif.tsv')
+
+# Componente da CIF registrado em cada campo da avaliação
+COMPONENTE_CAMPO = {
+    'funcoes_corpo': 'b',
+    'estruturas_corpo': 's',
+    'atividades_participacao': 'd',
+    'fatores_ambientais': 'e',
+}
+
+# Primeiro qualificador aceito por componente: 0 a 4, 8 (não especificado) e
+# 9 (não aplicável); nos fatores ambientais, facilitadores +0 a +4 e +8, que
+# chegam aqui negativos (ver converter_qualificador)
+_ESCALA = frozenset({0, 1, 2, 3, 4, 8, 9})
+QUALIFICADORES = {
+    'b': _ESCALA,
+    's': _ESCALA,
+    'd': _ESCALA,
+    'e': _ESCALA | {-1, -2, -3, -4, -8},
+}
+
+# Chaves com forma de código (letra e dígitos) são validadas; as demais, como
+# anotações livres junto aos códigos, são mantidas sem validação
+_FORMA_CODIGO = re.compile(r'^[a-z]\d+$')
+
+
+def nivel(codigo):
+    """Nível na hierarquia: 1 capítulo (b2), 2 (b280), 3 (b2801), 4 (b28010)"""
+    return 1 if len(codigo) == 2 else len(codigo) - 2
+
+
+def codigo_pai(codigo):
+    if len(codigo) <= 2:
+        return None
+    return codigo[:2] if len(codigo) == 4 else codigo[:-1]
+
+
+class RegistroCif:
+    """Classificação em memória: códigos ordenados, com os descendentes de cada código contíguos"""
+
+    def __init__(self, titulos):
+        self.codigos = sorted(titulos)
+        self.titulos = [titulos[codigo] for codigo in self.codigos]
+        self._posicoes = {codigo: posicao for posicao, codigo in enumerate(self.codigos)}
+
+    @classmethod
+    def carregar(cls, caminho=ARQUIVO_CODIGOS):
+        with open(caminho, encoding='utf-8', newline='') as arquivo:
+            return cls({linha['codigo']: linha['titulo'] for linha in csv.DictReader(arquivo, delimiter='\t')})
+
+    def __contains__(self, codigo):
+        return codigo in self._posicoes
+
+    def __len__(self):
+        return len(self.codigos)
+
+    def _intervalo(self, prefixo):
+        """Posições [inicio, fim) dos códigos que começam com o prefixo"""
+        inicio = bisect.bisect_left(self.codigos, prefixo)
+        return inicio, bisect.bisect_left(self.codigos, prefixo + '\x7f', lo=inicio)
+
+    def item(self, codigo):
+        posicao = self._posicoes[codigo]
+        inicio, fim = self._intervalo(codigo)
+        return {
+            'codigo': codigo,
+            'titulo': self.titulos[posicao],
+            'nivel': nivel(codigo),
+            'pai': codigo_pai(codigo),
+            'possui_filhos': fim - inicio > 1
+        }
+
+    def filhos(self, codigo):
+        inicio, fim = self._intervalo(codigo)
+        return [item for item in self.codigos[inicio + 1:fim] if codigo_pai(item) == codigo]
+
+    def ancestrais(self, codigo):
+        """Do capítulo ao pai imediato"""
+        caminho = []
+        pai = codigo_pai(codigo)
+        while pai is not None:
+            caminho.append(pai)
+            pai = codigo_pai(pai)
+        return caminho[::-1]
+
+    def buscar_prefixo(self, prefixo, limite=20):
+        """Códigos que começam com o prefixo, em ordem; retorna (itens, total)"""
+        inicio, fim = self._intervalo(prefixo.strip().lower())
+        return [self.item(codigo) for codigo in self.codigos[inicio:min(fim, inicio + limite)]], fim - inicio
+
+    def validar(self, campo, documento):
+        """Erros de códigos e qualificadores de um campo da CIF da avaliação"""
+        componente = COMPONENTE_CAMPO[campo]
+        erros = []
+        for codigo, bruto in entradas_cif(documento):
+            if not _FORMA_CODIGO.match(codigo):
+                continue
+            if codigo[0] != componente or codigo not in self or len(codigo) == 2:
+                erros.append({'campo': campo, 'codigo': codigo, 'erro': 'Código inexistente neste componente da CIF'})
+                continue
+            if bruto is None:
+                continue
+            qualificador = converter_qualificador(bruto)
+            if qualificador not in QUALIFICADORES[componente]:
+                erros.append({'campo': campo, 'codigo': codigo, 'erro': f'Qualificador inválido: {bruto}'})
+        return erros
+
+
+# Carregado uma vez, na importação (início da aplicação)
+REGISTRO_CIF = RegistroCif.carregar()
+
+
+def validar_campos_cif(dados):
+    """Erros dos campos da CIF presentes nos dados da requisição"""
+    erros = []
+    for campo in COMPONENTE_CAMPO:
+        if dados.get(campo) is not None:
+            erros.extend(REGISTRO_CIF.validar(campo, dados[campo]))
+    return erros
@@ -0,0 +1,152 @@
+from datetime import datetime
+from sqlalchemy import text
+from src.models.fisio_models import CAMPOS_CIF, GATILHOS_AGENDAMENTO
+from src.agenda.indicadores_service import GATILHOS_RESUMO_AGENDA, IndicadoresAgendaService
+from src.sincronizacao.sincronizacao_service import GATILHOS_LOG_ALTERACOES, registrar_existentes
+from src.cif.indice_cif_service import IndiceCifService
+
+def _adicionar_coluna(tabela, coluna, tipo):
+    """Passo que adiciona coluna apenas se ela ainda não existir"""
+    def passo(connection):
+        colunas = {linha[1] for linha in connection.execute(text(f"PRAGMA table_info({tabela})"))}
+        if coluna not in colunas:
+            connection.execute(text(f"ALTER TABLE {tabela} ADD COLUMN {coluna} {tipo}"))
+    return passo
+
+
+def _cif_para_json(connection):
+    """Converter campos da CIF gravados como texto em JSON nativo"""
+    for campo in CAMPOS_CIF:
+        if connection.dialect.name == 'postgresql':
+            connection.execute(text(
+                f"ALTER TABLE avaliacoes ALTER COLUMN {campo} TYPE JSONB USING {campo}::jsonb"
+            ))
+        else:
+            # O SQLite guarda JSON como texto; valores que não eram JSON (texto
+            # livre gravado sem json.dumps) passam a ser strings JSON
+            connection.execute(text(
+                f"UPDATE avaliacoes SET {campo} = json_quote({campo}) "
+                f"WHERE {campo} IS NOT NULL AND json_valid({campo}) = 0"
+            ))
+
+
+# db.create_all() cria apenas tabelas (e seus índices) que ainda não existem;
+# alterações em bancos já existentes (como src/database/app.db) entram aqui,
+# em ordem de versão. Cada passo é um comando SQL ou uma função que recebe a
+# conexão, e deve ser idempotente para bancos criados já na versão atual.
+MIGRACOES = [
+    (1, 'Índices das colunas de filtro mais usadas', [
+        "CREATE INDEX IF NOT EXISTS ix_pacientes_nome_id ON pacientes (nome_completo, id)",
+        "CREATE INDEX IF NOT EXISTS ix_pacientes_fisioterapeuta_nome "
+        "ON pacientes (fisioterapeuta_id, nome_completo, id)",
+        "CREATE INDEX IF NOT EXISTS ix_pacientes_ativos_nome "
+        "ON pacientes (nome_completo, id) WHERE ativo = 1",
+        "CREATE INDEX IF NOT EXISTS ix_avaliacoes_paciente_data ON avaliacoes (paciente_id, data_avaliacao)",
+        "CREATE INDEX IF NOT EXISTS ix_evolucoes_paciente_data ON evolucoes (paciente_id, data_sessao)",
+        "CREATE INDEX IF NOT EXISTS ix_evolucoes_avaliacao ON evolucoes (avaliacao_id)",
+        "CREATE INDEX IF NOT EXISTS ix_procedimentos_evolucoes_evolucao ON procedimentos_evolucoes (evolucao_id)",
+        "CREATE INDEX IF NOT EXISTS ix_anexos_avaliacoes_avaliacao ON anexos_avaliacoes (avaliacao_id)",
+        "CREATE INDEX IF NOT EXISTS ix_agendamentos_data_hora ON agendamentos (data_hora)",
+        "CREATE INDEX IF NOT EXISTS ix_agendamentos_paciente_data ON agendamentos (paciente_id, data_hora)",
+        "CREATE INDEX IF NOT EXISTS ix_agendamentos_status_data ON agendamentos (status, data_hora)",
+        "CREATE INDEX IF NOT EXISTS ix_agendamentos_nao_cancelados_data "
+        "ON agendamentos (data_hora) WHERE status != 'cancelado'",
+        "CREATE INDEX IF NOT EXISTS ix_logs_auditoria_registro ON logs_auditoria (tabela, registro_id, data_hora)",
+    ]),
+    (2, 'Fim do agendamento e fisioterapeuta para detecção de sobreposição', [
+        _adicionar_coluna('agendamentos', 'data_hora_fim', 'DATETIME'),
+        _adicionar_coluna('agendamentos', 'fisioterapeuta_id', 'INTEGER REFERENCES fisioterapeutas (id)'),
+        "UPDATE agendamentos SET fisioterapeuta_id = "
+        "(SELECT fisioterapeuta_id FROM pacientes WHERE pacientes.id = agendamentos.paciente_id) "
+        "WHERE fisioterapeuta_id IS NULL",
+        # Mantém o formato gravado pelo SQLAlchemy (frações de segundo de data_hora)
+        "UPDATE agendamentos SET data_hora_fim = "
+        "strftime('%Y-%m-%d %H:%M:%S', data_hora, '+' || COALESCE(duracao_minutos, 60) || ' minutes') "
+        "|| substr(data_hora, 20) "
+        "WHERE data_hora_fim IS NULL",
+        "CREATE INDEX IF NOT EXISTS ix_agendamentos_ocupacao "
+        "ON agendamentos (fisioterapeuta_id, data_hora, data_hora_fim) "
+        "WHERE status IN ('agendado', 'confirmado')",
+        *GATILHOS_AGENDAMENTO,
+    ]),
+    (3, 'Séries de agendamentos recorrentes', [
+        _adicionar_coluna('agendamentos', 'serie_id', 'INTEGER REFERENCES series_agendamentos (id)'),
+        "CREATE INDEX IF NOT EXISTS ix_agendamentos_serie_data ON agendamentos (serie_id, data_hora)",
+    ]),
+    (4, 'Fila de envio de lembretes', [
+        "CREATE INDEX IF NOT EXISTS ix_lembretes_outbox_fila "
+        "ON lembretes_outbox (canal, status, proxima_tentativa)",
+    ]),
+    (5, 'Índices do feed iCalendar por fisioterapeuta', [
+        "CREATE INDEX IF NOT EXISTS ix_agendamentos_fisioterapeuta_atualizacao "
+        "ON agendamentos (fisioterapeuta_id, data_atualizacao)",
+        # O índice de ocupação deixa de ser parcial para servir também ao
+        # feed, que inclui sessões realizadas e canceladas
+        "DROP INDEX IF EXISTS ix_agendamentos_ocupacao",
+        "CREATE INDEX ix_agendamentos_ocupacao ON agendamentos (fisioterapeuta_id, data_hora, data_hora_fim)",
+    ]),
+    (6, 'Resumo diário da agenda para indicadores', [
+        "CREATE INDEX IF NOT EXISTS ix_agenda_resumo_dia ON agenda_resumo_diario (dia)",
+        *GATILHOS_RESUMO_AGENDA,
+        # Carga inicial a partir do histórico; daqui em diante os gatilhos mantêm o resumo
+        IndicadoresAgendaService.recalcular,
+    ]),
+    (7, 'Log de alterações para sincronização incremental', [
+        "CREATE INDEX IF NOT EXISTS ix_log_alteracoes_fisioterapeuta ON log_alteracoes (fisioterapeuta_id, id)",
+        *[gatilho for gatilhos in GATILHOS_LOG_ALTERACOES.values() for gatilho in gatilhos],
+        # Registros anteriores ao log entram como inclusões na primeira sincronização
+        registrar_existentes,
+    ]),
+    (8, 'Campos da CIF como JSON nativo', [
+        _cif_para_json,
+    ]),
+    (9, 'Índice invertido dos códigos da CIF', [
+        "CREATE INDEX IF NOT EXISTS ix_avaliacoes_cif_codigo ON avaliacoes_cif (codigo, qualificador, data_avaliacao)",
+        IndiceCifService.reindexar,
+    ]),
+    (10, 'Armazenamento de anexos por hash', [
+        _adicionar_coluna('anexos_avaliacoes', 'sha256', 'VARCHAR(64) REFERENCES anexos_objetos (sha256)'),
+    ]),
+    # Objetos existentes ficam pendentes (NULL) e são processados pelo gerador
+    (11, 'Miniaturas e prévias de anexos', [
+        _adicionar_coluna('anexos_objetos', 'derivados', 'JSON'),
+    ]),
+    (12, 'Qualificadores 8 e 9 da CIF fora das faixas da coorte', [
+        "UPDATE avaliacoes_cif SET qualificador = NULL WHERE qualificador IN (8, 9, -8)",
+    ]),
+]
+
+
+def versao_atual(connection):
+    """Maior versão de migração aplicada (0 se nenhuma)"""
+    return connection.execute(text("SELECT COALESCE(MAX(versao), 0) FROM versoes_schema")).scalar()
+
+
+def aplicar_migracoes(engine):
+    """Aplicar migrações pendentes, cada uma em sua própria transação"""
+    with engine.begin() as connection:
+        connection.execute(text(
+            "CREATE TABLE IF NOT EXISTS versoes_schema ("
+            "versao INTEGER PRIMARY KEY, "
+            "descricao VARCHAR(200) NOT NULL, "
+            "data_aplicacao DATETIME NOT NULL)"
+        ))
+        aplicadas = set(connection.execute(text("SELECT versao FROM versoes_schema")).scalars())
+
+    novas = []
+    for versao, descricao, passos in MIGRACOES:
+        if versao in aplicadas:
+            continue
+        with engine.begin() as connection:
+            for passo in passos:
+                if callable(passo):
+                    passo(connection)
+                else:
+                    connection.execute(text(passo))
+            connection.execute(
+                text("INSERT INTO versoes_schema (versao, descricao, data_aplicacao) "
+                     "VALUES (:versao, :descricao, :data)"),
+                {'versao': versao, 'descricao': descricao, 'data': datetime.utcnow()}
+            )
+        novas.append(versao)
+    return novas
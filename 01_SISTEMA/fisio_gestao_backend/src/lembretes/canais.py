@@ -0,0 +1,166 @@
+import json
+import smtplib
+import threading
+import time
+import urllib.error
+import urllib.request
+from email.message import EmailMessage
+
+
+class ErroPermanente(Exception):
+    """Falha de envio que não deve ser repetida (ex.: destinatário recusado)"""
+
+
+class LimiteTaxa:
+    """Balde de fichas compartilhado pelos workers de um canal"""
+
+    def __init__(self, por_segundo, rajada=None):
+        self.por_segundo = float(por_segundo)
+        self.capacidade = float(rajada or max(1, por_segundo))
+        self._fichas = self.capacidade
+        self._ultimo = time.monotonic()
+        self._lock = threading.Lock()
+
+    def aguardar(self):
+        """Bloquear até haver uma ficha disponível e consumi-la"""
+        while True:
+            with self._lock:
+                agora = time.monotonic()
+                self._fichas = min(self.capacidade, self._fichas + (agora - self._ultimo) * self.por_segundo)
+                self._ultimo = agora
+                if self._fichas >= 1:
+                    self._fichas -= 1
+                    return
+                espera = (1 - self._fichas) / self.por_segundo
+            time.sleep(espera)
+
+
+class Canal:
+    """Canal de envio; subclasses implementam enviar_lote"""
+
+    # Coluna do paciente usada como destino ('email' ou 'telefone')
+    campo_destino = None
+
+    def __init__(self, por_segundo=10, rajada=None, **configuracao):
+        self.limite = LimiteTaxa(por_segundo, rajada)
+        self.configuracao = configuracao
+
+    def enviar_lote(self, mensagens):
+        """Enviar mensagens (dicts com destino, assunto e texto); retorna um erro ou None por mensagem"""
+        raise NotImplementedError
+
+
+class CanalSMTP(Canal):
+    """E-mail via SMTP, reaproveitando uma conexão por lote"""
+
+    campo_destino = 'email'
+
+    def __init__(self, host='localhost', porta=25, remetente='nao-responda@fisiogestao.local',
+                 usuario=None, senha=None, starttls=False, timeout=30, **opcoes):
+        super().__init__(**opcoes)
+        self.host = host
+        self.porta = porta
+        self.remetente = remetente
+        self.usuario = usuario
+        self.senha = senha
+        self.starttls = starttls
+        self.timeout = timeout
+
+    def enviar_lote(self, mensagens):
+        # Falha ao conectar vale para todo o lote (temporária)
+        try:
+            conexao = smtplib.SMTP(self.host, self.porta, timeout=self.timeout)
+        except (OSError, smtplib.SMTPException) as e:
+            return [e] * len(mensagens)
+
+        resultados = []
+        try:
+            if self.starttls:
+                conexao.starttls()
+            if self.usuario:
+                conexao.login(self.usuario, self.senha)
+            for mensagem in mensagens:
+                self.limite.aguardar()
+                email = EmailMessage()
+                email['From'] = self.remetente
+                email['To'] = mensagem['destino']
+                email['Subject'] = mensagem['assunto']
+                email.set_content(mensagem['texto'])
+                try:
+                    conexao.send_message(email)
+                    resultados.append(None)
+                except smtplib.SMTPRecipientsRefused as e:
+                    # 5xx recusa definitiva; 4xx (ex.: caixa cheia) pode ser repetida
+                    if all(codigo >= 500 for codigo, _ in e.recipients.values()):
+                        resultados.append(ErroPermanente(str(e)))
+                    else:
+                        resultados.append(e)
+                except (OSError, smtplib.SMTPException) as e:
+                    resultados.append(e)
+        except (OSError, smtplib.SMTPException) as e:
+            resultados.extend([e] * (len(mensagens) - len(resultados)))
+        finally:
+            try:
+                conexao.quit()
+            except (OSError, smtplib.SMTPException):
+                conexao.close()
+        return resultados
+
+
+class CanalSMSHttp(Canal):
+    """SMS por gateway HTTP genérico (POST JSON com destino e texto)"""
+
+    campo_destino = 'telefone'
+
+    def __init__(self, url, token=None, timeout=10, **opcoes):
+        super().__init__(**opcoes)
+        self.url = url
+        self.token = token
+        self.timeout = timeout
+
+    def enviar_lote(self, mensagens):
+        resultados = []
+        for mensagem in mensagens:
+            self.limite.aguardar()
+            corpo = json.dumps({'to': mensagem['destino'], 'message': mensagem['texto']}).encode('utf-8')
+            requisicao = urllib.request.Request(self.url, data=corpo, method='POST',
+                                                headers={'Content-Type': 'application/json'})
+            if self.token:
+                requisicao.add_header('Authorization', f'Bearer {self.token}')
+            try:
+                with urllib.request.urlopen(requisicao, timeout=self.timeout):
+                    resultados.append(None)
+            except urllib.error.HTTPError as e:
+                # 4xx (exceto 429) indica destino ou requisição inválidos
+                if 400 <= e.code < 500 and e.code != 429:
+                    resultados.append(ErroPermanente(f'HTTP {e.code}'))
+                else:
+                    resultados.append(e)
+            except OSError as e:
+                resultados.append(e)
+        return resultados
+
+
+TIPOS_CANAL = {
+    'smtp': CanalSMTP,
+    'sms_http': CanalSMSHttp,
+}
+
+
+def criar_canais(configuracao):
+    """Instanciar canais a partir de {'nome': {'tipo': ..., opções...}}
+
+    `tipo` é uma chave de TIPOS_CANAL ou uma subclasse de Canal.
+    """
+    canais = {}
+    for nome, opcoes in configuracao.items():
+        opcoes = dict(opcoes)
+        tipo = opcoes.pop('tipo')
+        if isinstance(tipo, type) and issubclass(tipo, Canal):
+            classe = tipo
+        elif tipo in TIPOS_CANAL:
+            classe = TIPOS_CANAL[tipo]
+        else:
+            raise ValueError(f'Tipo de canal desconhecido: {tipo}')
+        canais[nome] = classe(**opcoes)
+    return canais
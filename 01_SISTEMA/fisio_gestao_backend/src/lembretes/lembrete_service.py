@@ -0,0 +1,365 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import exists, literal, select, update
+from src.models.fisio_models import Agendamento, Paciente, STATUS_ATIVOS, db
+from src.lembretes.canais import ErroPermanente, criar_canais
+
+logger = logging.getLogger(__name__)
+
+# Canais usados quando app.config['LEMBRETES_CANAIS'] não é definido
+CANAIS_PADRAO = {
+    'email': {'tipo': 'smtp', 'host': 'localhost', 'porta': 25, 'por_segundo': 10},
+}
+
+TAMANHO_LOTE = 100
+WORKERS_POR_CANAL = 2
+MAX_TENTATIVAS = 5
+BACKOFF_BASE_SEGUNDOS = 60
+BACKOFF_MAXIMO_SEGUNDOS = 3600
+# Tempo de reserva de um item em envio; vencido, o item volta para a fila
+# (worker interrompido no meio do lote)
+RESERVA_SEGUNDOS = 300
+
+ASSUNTO = 'Lembrete de sessão de fisioterapia'
+TEXTO = 'Olá, {nome}! Lembramos que sua sessão de fisioterapia está marcada para {data} às {hora}.'
+
+
+class LembreteOutbox(db.Model):
+    """Fila (outbox) de lembretes a enviar, um por agendamento e canal"""
+    __tablename__ = 'lembretes_outbox'
+    __table_args__ = (
+        db.UniqueConstraint('agendamento_id', 'canal', name='uq_lembretes_outbox_agendamento_canal'),
+        db.Index('ix_lembretes_outbox_fila', 'canal', 'status', 'proxima_tentativa'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    agendamento_id = db.Column(db.Integer, db.ForeignKey('agendamentos.id'), nullable=False)
+    canal = db.Column(db.String(20), nullable=False)
+    destino = db.Column(db.String(120), nullable=False)
+    nome_paciente = db.Column(db.String(200), nullable=False)
+    data_hora = db.Column(db.DateTime, nullable=False)  # da sessão
+    status = db.Column(db.String(20), nullable=False, default='pendente')  # pendente, enviando, enviado, falhou, cancelado
+    tentativas = db.Column(db.Integer, nullable=False, default=0)
+    proxima_tentativa = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    ultimo_erro = db.Column(db.Text)
+    data_criacao = db.Column(db.DateTime, default=datetime.utcnow)
+    data_envio = db.Column(db.DateTime)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'agendamento_id': self.agendamento_id,
+            'canal': self.canal,
+            'destino': self.destino,
+            'status': self.status,
+            'tentativas': self.tentativas,
+            'proxima_tentativa': self.proxima_tentativa.isoformat() if self.proxima_tentativa else None,
+            'ultimo_erro': self.ultimo_erro,
+            'data_criacao': self.data_criacao.isoformat() if self.data_criacao else None,
+            'data_envio': self.data_envio.isoformat() if self.data_envio else None
+        }
+
+
+class LembreteService:
+    @staticmethod
+    def canais():
+        """Instanciar canais configurados em app.config['LEMBRETES_CANAIS']"""
+        return criar_canais(current_app.config.get('LEMBRETES_CANAIS', CANAIS_PADRAO))
+
+    @staticmethod
+    def enfileirar(dia, canais):
+        """Enfileirar lembretes das sessões ativas do dia, com um INSERT ... SELECT por canal
+
+        Só entram pacientes com consentimento de comunicação e destino
+        preenchido; itens já enfileirados são ignorados, exceto os cancelados
+        por remarcação, que voltam à fila com o novo horário. Não faz commit.
+        """
+        inicio = datetime.combine(dia, datetime.min.time())
+        fim = inicio + timedelta(days=1)
+        agora = datetime.utcnow()
+        total = 0
+        for nome, canal in canais.items():
+            destino = getattr(Paciente, canal.campo_destino)
+            elegiveis = [
+                Agendamento.data_hora >= inicio,
+                Agendamento.data_hora < fim,
+                Agendamento.filtro_status_ativo(),
+                Agendamento.lembrete_enviado == False,
+                Paciente.consentimento_comunicacao == True,
+                destino.isnot(None),
+                destino != '',
+            ]
+            # Sessão remarcada para o dia: o item cancelado na reserva volta à fila
+            reagendados = db.session.execute(
+                update(LembreteOutbox)
+                .where(
+                    LembreteOutbox.canal == nome,
+                    LembreteOutbox.status == 'cancelado',
+                    LembreteOutbox.agendamento_id.in_(
+                        select(Agendamento.id)
+                        .join(Paciente, Paciente.id == Agendamento.paciente_id)
+                        .where(*elegiveis, Agendamento.data_hora != LembreteOutbox.data_hora)
+                    )
+                )
+                .values(
+                    status='pendente',
+                    data_hora=select(Agendamento.data_hora)
+                    .where(Agendamento.id == LembreteOutbox.agendamento_id).scalar_subquery(),
+                    tentativas=0,
+                    proxima_tentativa=agora,
+                    ultimo_erro=None
+                )
+                .execution_options(synchronize_session=False)
+            )
+            total += reagendados.rowcount
+            consulta = (
+                select(
+                    Agendamento.id, literal(nome), destino, Paciente.nome_completo, Agendamento.data_hora,
+                    literal('pendente'), literal(0), literal(agora), literal(agora)
+                )
+                .join(Paciente, Paciente.id == Agendamento.paciente_id)
+                .where(
+                    *elegiveis,
+                    ~exists().where(
+                        LembreteOutbox.agendamento_id == Agendamento.id,
+                        LembreteOutbox.canal == nome
+                    )
+                )
+            )
+            resultado = db.session.execute(
+                LembreteOutbox.__table__.insert().from_select(
+                    ['agendamento_id', 'canal', 'destino', 'nome_paciente', 'data_hora',
+                     'status', 'tentativas', 'proxima_tentativa', 'data_criacao'],
+                    consulta
+                )
+            )
+            total += resultado.rowcount
+        return total
+
+    @staticmethod
+    def reservar_lote(canal, tamanho=TAMANHO_LOTE, campo_destino='email'):
+        """Reservar atomicamente até `tamanho` itens vencidos do canal e fazer commit
+
+        Na reserva, cada item é conferido com o agendamento e o paciente atuais:
+        sessão que deixou de estar ativa ou mudou de horário, ou paciente que
+        retirou o consentimento, fica 'cancelado' em vez de ser enviada. Destino
+        e nome vêm do cadastro atual, não da cópia feita ao enfileirar.
+        """
+        destino = getattr(Paciente, campo_destino)
+        while True:
+            agora = datetime.utcnow()
+            ids = (
+                select(LembreteOutbox.id)
+                .where(
+                    LembreteOutbox.canal == canal,
+                    LembreteOutbox.status.in_(('pendente', 'enviando')),
+                    LembreteOutbox.proxima_tentativa <= agora
+                )
+                .order_by(LembreteOutbox.proxima_tentativa)
+                .limit(tamanho)
+            )
+            reservados = db.session.execute(
+                update(LembreteOutbox)
+                .where(LembreteOutbox.id.in_(ids.scalar_subquery()))
+                .values(
+                    status='enviando',
+                    tentativas=LembreteOutbox.tentativas + 1,
+                    proxima_tentativa=agora + timedelta(seconds=RESERVA_SEGUNDOS)
+                )
+                .returning(LembreteOutbox.id)
+                .execution_options(synchronize_session=False)
+            ).scalars().all()
+            if not reservados:
+                db.session.commit()
+                return []
+
+            itens = db.session.execute(
+                select(
+                    LembreteOutbox.id, LembreteOutbox.agendamento_id, destino.label('destino'),
+                    Paciente.nome_completo.label('nome_paciente'), LembreteOutbox.data_hora,
+                    LembreteOutbox.tentativas, Agendamento.status.label('status_agendamento'),
+                    Agendamento.data_hora.label('data_hora_atual'), Paciente.consentimento_comunicacao
+                )
+                .join(Agendamento, Agendamento.id == LembreteOutbox.agendamento_id)
+                .join(Paciente, Paciente.id == Agendamento.paciente_id)
+                .where(LembreteOutbox.id.in_(reservados))
+            ).all()
+
+            lote = []
+            cancelados = []
+            for item in itens:
+                if item.status_agendamento not in STATUS_ATIVOS:
+                    motivo = f'Agendamento {item.status_agendamento}'
+                elif item.data_hora_atual != item.data_hora:
+                    motivo = 'Agendamento remarcado'
+                elif not item.consentimento_comunicacao:
+                    motivo = 'Consentimento de comunicação retirado'
+                elif not item.destino:
+                    motivo = 'Paciente sem destino para o canal'
+                else:
+                    lote.append(item)
+                    continue
+                cancelados.append({'id': item.id, 'status': 'cancelado', 'ultimo_erro': motivo})
+            if cancelados:
+                db.session.execute(update(LembreteOutbox), cancelados)
+            db.session.commit()
+            # Lote inteiro cancelado: segue para os próximos itens vencidos
+            if lote:
+                return lote
+
+    @staticmethod
+    def montar_mensagem(item):
+        return {
+            'destino': item.destino,
+            'assunto': ASSUNTO,
+            'texto': TEXTO.format(
+                nome=item.nome_paciente,
+                data=item.data_hora.strftime('%d/%m/%Y'),
+                hora=item.data_hora.strftime('%H:%M')
+            )
+        }
+
+    @staticmethod
+    def backoff(tentativas):
+        """Espera antes da próxima tentativa (exponencial, com teto)"""
+        return timedelta(seconds=min(BACKOFF_MAXIMO_SEGUNDOS, BACKOFF_BASE_SEGUNDOS * 2 ** (tentativas - 1)))
+
+    @staticmethod
+    def registrar_resultados(lote, resultados):
+        """Gravar o resultado de cada item do lote e marcar os agendamentos avisados"""
+        agora = datetime.utcnow()
+        atualizacoes = []
+        avisados = []
+        for item, erro in zip(lote, resultados):
+            if erro is None:
+                atualizacoes.append({'id': item.id, 'status': 'enviado', 'data_envio': agora, 'ultimo_erro': None})
+                avisados.append(item.agendamento_id)
+            elif isinstance(erro, ErroPermanente) or item.tentativas >= MAX_TENTATIVAS:
+                atualizacoes.append({'id': item.id, 'status': 'falhou', 'ultimo_erro': str(erro)[:500]})
+            else:
+                atualizacoes.append({
+                    'id': item.id,
+                    'status': 'pendente',
+                    'proxima_tentativa': agora + LembreteService.backoff(item.tentativas),
+                    'ultimo_erro': str(erro)[:500]
+                })
+
+        # Agrupar por conjunto de colunas para um executemany por formato
+        por_formato = {}
+        for atualizacao in atualizacoes:
+            por_formato.setdefault(tuple(sorted(atualizacao)), []).append(atualizacao)
+        for parametros in por_formato.values():
+            db.session.execute(update(LembreteOutbox), parametros)
+
+        if avisados:
+            db.session.execute(
+                update(Agendamento)
+                .where(Agendamento.id.in_(avisados))
+                # data_atualizacao compõe a versão (ETag) do prontuário em cache
+                .values(lembrete_enviado=True, data_atualizacao=agora)
+                .execution_options(synchronize_session=False)
+            )
+        db.session.commit()
+
+
+class DespachanteLembretes:
+    """Pool de workers que esvazia a outbox em lotes, por canal"""
+
+    def __init__(self, app, canais, workers_por_canal=WORKERS_POR_CANAL, tamanho_lote=TAMANHO_LOTE):
+        self.app = app
+        self.canais = canais
+        self.workers_por_canal = workers_por_canal
+        self.tamanho_lote = tamanho_lote
+
+    def _processar_lote(self, nome):
+        with self.app.app_context():
+            lote = LembreteService.reservar_lote(nome, self.tamanho_lote, self.canais[nome].campo_destino)
+            if not lote:
+                return 0
+            mensagens = [LembreteService.montar_mensagem(item) for item in lote]
+            try:
+                resultados = self.canais[nome].enviar_lote(mensagens)
+            except Exception as e:
+                logger.exception('Falha no canal %s', nome)
+                resultados = [e] * len(lote)
+            LembreteService.registrar_resultados(lote, resultados)
+            return len(lote)
+
+    def _drenar(self, nome):
+        total = 0
+        while True:
+            processados = self._processar_lote(nome)
+            if not processados:
+                return total
+            total += processados
+
+    def processar_pendentes(self):
+        """Enviar todos os itens vencidos; retorna quantos foram processados"""
+        workers = self.workers_por_canal * len(self.canais)
+        if not workers:
+            return 0
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='lembretes') as pool:
+            futuros = [
+                pool.submit(self._drenar, nome)
+                for nome in self.canais
+                for _ in range(self.workers_por_canal)
+            ]
+            return sum(futuro.result() for futuro in futuros)
+
+
+class AgendadorLembretes(threading.Thread):
+    """Thread que periodicamente enfileira os lembretes de amanhã e despacha a outbox"""
+
+    def __init__(self, app, intervalo_segundos=60):
+        super().__init__(name='agendador-lembretes', daemon=True)
+        self.app = app
+        self.intervalo_segundos = intervalo_segundos
+        self.parar = threading.Event()
+        with app.app_context():
+            self.despachante = DespachanteLembretes(
+                app, LembreteService.canais(),
+                workers_por_canal=app.config.get('LEMBRETES_WORKERS', WORKERS_POR_CANAL)
+            )
+
+    def executar_ciclo(self):
+        with self.app.app_context():
+            amanha = datetime.now().date() + timedelta(days=1)
+            LembreteService.enfileirar(amanha, self.despachante.canais)
+            db.session.commit()
+        return self.despachante.processar_pendentes()
+
+    def run(self):
+        while not self.parar.is_set():
+            try:
+                self.executar_ciclo()
+            except Exception:
+                logger.exception('Falha no ciclo de lembretes')
+            self.parar.wait(self.intervalo_segundos)
+
+
+def iniciar_lembretes(app):
+    """Iniciar o agendador em segundo plano se app.config['LEMBRETES_ATIVOS']"""
+    if not app.config.get('LEMBRETES_ATIVOS'):
+        return None
+    agendador = AgendadorLembretes(app, app.config.get('LEMBRETES_INTERVALO_SEGUNDOS', 60))
+    agendador.start()
+    return agendador
+
+
+@click.command('lembretes')
+@click.option('--dia', type=click.DateTime(formats=['%Y-%m-%d']), default=None,
+              help='Dia das sessões (padrão: amanhã)')
+@with_appcontext
+def comando_lembretes(dia):
+    """Enfileirar e enviar lembretes (para uso em cron)"""
+    dia = dia.date() if dia else datetime.now().date() + timedelta(days=1)
+    canais = LembreteService.canais()
+    enfileirados = LembreteService.enfileirar(dia, canais)
+    db.session.commit()
+    processados = DespachanteLembretes(current_app._get_current_object(), canais).processar_pendentes()
+    click.echo(f'{enfileirados} lembretes enfileirados, {processados} processados')
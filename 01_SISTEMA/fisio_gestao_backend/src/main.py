@@ -7,6 +7,11 @@ from flask import Flask, send_from_directory
 from flask_cors import CORS
 from src.models.fisio_models import db
 from src.audit.audit_service import LogAuditoria
+from src.database.migrations import aplicar_migracoes
+from src.agenda.indicadores_service import comando_resumo_agenda
+from src.lembretes.lembrete_service import comando_lembretes, iniciar_lembretes
+from src.anexos.armazenamento_service import comando_limpar_uploads
+from src.anexos.derivados_service import comando_derivados, iniciar_derivados
 from src.routes.pacientes import paciente_bp
 from src.routes.avaliacoes import avaliacao_bp
 from src.routes.evolucoes import evolucao_bp
@@ -14,6 +19,9 @@ from src.routes.procedimentos import procedimento_bp
 from src.routes.agendamentos import agendamento_bp
 from src.routes.auth import auth_bp
 from src.routes.lgpd import lgpd_bp
+from src.routes.busca import busca_bp
+from src.routes.sincronizacao import sincronizacao_bp
+from src.routes.cif import cif_bp
 
 app = Flask(__name__, static_folder=os.path.join(os.path.dirname(__file__), 'static'))
 app.config['SECRET_KEY'] = 'fisio-gestao-secret-key-2025-lgpd-compliant'
@@ -29,13 +37,43 @@ app.register_blueprint(avaliacao_bp, url_prefix='/api')
 app.register_blueprint(evolucao_bp, url_prefix='/api')
 app.register_blueprint(procedimento_bp, url_prefix='/api')
 app.register_blueprint(agendamento_bp, url_prefix='/api')
+app.register_blueprint(busca_bp, url_prefix='/api')
+app.register_blueprint(sincronizacao_bp, url_prefix='/api')
+app.register_blueprint(cif_bp, url_prefix='/api')
 
 # Configuração do banco de dados
 app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{os.path.join(os.path.dirname(__file__), 'database', 'app.db')}"
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Arquivos de anexos, armazenados por hash SHA-256 (uploads parciais em uploads/)
+app.config['ANEXOS_DIRETORIO'] = os.environ.get(
+    'ANEXOS_DIRETORIO', os.path.join(os.path.dirname(__file__), 'database', 'anexos')
+)
+# Com nginx, prefixo de uma location `internal` apontando para ANEXOS_DIRETORIO
+# (ex.: /_anexos/): downloads de anexos saem por X-Accel-Redirect
+app.config['ANEXOS_X_ACCEL_REDIRECT'] = os.environ.get('ANEXOS_X_ACCEL_REDIRECT')
 db.init_app(app)
 with app.app_context():
     db.create_all()
+    aplicar_migracoes(db.engine)
+
+# Lembretes: envio em segundo plano (LEMBRETES_ATIVOS=1) ou via `flask lembretes` no cron
+app.config['LEMBRETES_ATIVOS'] = os.environ.get('LEMBRETES_ATIVOS') == '1'
+app.cli.add_command(comando_lembretes)
+iniciar_lembretes(app)
+
+# Miniaturas e prévias de anexos: pool de processos em segundo plano
+# (ANEXOS_DERIVADOS_ATIVOS=1) ou via `flask anexos-derivados` no cron
+app.config['ANEXOS_DERIVADOS_ATIVOS'] = os.environ.get('ANEXOS_DERIVADOS_ATIVOS') == '1'
+app.config['ANEXOS_DERIVADOS_WORKERS'] = int(os.environ.get('ANEXOS_DERIVADOS_WORKERS', 2))
+app.cli.add_command(comando_derivados)
+iniciar_derivados(app)
+
+# Uploads em partes abandonados: `flask anexos-limpar-uploads [--horas N]` no cron
+app.config['ANEXOS_UPLOADS_VALIDADE_HORAS'] = int(os.environ.get('ANEXOS_UPLOADS_VALIDADE_HORAS', 72))
+app.cli.add_command(comando_limpar_uploads)
+
+# Reconstrução do resumo diário da agenda: `flask agenda-resumo [--inicio ...] [--fim ...]`
+app.cli.add_command(comando_resumo_agenda)
 
 @app.route('/', defaults={'path': ''})
 @app.route('/<path:path>')
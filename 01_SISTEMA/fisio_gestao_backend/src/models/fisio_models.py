@@ -1,8 +1,34 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DDL, event, select
+from sqlalchemy.dialects.postgresql import JSONB
 
 db = SQLAlchemy()
 
+# Status de agendamento que ocupam horário na agenda
+STATUS_ATIVOS = ('agendado', 'confirmado')
+
+# Transições de status permitidas; realizado, faltou e cancelado são finais
+TRANSICOES_STATUS = {
+    'agendado': ('confirmado', 'realizado', 'faltou', 'cancelado'),
+    'confirmado': ('realizado', 'faltou', 'cancelado'),
+    'realizado': (),
+    'faltou': (),
+    'cancelado': (),
+}
+
+# Duração de sessão padrão e máxima; o limite máximo mantém a verificação de
+# sobreposição restrita a uma faixa do índice (início > novo início - máximo)
+DURACAO_PADRAO_MINUTOS = 60
+DURACAO_MAXIMA_MINUTOS = 480
+
+# Documentos JSON nativos: JSON1 (texto validado) no SQLite e JSONB no
+# PostgreSQL; None é gravado como NULL do SQL, não como 'null'
+TipoJSON = db.JSON(none_as_null=True).with_variant(JSONB(none_as_null=True), 'postgresql')
+
+# Colunas da CIF na avaliação
+CAMPOS_CIF = ('funcoes_corpo', 'estruturas_corpo', 'atividades_participacao', 'fatores_ambientais')
+
 class Fisioterapeuta(db.Model):
     """Modelo para fisioterapeutas do sistema"""
     __tablename__ = 'fisioterapeutas'
@@ -50,6 +76,15 @@ class Fisioterapeuta(db.Model):
 class Paciente(db.Model):
     """Modelo para pacientes"""
     __tablename__ = 'pacientes'
+    __table_args__ = (
+        # Chave da paginação por cursor (ordem alfabética estável)
+        db.Index('ix_pacientes_nome_id', 'nome_completo', 'id'),
+        # Carteira de pacientes de cada fisioterapeuta
+        db.Index('ix_pacientes_fisioterapeuta_nome', 'fisioterapeuta_id', 'nome_completo', 'id'),
+        # Listagem da recepção, que por padrão mostra apenas pacientes ativos
+        db.Index('ix_pacientes_ativos_nome', 'nome_completo', 'id',
+                 sqlite_where=db.text('ativo = 1')),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     fisioterapeuta_id = db.Column(db.Integer, db.ForeignKey('fisioterapeutas.id'), nullable=False)
@@ -91,6 +126,16 @@ class Paciente(db.Model):
     evolucoes = db.relationship('Evolucao', backref='paciente', lazy=True, cascade='all, delete-orphan')
     agendamentos = db.relationship('Agendamento', backref='paciente', lazy=True, cascade='all, delete-orphan')
     
+    # Campos expostos pela API (mesmas chaves de to_dict)
+    CAMPOS_PUBLICOS = (
+        'id', 'fisioterapeuta_id', 'nome_completo', 'data_nascimento', 'genero',
+        'estado_civil', 'profissao', 'naturalidade', 'local_nascimento',
+        'telefone', 'email', 'endereco_residencial', 'endereco_comercial',
+        'ativo', 'arquivado', 'consentimento_tratamento_dados',
+        'consentimento_comunicacao', 'consentimento_pesquisa',
+        'data_consentimento', 'versao_termos', 'data_criacao', 'data_atualizacao'
+    )
+    
     def to_dict(self):
         return {
             'id': self.id,
@@ -120,6 +165,9 @@ class Paciente(db.Model):
 class Avaliacao(db.Model):
     """Modelo para avaliações fisioterapêuticas baseadas na CIF"""
     __tablename__ = 'avaliacoes'
+    __table_args__ = (
+        db.Index('ix_avaliacoes_paciente_data', 'paciente_id', 'data_avaliacao'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     
@@ -146,10 +194,10 @@ class Avaliacao(db.Model):
     quantitativo_atendimentos = db.Column(db.Integer)
     
     # Campos baseados na CIF
-    funcoes_corpo = db.Column(db.Text)  # JSON com avaliação das funções do corpo
-    estruturas_corpo = db.Column(db.Text)  # JSON com avaliação das estruturas do corpo
-    atividades_participacao = db.Column(db.Text)  # JSON com avaliação de atividades e participação
-    fatores_ambientais = db.Column(db.Text)  # JSON com fatores ambientais
+    funcoes_corpo = db.Column(TipoJSON)  # avaliação das funções do corpo
+    estruturas_corpo = db.Column(TipoJSON)  # avaliação das estruturas do corpo
+    atividades_participacao = db.Column(TipoJSON)  # avaliação de atividades e participação
+    fatores_ambientais = db.Column(TipoJSON)  # fatores ambientais
     
     # Campos de controle
     data_avaliacao = db.Column(db.DateTime, default=datetime.utcnow)
@@ -194,6 +242,10 @@ class Avaliacao(db.Model):
 class Evolucao(db.Model):
     """Modelo para evoluções por sessão"""
     __tablename__ = 'evolucoes'
+    __table_args__ = (
+        db.Index('ix_evolucoes_paciente_data', 'paciente_id', 'data_sessao'),
+        db.Index('ix_evolucoes_avaliacao', 'avaliacao_id'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     data_sessao = db.Column(db.DateTime, nullable=False)
@@ -261,6 +313,9 @@ class Procedimento(db.Model):
 class ProcedimentoEvolucao(db.Model):
     """Relacionamento entre procedimentos e evoluções"""
     __tablename__ = 'procedimentos_evolucoes'
+    __table_args__ = (
+        db.Index('ix_procedimentos_evolucoes_evolucao', 'evolucao_id'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     evolucao_id = db.Column(db.Integer, db.ForeignKey('evolucoes.id'), nullable=False)
@@ -270,36 +325,87 @@ class ProcedimentoEvolucao(db.Model):
     # Relacionamentos
     procedimento = db.relationship('Procedimento', backref='evolucoes_procedimentos')
     
-    def to_dict(self):
-        return {
+    def to_dict(self, incluir_procedimento=True):
+        dados = {
             'id': self.id,
             'evolucao_id': self.evolucao_id,
             'procedimento_id': self.procedimento_id,
-            'observacoes': self.observacoes,
-            'procedimento': self.procedimento.to_dict() if self.procedimento else None
+            'observacoes': self.observacoes
+        }
+        # Listagens enviam o catálogo à parte, uma vez por procedimento
+        if incluir_procedimento:
+            dados['procedimento'] = self.procedimento.to_dict() if self.procedimento else None
+        return dados
+
+class ObjetoAnexo(db.Model):
+    """Conteúdo de anexo gravado uma única vez por hash SHA-256, com contagem de referências"""
+    __tablename__ = 'anexos_objetos'
+    
+    sha256 = db.Column(db.String(64), primary_key=True)
+    tamanho_bytes = db.Column(db.BigInteger, nullable=False)
+    referencias = db.Column(db.Integer, nullable=False, default=0)
+    # Miniaturas e prévias geradas em segundo plano ({tipo: {largura, altura,
+    # tamanho_bytes}}); None enquanto pendente, {} se o conteúdo não tem prévia
+    derivados = db.Column(TipoJSON)
+    data_criacao = db.Column(db.DateTime, default=datetime.utcnow)
+
+class UploadAnexo(db.Model):
+    """Upload em partes ainda não concluído; retomado a partir de `recebidos`"""
+    __tablename__ = 'anexos_uploads'
+    
+    id = db.Column(db.String(32), primary_key=True)
+    avaliacao_id = db.Column(db.Integer, db.ForeignKey('avaliacoes.id'), nullable=False)
+    nome_arquivo = db.Column(db.String(255), nullable=False)
+    tipo_arquivo = db.Column(db.String(50))
+    categoria = db.Column(db.String(100))
+    tamanho_bytes = db.Column(db.BigInteger, nullable=False)
+    recebidos = db.Column(db.BigInteger, nullable=False, default=0)
+    data_criacao = db.Column(db.DateTime, default=datetime.utcnow)
+    data_atualizacao = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    avaliacao = db.relationship('Avaliacao', backref=db.backref('uploads', cascade='all, delete-orphan'))
+    
+    def to_dict(self):
+        return {
+            'upload_id': self.id,
+            'avaliacao_id': self.avaliacao_id,
+            'nome_arquivo': self.nome_arquivo,
+            'tipo_arquivo': self.tipo_arquivo,
+            'categoria': self.categoria,
+            'tamanho_bytes': self.tamanho_bytes,
+            'recebidos': self.recebidos,
+            'data_criacao': self.data_criacao.isoformat() if self.data_criacao else None
         }
 
 class AnexoAvaliacao(db.Model):
     """Anexos de avaliações (exames, imagens, etc.)"""
     __tablename__ = 'anexos_avaliacoes'
+    __table_args__ = (
+        db.Index('ix_anexos_avaliacoes_avaliacao', 'avaliacao_id'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     nome_arquivo = db.Column(db.String(255), nullable=False)
     tipo_arquivo = db.Column(db.String(50))  # image, pdf, video, etc.
     tamanho_bytes = db.Column(db.Integer)
-    url_arquivo = db.Column(db.String(500))  # URL do arquivo no S3 ou caminho local
+    url_arquivo = db.Column(db.String(500))  # chave do objeto no armazenamento de anexos
     categoria = db.Column(db.String(100))  # Exames de Imagem, Fotos de Evolução, etc.
+    sha256 = db.Column(db.String(64), db.ForeignKey('anexos_objetos.sha256'))  # conteúdo armazenado
     
     # Campos de controle
     data_upload = db.Column(db.DateTime, default=datetime.utcnow)
     
     # Relacionamentos
     avaliacao_id = db.Column(db.Integer, db.ForeignKey('avaliacoes.id'), nullable=False)
+    objeto = db.relationship('ObjetoAnexo', lazy='joined', viewonly=True)
     
     def __repr__(self):
         return f'<AnexoAvaliacao {self.nome_arquivo}>'
     
     def to_dict(self):
+        url_download = f'/api/avaliacoes/{self.avaliacao_id}/anexos/{self.id}/arquivo' if self.sha256 else None
+        # Miniatura e prévia (imagens e PDFs): None enquanto não geradas
+        derivados = self.objeto.derivados if self.objeto else None
         return {
             'id': self.id,
             'nome_arquivo': self.nome_arquivo,
@@ -307,18 +413,73 @@ class AnexoAvaliacao(db.Model):
             'tamanho_bytes': self.tamanho_bytes,
             'url_arquivo': self.url_arquivo,
             'categoria': self.categoria,
+            'sha256': self.sha256,
+            'url_download': url_download,
+            'derivados': None if derivados is None else {
+                tipo: {**medidas, 'url': f'{url_download}/{tipo}'} for tipo, medidas in derivados.items()
+            },
             'data_upload': self.data_upload.isoformat() if self.data_upload else None,
             'avaliacao_id': self.avaliacao_id
         }
 
+class SerieAgendamento(db.Model):
+    """Séries de agendamentos recorrentes (regra RRULE expandida no servidor)"""
+    __tablename__ = 'series_agendamentos'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    regra = db.Column(db.String(255), nullable=False)
+    data_inicio = db.Column(db.DateTime, nullable=False)
+    duracao_minutos = db.Column(db.Integer, default=DURACAO_PADRAO_MINUTOS)
+    observacoes = db.Column(db.Text)
+    
+    # Campos de controle
+    data_criacao = db.Column(db.DateTime, default=datetime.utcnow)
+    data_atualizacao = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    # Relacionamentos
+    paciente_id = db.Column(db.Integer, db.ForeignKey('pacientes.id'), nullable=False)
+    fisioterapeuta_id = db.Column(db.Integer, db.ForeignKey('fisioterapeutas.id'))
+    
+    def __repr__(self):
+        return f'<SerieAgendamento {self.id} - {self.regra}>'
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'regra': self.regra,
+            'data_inicio': self.data_inicio.isoformat() if self.data_inicio else None,
+            'duracao_minutos': self.duracao_minutos,
+            'observacoes': self.observacoes,
+            'data_criacao': self.data_criacao.isoformat() if self.data_criacao else None,
+            'data_atualizacao': self.data_atualizacao.isoformat() if self.data_atualizacao else None,
+            'paciente_id': self.paciente_id,
+            'fisioterapeuta_id': self.fisioterapeuta_id
+        }
+
 class Agendamento(db.Model):
     """Agendamentos de sessões"""
     __tablename__ = 'agendamentos'
+    __table_args__ = (
+        db.Index('ix_agendamentos_data_hora', 'data_hora'),
+        db.Index('ix_agendamentos_paciente_data', 'paciente_id', 'data_hora'),
+        db.Index('ix_agendamentos_status_data', 'status', 'data_hora'),
+        # Índice parcial: o SQLite só o usa quando a consulta repete o
+        # predicado com literais (ver filtro_nao_cancelado)
+        db.Index('ix_agendamentos_nao_cancelados_data', 'data_hora',
+                 sqlite_where=db.text("status != 'cancelado'")),
+        # Agenda de cada fisioterapeuta: detecção de sobreposição, horários
+        # livres e feed iCalendar (que também lista sessões canceladas)
+        db.Index('ix_agendamentos_ocupacao', 'fisioterapeuta_id', 'data_hora', 'data_hora_fim'),
+        db.Index('ix_agendamentos_serie_data', 'serie_id', 'data_hora'),
+        # Versão do feed iCalendar (última alteração da agenda do fisioterapeuta)
+        db.Index('ix_agendamentos_fisioterapeuta_atualizacao', 'fisioterapeuta_id', 'data_atualizacao'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     data_hora = db.Column(db.DateTime, nullable=False)
-    duracao_minutos = db.Column(db.Integer, default=60)
-    status = db.Column(db.String(20), default='agendado')  # agendado, confirmado, realizado, cancelado
+    duracao_minutos = db.Column(db.Integer, default=DURACAO_PADRAO_MINUTOS)
+    data_hora_fim = db.Column(db.DateTime)  # data_hora + duracao_minutos, mantido pelos eventos abaixo
+    status = db.Column(db.String(20), default='agendado')  # agendado, confirmado, realizado, faltou, cancelado
     observacoes = db.Column(db.Text)
     lembrete_enviado = db.Column(db.Boolean, default=False)
     
@@ -328,20 +489,83 @@ class Agendamento(db.Model):
     
     # Relacionamentos
     paciente_id = db.Column(db.Integer, db.ForeignKey('pacientes.id'), nullable=False)
+    fisioterapeuta_id = db.Column(db.Integer, db.ForeignKey('fisioterapeutas.id'))  # padrão: do paciente
+    serie_id = db.Column(db.Integer, db.ForeignKey('series_agendamentos.id'))
     
     def __repr__(self):
         return f'<Agendamento {self.id} - {self.data_hora}>'
     
+    @staticmethod
+    def filtro_nao_cancelado():
+        """Filtro de agendamentos não cancelados (literal, casa com o índice parcial)"""
+        return Agendamento.status != db.literal_column("'cancelado'")
+    
+    @staticmethod
+    def filtro_status_ativo():
+        """Filtro de agendamentos agendados ou confirmados (literais, sondagem direta no índice de status)"""
+        return Agendamento.status.in_([db.literal_column(f"'{status}'") for status in STATUS_ATIVOS])
+    
     def to_dict(self):
         return {
             'id': self.id,
             'data_hora': self.data_hora.isoformat() if self.data_hora else None,
             'duracao_minutos': self.duracao_minutos,
+            'data_hora_fim': self.data_hora_fim.isoformat() if self.data_hora_fim else None,
             'status': self.status,
             'observacoes': self.observacoes,
             'lembrete_enviado': self.lembrete_enviado,
             'data_criacao': self.data_criacao.isoformat() if self.data_criacao else None,
             'data_atualizacao': self.data_atualizacao.isoformat() if self.data_atualizacao else None,
-            'paciente_id': self.paciente_id
+            'paciente_id': self.paciente_id,
+            'fisioterapeuta_id': self.fisioterapeuta_id,
+            'serie_id': self.serie_id
         }
 
+# Gatilhos que recusam agendamentos sobrepostos para o mesmo fisioterapeuta.
+# A verificação roda dentro do próprio INSERT/UPDATE, já com o lock de escrita
+# do SQLite, então não há janela entre a consulta e a gravação. A busca é uma
+# única sondagem no índice ix_agendamentos_ocupacao.
+_SOBREPOSICAO_AGENDAMENTO = f"""
+    SELECT RAISE(ABORT, 'conflito_agendamento')
+    WHERE EXISTS (
+        SELECT 1 FROM agendamentos
+        WHERE fisioterapeuta_id = NEW.fisioterapeuta_id
+          AND status IN ('agendado', 'confirmado')
+          AND data_hora > datetime(NEW.data_hora, '-{DURACAO_MAXIMA_MINUTOS} minutes')
+          AND data_hora < NEW.data_hora_fim
+          AND data_hora_fim > NEW.data_hora
+          AND id IS NOT NEW.id
+    );
+"""
+
+GATILHOS_AGENDAMENTO = (
+    f"""CREATE TRIGGER IF NOT EXISTS tg_agendamentos_sobreposicao_insert
+    BEFORE INSERT ON agendamentos
+    WHEN NEW.status IN ('agendado', 'confirmado')
+    BEGIN {_SOBREPOSICAO_AGENDAMENTO} END""",
+    f"""CREATE TRIGGER IF NOT EXISTS tg_agendamentos_sobreposicao_update
+    BEFORE UPDATE OF data_hora, data_hora_fim, status, fisioterapeuta_id ON agendamentos
+    WHEN NEW.status IN ('agendado', 'confirmado')
+    BEGIN {_SOBREPOSICAO_AGENDAMENTO} END""",
+)
+
+for _gatilho in GATILHOS_AGENDAMENTO:
+    event.listen(Agendamento.__table__, 'after_create', DDL(_gatilho).execute_if(dialect='sqlite'))
+
+@event.listens_for(Agendamento, 'before_insert')
+def _preencher_agendamento_inserido(mapper, connection, agendamento):
+    if agendamento.fisioterapeuta_id is None:
+        agendamento.fisioterapeuta_id = connection.execute(
+            select(Paciente.fisioterapeuta_id).where(Paciente.id == agendamento.paciente_id)
+        ).scalar()
+    _calcular_fim_agendamento(agendamento)
+
+@event.listens_for(Agendamento, 'before_update')
+def _preencher_agendamento_atualizado(mapper, connection, agendamento):
+    _calcular_fim_agendamento(agendamento)
+
+def _calcular_fim_agendamento(agendamento):
+    if agendamento.duracao_minutos is None:
+        agendamento.duracao_minutos = DURACAO_PADRAO_MINUTOS
+    if agendamento.data_hora is not None:
+        agendamento.data_hora_fim = agendamento.data_hora + timedelta(minutes=agendamento.duracao_minutos)
@@ -0,0 +1,85 @@
+import heapq
+from datetime import datetime
+from sqlalchemy import select, tuple_
+from src.models.fisio_models import Agendamento, Avaliacao, Evolucao, db
+from src.utils.paginacao import CursorInvalido, serializar_valor
+
+# Linhas trazidas do banco por vez em cada cursor
+LINHAS_POR_LOTE = 100
+
+# (tipo, modelo, coluna de data, colunas enviadas); a ordem desempata eventos no mesmo instante
+FONTES = (
+    ('agendamento', Agendamento, 'data_hora', ('status', 'duracao_minutos', 'observacoes')),
+    ('evolucao', Evolucao, 'data_sessao', ('procedimentos_realizados', 'resposta_paciente', 'intercorrencias')),
+    ('avaliacao', Avaliacao, 'data_avaliacao', ('queixa_principal', 'diagnostico_fisioterapeutico')),
+)
+ORDEM_TIPO = {fonte[0]: ordem for ordem, fonte in enumerate(FONTES)}
+
+
+def _chave(evento):
+    return evento[0], evento[1], evento[2]
+
+
+class LinhaDoTempoService:
+    @staticmethod
+    def _fonte(ordem, paciente_id, apos, limite):
+        """Cursor de uma tabela em ordem decrescente pelo índice (paciente_id, data)"""
+        tipo, modelo, nome_data, campos = FONTES[ordem]
+        coluna_data = getattr(modelo, nome_data)
+        query = (
+            select(coluna_data, modelo.id, *[getattr(modelo, campo) for campo in campos])
+            .where(modelo.paciente_id == paciente_id, coluna_data.isnot(None))
+        )
+        if apos is not None:
+            data, ordem_cursor, registro_id = apos
+            # (data, ordem, id) < cursor, já resolvido para a ordem fixa desta fonte
+            if ordem < ordem_cursor:
+                query = query.where(coluna_data <= data)
+            elif ordem == ordem_cursor:
+                query = query.where(tuple_(coluna_data, modelo.id) < tuple_(data, registro_id))
+            else:
+                query = query.where(coluna_data < data)
+        query = (
+            query.order_by(coluna_data.desc(), modelo.id.desc())
+            .limit(limite)
+            .execution_options(yield_per=LINHAS_POR_LOTE)
+        )
+        for linha in db.session.execute(query):
+            yield linha[0], ordem, linha[1], tipo, dict(zip(campos, linha[2:]))
+
+    @staticmethod
+    def eventos(paciente_id, apos=None, limite=None):
+        """Eventos do paciente, do mais recente ao mais antigo, intercalados sob demanda com um heap
+
+        `apos` é a chave (data, ordem, id) do último evento já enviado. Cada
+        fonte lê no máximo `limite` linhas, em lotes de LINHAS_POR_LOTE.
+        """
+        fontes = [LinhaDoTempoService._fonte(ordem, paciente_id, apos, limite) for ordem in range(len(FONTES))]
+        return heapq.merge(*fontes, key=_chave, reverse=True)
+
+    @staticmethod
+    def ler_cursor(valores):
+        """Converter [data, tipo, id] decodificados do cursor na chave de ordenação"""
+        data, tipo, registro_id = valores
+        if tipo not in ORDEM_TIPO or not isinstance(registro_id, int) or not isinstance(data, str):
+            raise CursorInvalido('Cursor inválido')
+        try:
+            return datetime.fromisoformat(data), ORDEM_TIPO[tipo], registro_id
+        except ValueError:
+            raise CursorInvalido('Cursor inválido')
+
+    @staticmethod
+    def evento_dict(evento):
+        data, _, registro_id, tipo, dados = evento
+        return {
+            'tipo': tipo,
+            'id': registro_id,
+            'data': data.isoformat(),
+            'dados': {campo: serializar_valor(valor) for campo, valor in dados.items()}
+        }
+
+    @staticmethod
+    def cursor(evento):
+        """Valores da chave do evento para codificar o próximo cursor"""
+        data, _, registro_id, tipo, _ = evento
+        return [data, tipo, registro_id]
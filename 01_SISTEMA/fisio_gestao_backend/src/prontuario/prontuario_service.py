@@ -0,0 +1,104 @@
+from flask import current_app
+from sqlalchemy import JSON, Boolean, DateTime, text
+from src.models.fisio_models import Paciente, Avaliacao, Evolucao, Agendamento, db
+
+
+def _campos(modelo):
+    """Chaves serializadas por to_dict, na mesma ordem
+
+    Avaliação, evolução e agendamento serializam todas as colunas, na ordem
+    da tabela (ver test_prontuario_sql_equivale_ao_orm); o paciente, só as públicas.
+    """
+    if modelo is Paciente:
+        return Paciente.CAMPOS_PUBLICOS
+    return tuple(coluna.name for coluna in modelo.__table__.columns)
+
+
+def _expressao_sqlite(coluna):
+    """Expressão SQL que reproduz a serialização de to_dict para a coluna"""
+    nome = coluna.name
+    if isinstance(coluna.type, DateTime):
+        # SQLAlchemy grava 'YYYY-MM-DD HH:MM:SS.ffffff'; isoformat() usa 'T'
+        # e omite os microssegundos quando são zero
+        return (
+            f"CASE WHEN {nome} IS NULL THEN NULL "
+            f"WHEN substr({nome}, 20) IN ('', '.000000') THEN replace(substr({nome}, 1, 19), ' ', 'T') "
+            f"ELSE replace({nome}, ' ', 'T') END"
+        )
+    if isinstance(coluna.type, JSON):
+        # Documento já armazenado como JSON: embutido sem decodificar
+        return f"json({nome})"
+    if isinstance(coluna.type, Boolean):
+        return f"json(CASE WHEN {nome} IS NULL THEN 'null' WHEN {nome} THEN 'true' ELSE 'false' END)"
+    return nome
+
+
+def _objeto_sqlite(modelo):
+    colunas = modelo.__table__.columns
+    pares = ', '.join(
+        f"'{campo}', {_expressao_sqlite(colunas[campo])}" for campo in _campos(modelo)
+    )
+    return f"json_object({pares})"
+
+
+def _lista_sqlite(modelo):
+    return (
+        f"json((SELECT json_group_array(json(item)) FROM ("
+        f"SELECT {_objeto_sqlite(modelo)} AS item FROM {modelo.__tablename__} "
+        f"WHERE paciente_id = :paciente_id ORDER BY id)))"
+    )
+
+
+class ProntuarioService:
+    _sql_sqlite = None
+
+    @staticmethod
+    def montar(paciente_id):
+        """Montar prontuário a partir dos modelos ORM"""
+        paciente = Paciente.query.get_or_404(paciente_id)
+
+        # Buscar todas as informações relacionadas
+        avaliacoes = [avaliacao.to_dict() for avaliacao in paciente.avaliacoes]
+        evolucoes = [evolucao.to_dict() for evolucao in paciente.evolucoes]
+        agendamentos = [agendamento.to_dict() for agendamento in paciente.agendamentos]
+
+        return {
+            'paciente': paciente.to_dict(),
+            'avaliacoes': avaliacoes,
+            'evolucoes': evolucoes,
+            'agendamentos': agendamentos
+        }
+
+    @classmethod
+    def sql_sqlite(cls):
+        """Consulta única (JSON1) que devolve o prontuário já serializado"""
+        if cls._sql_sqlite is None:
+            cls._sql_sqlite = (
+                "SELECT json_object("
+                f"'paciente', json((SELECT {_objeto_sqlite(Paciente)} FROM pacientes WHERE id = :paciente_id)), "
+                f"'avaliacoes', {_lista_sqlite(Avaliacao)}, "
+                f"'evolucoes', {_lista_sqlite(Evolucao)}, "
+                f"'agendamentos', {_lista_sqlite(Agendamento)}"
+                ") WHERE EXISTS (SELECT 1 FROM pacientes WHERE id = :paciente_id)"
+            )
+        return cls._sql_sqlite
+
+    @classmethod
+    def montar_json(cls, paciente_id):
+        """Obter prontuário serializado (bytes) ou None se o paciente não existir
+
+        No SQLite o documento é montado pelo banco em uma única ida e volta;
+        nos demais bancos usa o caminho ORM.
+        """
+        if db.engine.dialect.name != 'sqlite':
+            paciente = db.session.get(Paciente, paciente_id)
+            if paciente is None:
+                return None
+            return current_app.json.dumps(cls.montar(paciente_id)).encode('utf-8')
+
+        documento = db.session.execute(
+            text(cls.sql_sqlite()), {'paciente_id': paciente_id}
+        ).scalar()
+        if documento is None:
+            return None
+        return documento.encode('utf-8')
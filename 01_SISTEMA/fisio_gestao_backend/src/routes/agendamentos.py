@@ -1,9 +1,64 @@
-from flask import Blueprint, jsonify, request
-from src.models.fisio_models import Agendamento, Paciente, db
-from datetime import datetime, timedelta
+from flask import Blueprint, abort, current_app, jsonify, request, stream_with_context
+from werkzeug.exceptions import HTTPException
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
+from src.models.fisio_models import (
+    Agendamento, Paciente, SerieAgendamento, DURACAO_PADRAO_MINUTOS, STATUS_ATIVOS, TRANSICOES_STATUS, db
+)
+from src.audit.audit_service import AuditoriaService
+from src.agenda.agenda_service import (
+    AgendaService, FEED_DIAS_PASSADOS, MAX_DIAS_HORARIOS_LIVRES, MAX_LOTE_STATUS
+)
+from src.agenda.ics import gerar_ics
+from src.agenda.indicadores_service import IndicadoresAgendaService
+from src.agenda.recorrencia import RegraInvalida
+from src.lembretes.lembrete_service import LembreteService
+from src.utils.paginacao import serializar_valor
+from datetime import date, datetime, timedelta, timezone
+import hashlib
+import json
 
 agendamento_bp = Blueprint('agendamento', __name__)
 
+def _ler_data_hora(texto):
+    """Converter data/hora ISO 8601 para o formato gravado na agenda
+
+    Horários da agenda são gravados sem fuso, na hora local da clínica (ver
+    agenda/ics.py): com Z ou offset, vale a hora informada e o fuso é descartado.
+    """
+    return datetime.fromisoformat(texto.replace('Z', '+00:00')).replace(tzinfo=None)
+
+def _ler_include(padrao=None):
+    """Ler include=paciente[:campo,...]; retorna (campos do paciente ou None, erro)"""
+    include = request.args.get('include', padrao)
+    if not include:
+        return None, None
+    
+    recurso, _, campos = include.partition(':')
+    if recurso.strip() != 'paciente':
+        return None, f'include não suportado: {recurso}'
+    if not campos:
+        return list(Paciente.CAMPOS_PUBLICOS), None
+    
+    campos = [campo.strip() for campo in campos.split(',') if campo.strip()]
+    invalidos = [campo for campo in campos if campo not in Paciente.CAMPOS_PUBLICOS]
+    if invalidos:
+        return None, f'Campos inválidos: {", ".join(invalidos)}'
+    if 'id' not in campos:
+        campos.insert(0, 'id')
+    return campos, None
+
+def _carregar_paciente(*campos):
+    """Carregar o paciente no mesmo SELECT dos agendamentos, apenas com as colunas usadas"""
+    return joinedload(Agendamento.paciente, innerjoin=True).load_only(
+        *[getattr(Paciente, campo) for campo in campos]
+    )
+
+def _paciente_dict(paciente, campos):
+    if len(campos) == len(Paciente.CAMPOS_PUBLICOS):
+        return paciente.to_dict()
+    return {campo: serializar_valor(getattr(paciente, campo)) for campo in campos}
+
 @agendamento_bp.route('/agendamentos', methods=['GET'])
 def get_agendamentos():
     """Listar agendamentos com filtros opcionais"""
@@ -13,7 +68,14 @@ def get_agendamentos():
         data_inicio = request.args.get('data_inicio')
         data_fim = request.args.get('data_fim')
         
+        # Por padrão inclui o paciente completo; include=paciente:id,nome_completo reduz as colunas
+        campos_paciente, erro = _ler_include('paciente')
+        if erro:
+            return jsonify({'erro': erro}), 400
+        
         query = Agendamento.query
+        if campos_paciente:
+            query = query.options(_carregar_paciente(*campos_paciente))
         
         if paciente_id:
             query = query.filter(Agendamento.paciente_id == paciente_id)
@@ -23,25 +85,26 @@ def get_agendamentos():
         
         if data_inicio:
             try:
-                data_inicio_dt = datetime.fromisoformat(data_inicio.replace('Z', '+00:00'))
+                data_inicio_dt = _ler_data_hora(data_inicio)
                 query = query.filter(Agendamento.data_hora >= data_inicio_dt)
             except ValueError:
                 return jsonify({'erro': 'Formato de data_inicio inválido'}), 400
         
         if data_fim:
             try:
-                data_fim_dt = datetime.fromisoformat(data_fim.replace('Z', '+00:00'))
+                data_fim_dt = _ler_data_hora(data_fim)
                 query = query.filter(Agendamento.data_hora <= data_fim_dt)
             except ValueError:
                 return jsonify({'erro': 'Formato de data_fim inválido'}), 400
         
         agendamentos = query.order_by(Agendamento.data_hora).all()
         
-        # Incluir informações do paciente
+        # Incluir informações do paciente (já carregado pelo joinedload)
         agendamentos_dict = []
         for agendamento in agendamentos:
             agendamento_dict = agendamento.to_dict()
-            agendamento_dict['paciente'] = agendamento.paciente.to_dict() if agendamento.paciente else None
+            if campos_paciente:
+                agendamento_dict['paciente'] = _paciente_dict(agendamento.paciente, campos_paciente)
             agendamentos_dict.append(agendamento_dict)
         
         return jsonify(agendamentos_dict)
@@ -49,6 +112,55 @@ def get_agendamentos():
     except Exception as e:
         return jsonify({'erro': str(e)}), 500
 
+def _gravar_agendamento(agendamento):
+    """Gravar agendamento; retorna resposta 409 se houver sobreposição"""
+    agendamento_id = agendamento.id
+    inicio = agendamento.data_hora
+    fim = inicio + timedelta(minutes=agendamento.duracao_minutos or DURACAO_PADRAO_MINUTOS)
+    fisioterapeuta_id = agendamento.fisioterapeuta_id
+    ativo = agendamento.status in STATUS_ATIVOS
+    
+    if ativo and AgendaService.verificar_antes_de_gravar():
+        conflitos = AgendaService.conflitos(fisioterapeuta_id, inicio, fim, ignorar_id=agendamento_id)
+        if conflitos:
+            db.session.rollback()
+            return _resposta_conflito(conflitos)
+    
+    try:
+        db.session.add(agendamento)
+        db.session.commit()
+    except IntegrityError as e:
+        db.session.rollback()
+        if not AgendaService.e_conflito(e):
+            raise
+        conflitos = AgendaService.conflitos(fisioterapeuta_id, inicio, fim, ignorar_id=agendamento_id)
+        return _resposta_conflito(conflitos)
+    return None
+
+def _conflito_dict(conflito):
+    return {
+        'id': conflito.id,
+        'data_hora': conflito.data_hora.isoformat(),
+        'data_hora_fim': conflito.data_hora_fim.isoformat() if conflito.data_hora_fim else None
+    }
+
+def _resposta_conflito(conflitos):
+    return jsonify({
+        'erro': 'Horário indisponível: sobrepõe outro agendamento do fisioterapeuta',
+        'conflitos': [_conflito_dict(conflito) for conflito in conflitos]
+    }), 409
+
+def _ocorrencias_em_conflito(puladas):
+    """Ocorrências de série recusadas, com os agendamentos que as impediram"""
+    return [
+        {
+            'data_hora': inicio.isoformat(),
+            'data_hora_fim': fim.isoformat(),
+            'conflitos': [_conflito_dict(conflito) for conflito in conflitos]
+        }
+        for (inicio, fim), conflitos in puladas
+    ]
+
 @agendamento_bp.route('/agendamentos', methods=['POST'])
 def create_agendamento():
     """Criar novo agendamento"""
@@ -69,29 +181,30 @@ def create_agendamento():
         
         # Converter data e hora
         try:
-            data_hora = datetime.fromisoformat(data['data_hora'].replace('Z', '+00:00'))
+            data_hora = _ler_data_hora(data['data_hora'])
         except ValueError:
             return jsonify({'erro': 'Formato de data/hora inválido'}), 400
         
-        # Verificar se já existe agendamento no mesmo horário
-        agendamento_existente = Agendamento.query.filter(
-            Agendamento.data_hora == data_hora,
-            Agendamento.status.in_(['agendado', 'confirmado'])
-        ).first()
+        duracao_minutos = data.get('duracao_minutos', DURACAO_PADRAO_MINUTOS)
+        erro_duracao = AgendaService.validar_duracao(duracao_minutos)
+        if erro_duracao:
+            return jsonify({'erro': erro_duracao}), 400
         
-        if agendamento_existente:
-            return jsonify({'erro': 'Já existe um agendamento para este horário'}), 409
+        fisioterapeuta_id = data.get('fisioterapeuta_id') or paciente.fisioterapeuta_id
         
         agendamento = Agendamento(
             paciente_id=data['paciente_id'],
+            fisioterapeuta_id=fisioterapeuta_id,
             data_hora=data_hora,
-            duracao_minutos=data.get('duracao_minutos', 60),
+            duracao_minutos=duracao_minutos,
             status=data.get('status', 'agendado'),
             observacoes=data.get('observacoes')
         )
         
-        db.session.add(agendamento)
-        db.session.commit()
+        # A sobreposição é recusada pelo gatilho do banco na própria gravação
+        resposta_conflito = _gravar_agendamento(agendamento)
+        if resposta_conflito:
+            return resposta_conflito
         
         # Incluir informações do paciente na resposta
         agendamento_dict = agendamento.to_dict()
@@ -103,6 +216,199 @@ def create_agendamento():
         db.session.rollback()
         return jsonify({'erro': str(e)}), 500
 
+@agendamento_bp.route('/agendamentos/series', methods=['POST'])
+def create_serie_agendamentos():
+    """Criar série de agendamentos a partir de regra de recorrência (RRULE)"""
+    try:
+        data = request.json
+        
+        if not data.get('paciente_id'):
+            return jsonify({'erro': 'Paciente é obrigatório'}), 400
+        
+        if not data.get('data_hora'):
+            return jsonify({'erro': 'Data e hora são obrigatórias'}), 400
+        
+        paciente = db.session.get(Paciente, data['paciente_id'])
+        if not paciente:
+            return jsonify({'erro': 'Paciente não encontrado'}), 404
+        
+        try:
+            data_hora = _ler_data_hora(data['data_hora'])
+        except ValueError:
+            return jsonify({'erro': 'Formato de data/hora inválido'}), 400
+        
+        duracao_minutos = data.get('duracao_minutos', DURACAO_PADRAO_MINUTOS)
+        erro_duracao = AgendaService.validar_duracao(duracao_minutos)
+        if erro_duracao:
+            return jsonify({'erro': erro_duracao}), 400
+        
+        try:
+            serie, puladas = AgendaService.criar_serie(
+                paciente, data_hora, duracao_minutos, data.get('regra'),
+                fisioterapeuta_id=data.get('fisioterapeuta_id'),
+                observacoes=data.get('observacoes')
+            )
+        except RegraInvalida as e:
+            return jsonify({'erro': str(e)}), 400
+        
+        if serie is None:
+            db.session.rollback()
+            return jsonify({
+                'erro': 'Nenhuma ocorrência da série está livre',
+                'conflitos': _ocorrencias_em_conflito(puladas)
+            }), 409
+        
+        # Série e ocorrências em uma única transação; o gatilho de
+        # sobreposição ainda protege contra gravações concorrentes
+        try:
+            db.session.commit()
+        except IntegrityError as e:
+            db.session.rollback()
+            if not AgendaService.e_conflito(e):
+                raise
+            return jsonify({'erro': 'A agenda mudou durante a criação da série; tente novamente'}), 409
+        
+        agendamentos = Agendamento.query.filter_by(serie_id=serie.id).order_by(Agendamento.data_hora).all()
+        
+        return jsonify({
+            'serie': serie.to_dict(),
+            'agendamentos': [agendamento.to_dict() for agendamento in agendamentos],
+            'conflitos': _ocorrencias_em_conflito(puladas)
+        }), 201
+    
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'erro': str(e)}), 500
+
+@agendamento_bp.route('/agendamentos/series/<int:serie_id>', methods=['GET'])
+def get_serie_agendamentos(serie_id):
+    """Obter série de agendamentos com suas ocorrências"""
+    try:
+        serie = SerieAgendamento.query.get_or_404(serie_id)
+        agendamentos = Agendamento.query.filter_by(serie_id=serie.id).order_by(Agendamento.data_hora).all()
+        
+        return jsonify({
+            'serie': serie.to_dict(),
+            'agendamentos': [agendamento.to_dict() for agendamento in agendamentos]
+        })
+    
+    except Exception as e:
+        return jsonify({'erro': str(e)}), 500
+
+@agendamento_bp.route('/agendamentos/series/<int:serie_id>', methods=['PUT'])
+def update_serie_agendamentos(serie_id):
+    """Atualizar ocorrências ativas da série de uma só vez"""
+    try:
+        serie = SerieAgendamento.query.get_or_404(serie_id)
+        data = request.json
+        
+        # Por padrão altera apenas as ocorrências futuras
+        a_partir_de = datetime.utcnow()
+        if data.get('a_partir_de'):
+            try:
+                a_partir_de = _ler_data_hora(data['a_partir_de'])
+            except ValueError:
+                return jsonify({'erro': 'Formato de a_partir_de inválido'}), 400
+        
+        valores = {}
+        if 'duracao_minutos' in data:
+            erro_duracao = AgendaService.validar_duracao(data['duracao_minutos'])
+            if erro_duracao:
+                return jsonify({'erro': erro_duracao}), 400
+            valores['duracao_minutos'] = data['duracao_minutos']
+        
+        if 'status' in data:
+            if data['status'] not in (*STATUS_ATIVOS, 'cancelado'):
+                return jsonify({'erro': 'Status inválido para a série'}), 400
+            valores['status'] = data['status']
+        
+        for campo in ('fisioterapeuta_id', 'observacoes'):
+            if campo in data:
+                valores[campo] = data[campo]
+        
+        if not valores:
+            return jsonify({'erro': 'Nenhum campo para atualizar'}), 400
+        
+        atualizados, conflitos = AgendaService.atualizar_serie(serie, a_partir_de, valores)
+        if conflitos:
+            db.session.rollback()
+            return jsonify({
+                'erro': 'Horário indisponível: sobrepõe outro agendamento do fisioterapeuta',
+                'conflitos': _ocorrencias_em_conflito(conflitos)
+            }), 409
+        
+        try:
+            db.session.commit()
+        except IntegrityError as e:
+            db.session.rollback()
+            if not AgendaService.e_conflito(e):
+                raise
+            return jsonify({'erro': 'A agenda mudou durante a atualização da série; tente novamente'}), 409
+        
+        return jsonify({'serie': serie.to_dict(), 'atualizados': atualizados})
+    
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'erro': str(e)}), 500
+
+@agendamento_bp.route('/agendamentos/lote', methods=['PATCH'])
+def update_status_agendamentos_lote():
+    """Alterar status de vários agendamentos de uma vez (fechamento do dia)"""
+    try:
+        data = request.json or {}
+        
+        # {"alteracoes": [{"id": 1, "status": "realizado"}, ...]} ou {"ids": [...], "status": "..."}
+        if 'alteracoes' in data:
+            itens = data['alteracoes']
+        else:
+            itens = [{'id': agendamento_id, 'status': data.get('status')} for agendamento_id in data.get('ids', [])]
+        
+        if not isinstance(itens, list) or not itens:
+            return jsonify({'erro': 'Informe as alterações de status'}), 400
+        if len(itens) > MAX_LOTE_STATUS:
+            return jsonify({'erro': f'Máximo de {MAX_LOTE_STATUS} agendamentos por lote'}), 400
+        
+        alteracoes = {}
+        for item in itens:
+            if not isinstance(item, dict) or not isinstance(item.get('id'), int) or isinstance(item.get('id'), bool):
+                return jsonify({'erro': 'Cada alteração precisa de um id inteiro'}), 400
+            if item.get('status') not in TRANSICOES_STATUS:
+                return jsonify({'erro': f'Status inválido: {item.get("status")}'}), 400
+            alteracoes[item['id']] = item['status']
+        
+        aplicados, rejeitados = AgendaService.alterar_status_em_lote(alteracoes)
+        
+        AuditoriaService.log_acoes_em_lote('UPDATE', 'agendamentos', [
+            {
+                'registro_id': agendamento_id,
+                'dados_anteriores': json.dumps({'status': anterior}),
+                'dados_novos': json.dumps({'status': novo})
+            }
+            for agendamento_id, anterior, novo in aplicados
+        ], observacoes='Alteração de status em lote')
+        
+        try:
+            db.session.commit()
+        except IntegrityError as e:
+            db.session.rollback()
+            if not AgendaService.e_conflito(e):
+                raise
+            return jsonify({'erro': 'A alteração causaria sobreposição na agenda'}), 409
+        
+        por_status = {}
+        for _, _, novo in aplicados:
+            por_status[novo] = por_status.get(novo, 0) + 1
+        
+        return jsonify({
+            'atualizados': len(aplicados),
+            'por_status': por_status,
+            'rejeitados': sorted(rejeitados, key=lambda rejeitado: rejeitado['id'])
+        })
+    
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'erro': str(e)}), 500
+
 @agendamento_bp.route('/agendamentos/<int:agendamento_id>', methods=['GET'])
 def get_agendamento(agendamento_id):
     """Obter agendamento por ID"""
@@ -128,25 +434,19 @@ def update_agendamento(agendamento_id):
         # Atualizar campos
         if 'data_hora' in data:
             try:
-                nova_data_hora = datetime.fromisoformat(data['data_hora'].replace('Z', '+00:00'))
-                
-                # Verificar se já existe agendamento no novo horário (exceto o atual)
-                agendamento_existente = Agendamento.query.filter(
-                    Agendamento.data_hora == nova_data_hora,
-                    Agendamento.status.in_(['agendado', 'confirmado']),
-                    Agendamento.id != agendamento_id
-                ).first()
-                
-                if agendamento_existente:
-                    return jsonify({'erro': 'Já existe um agendamento para este horário'}), 409
-                
-                agendamento.data_hora = nova_data_hora
+                agendamento.data_hora = _ler_data_hora(data['data_hora'])
             except ValueError:
                 return jsonify({'erro': 'Formato de data/hora inválido'}), 400
         
         if 'duracao_minutos' in data:
+            erro_duracao = AgendaService.validar_duracao(data['duracao_minutos'])
+            if erro_duracao:
+                return jsonify({'erro': erro_duracao}), 400
             agendamento.duracao_minutos = data['duracao_minutos']
         
+        if 'fisioterapeuta_id' in data:
+            agendamento.fisioterapeuta_id = data['fisioterapeuta_id']
+        
         if 'status' in data:
             agendamento.status = data['status']
         
@@ -157,7 +457,9 @@ def update_agendamento(agendamento_id):
             agendamento.lembrete_enviado = data['lembrete_enviado']
         
         agendamento.data_atualizacao = datetime.utcnow()
-        db.session.commit()
+        resposta_conflito = _gravar_agendamento(agendamento)
+        if resposta_conflito:
+            return resposta_conflito
         
         # Incluir informações do paciente na resposta
         agendamento_dict = agendamento.to_dict()
@@ -198,15 +500,21 @@ def get_calendario():
             return jsonify({'erro': 'data_inicio e data_fim são obrigatórias'}), 400
         
         try:
-            data_inicio_dt = datetime.fromisoformat(data_inicio.replace('Z', '+00:00'))
-            data_fim_dt = datetime.fromisoformat(data_fim.replace('Z', '+00:00'))
+            data_inicio_dt = _ler_data_hora(data_inicio)
+            data_fim_dt = _ler_data_hora(data_fim)
         except ValueError:
             return jsonify({'erro': 'Formato de data inválido'}), 400
         
-        agendamentos = Agendamento.query.filter(
+        # O título usa apenas o nome; include=paciente:... acrescenta outros campos
+        campos_paciente, erro = _ler_include()
+        if erro:
+            return jsonify({'erro': erro}), 400
+        campos_carregados = set(campos_paciente or ()) | {'nome_completo'}
+        
+        agendamentos = Agendamento.query.options(_carregar_paciente(*campos_carregados)).filter(
             Agendamento.data_hora >= data_inicio_dt,
             Agendamento.data_hora <= data_fim_dt,
-            Agendamento.status != 'cancelado'
+            Agendamento.filtro_nao_cancelado()
         ).order_by(Agendamento.data_hora).all()
         
         # Formatar para calendário
@@ -221,6 +529,8 @@ def get_calendario():
                 'paciente_id': agendamento.paciente_id,
                 'observacoes': agendamento.observacoes
             }
+            if campos_paciente:
+                evento['paciente'] = _paciente_dict(agendamento.paciente, campos_paciente)
             eventos.append(evento)
         
         return jsonify(eventos)
@@ -228,42 +538,141 @@ def get_calendario():
     except Exception as e:
         return jsonify({'erro': str(e)}), 500
 
-@agendamento_bp.route('/agendamentos/lembretes', methods=['POST'])
-def enviar_lembretes():
-    """Enviar lembretes para agendamentos do dia seguinte"""
+@agendamento_bp.route('/agendamentos/horarios-livres', methods=['GET'])
+def get_horarios_livres():
+    """Listar janelas livres na agenda dos fisioterapeutas"""
     try:
-        # Buscar agendamentos para o dia seguinte que ainda não tiveram lembrete enviado
-        amanha = datetime.now().date() + timedelta(days=1)
-        inicio_dia = datetime.combine(amanha, datetime.min.time())
-        fim_dia = datetime.combine(amanha, datetime.max.time())
+        data_inicio = request.args.get('data_inicio')
+        data_fim = request.args.get('data_fim')
+        duracao_minutos = request.args.get('duracao_minutos', type=int)
+        fisioterapeuta_id = request.args.get('fisioterapeuta_id', type=int)
         
-        agendamentos = Agendamento.query.filter(
-            Agendamento.data_hora >= inicio_dia,
-            Agendamento.data_hora <= fim_dia,
-            Agendamento.status.in_(['agendado', 'confirmado']),
-            Agendamento.lembrete_enviado == False
-        ).all()
+        if not data_inicio or not data_fim:
+            return jsonify({'erro': 'data_inicio e data_fim são obrigatórias'}), 400
         
-        lembretes_enviados = 0
+        if duracao_minutos is None:
+            return jsonify({'erro': 'duracao_minutos é obrigatória'}), 400
+        erro_duracao = AgendaService.validar_duracao(duracao_minutos)
+        if erro_duracao:
+            return jsonify({'erro': erro_duracao}), 400
         
-        for agendamento in agendamentos:
-            # TODO: Implementar envio real de e-mail/SMS
-            # Por enquanto, apenas marcar como enviado
-            
-            # Verificar se o paciente tem consentimento para receber lembretes
-            # TODO: Implementar campo de consentimento no modelo Paciente
-            
-            agendamento.lembrete_enviado = True
-            lembretes_enviados += 1
+        try:
+            inicio = _ler_data_hora(data_inicio)
+            fim = _ler_data_hora(data_fim)
+        except ValueError:
+            return jsonify({'erro': 'Formato de data inválido'}), 400
         
-        db.session.commit()
+        # Apenas a data em data_fim inclui o dia inteiro
+        if len(data_fim) == 10:
+            fim += timedelta(days=1)
+        
+        if fim <= inicio:
+            return jsonify({'erro': 'data_fim deve ser posterior a data_inicio'}), 400
+        if fim - inicio > timedelta(days=MAX_DIAS_HORARIOS_LIVRES):
+            return jsonify({'erro': f'Intervalo máximo é de {MAX_DIAS_HORARIOS_LIVRES} dias'}), 400
+        
+        fisioterapeutas = AgendaService.horarios_livres(inicio, fim, duracao_minutos, fisioterapeuta_id)
+        if fisioterapeuta_id is not None and not fisioterapeutas:
+            return jsonify({'erro': 'Fisioterapeuta não encontrado'}), 404
         
         return jsonify({
-            'mensagem': f'{lembretes_enviados} lembretes enviados com sucesso',
-            'total_enviados': lembretes_enviados
+            'data_inicio': inicio.isoformat(),
+            'data_fim': fim.isoformat(),
+            'duracao_minutos': duracao_minutos,
+            'fisioterapeutas': fisioterapeutas
+        })
+    
+    except Exception as e:
+        return jsonify({'erro': str(e)}), 500
+
+@agendamento_bp.route('/agendamentos/indicadores', methods=['GET'])
+def get_indicadores_agenda():
+    """Taxas de ocupação, cancelamento e faltas por fisioterapeuta e dia da semana"""
+    try:
+        data_inicio = request.args.get('data_inicio')
+        data_fim = request.args.get('data_fim')
+        fisioterapeuta_id = request.args.get('fisioterapeuta_id', type=int)
+        
+        if not data_inicio or not data_fim:
+            return jsonify({'erro': 'data_inicio e data_fim são obrigatórias'}), 400
+        
+        try:
+            inicio = date.fromisoformat(data_inicio)
+            fim = date.fromisoformat(data_fim)
+        except ValueError:
+            return jsonify({'erro': 'Formato de data inválido (use AAAA-MM-DD)'}), 400
+        
+        if fim < inicio:
+            return jsonify({'erro': 'data_fim deve ser igual ou posterior a data_inicio'}), 400
+        
+        # Lido apenas do resumo diário: custo proporcional ao número de dias
+        return jsonify({
+            'data_inicio': inicio.isoformat(),
+            'data_fim': fim.isoformat(),
+            'fisioterapeutas': IndicadoresAgendaService.indicadores(inicio, fim, fisioterapeuta_id)
         })
     
     except Exception as e:
-        db.session.rollback()
         return jsonify({'erro': str(e)}), 500
 
+@agendamento_bp.route('/agendamentos/fisioterapeutas/<int:fisioterapeuta_id>/agenda.ics', methods=['GET'])
+def get_agenda_ics(fisioterapeuta_id):
+    """Feed iCalendar da agenda do fisioterapeuta (streaming, com ETag e Last-Modified)"""
+    try:
+        versao = AgendaService.versao_feed(fisioterapeuta_id)
+        if versao is None:
+            abort(404)
+        
+        # A janela do feed avança por dia, então entra na versão
+        inicio = datetime.combine(datetime.now().date() - timedelta(days=FEED_DIAS_PASSADOS), datetime.min.time())
+        atualizacao = max(filter(None, (versao.atualizacao, versao.atualizacao_pacientes)), default=None)
+        resumo = hashlib.sha1(repr((fisioterapeuta_id, str(atualizacao), versao.total, inicio)).encode('utf-8'))
+        etag = f'agenda-{fisioterapeuta_id}-{resumo.hexdigest()[:20]}'
+        ultima_alteracao = atualizacao.replace(tzinfo=timezone.utc, microsecond=0) if atualizacao else None
+        
+        if request.if_none_match:
+            nao_modificado = etag in request.if_none_match
+        else:
+            nao_modificado = (ultima_alteracao is not None and request.if_modified_since is not None
+                              and ultima_alteracao <= request.if_modified_since)
+        
+        if nao_modificado:
+            response = current_app.response_class(status=304)
+        else:
+            # Eventos enviados à medida que o cursor avança, sem montar o arquivo em memória
+            linhas = AgendaService.linhas_feed(fisioterapeuta_id, inicio)
+            response = current_app.response_class(
+                stream_with_context(gerar_ics(f'Agenda - {versao.nome}', linhas)),
+                mimetype='text/calendar'
+            )
+            response.headers['Content-Disposition'] = 'inline; filename="agenda.ics"'
+        
+        response.set_etag(etag)
+        if ultima_alteracao:
+            response.last_modified = ultima_alteracao
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        return jsonify({'erro': str(e)}), 500
+
+@agendamento_bp.route('/agendamentos/lembretes', methods=['POST'])
+def enviar_lembretes():
+    """Enfileirar lembretes para agendamentos do dia seguinte"""
+    try:
+        # O envio é feito em segundo plano pelo despachante (src/lembretes);
+        # aqui apenas a fila é preenchida, com consentimento filtrado na consulta
+        amanha = datetime.now().date() + timedelta(days=1)
+        total = LembreteService.enfileirar(amanha, LembreteService.canais())
+        db.session.commit()
+        
+        return jsonify({
+            'mensagem': f'{total} lembretes enfileirados para envio',
+            'total_enfileirados': total
+        }), 202
+    
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'erro': str(e)}), 500
@@ -1,7 +1,16 @@
-from flask import Blueprint, jsonify, request
-from src.models.fisio_models import Avaliacao, Paciente, AnexoAvaliacao, db
+import mimetypes
+import os
+import unicodedata
+from urllib.parse import quote
+from flask import Blueprint, current_app, jsonify, request, send_file
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import parse_content_range_header
+from src.models.fisio_models import Avaliacao, Paciente, AnexoAvaliacao, CAMPOS_CIF, db
+from src.cif.registro_cif import validar_campos_cif
+from src.anexos.armazenamento_service import (
+    ArmazenamentoAnexos, ParteInvalida, UploadAnexo, UploadAnexoService, UploadOcupado
+)
 from datetime import datetime
-import json
 
 avaliacao_bp = Blueprint('avaliacao', __name__)
 
@@ -37,6 +46,11 @@ def create_avaliacao():
         if not paciente:
             return jsonify({'erro': 'Paciente não encontrado'}), 404
         
+        # Códigos e qualificadores conferidos com a classificação da OMS
+        erros_cif = validar_campos_cif(data)
+        if erros_cif:
+            return jsonify({'erro': 'Códigos da CIF inválidos', 'erros': erros_cif}), 400
+        
         # Converter data de avaliação se fornecida
         data_avaliacao = datetime.utcnow()
         if data.get('data_avaliacao'):
@@ -45,23 +59,6 @@ def create_avaliacao():
             except ValueError:
                 return jsonify({'erro': 'Formato de data inválido'}), 400
         
-        # Validar e converter campos JSON da CIF
-        funcoes_corpo = data.get('funcoes_corpo')
-        if funcoes_corpo and isinstance(funcoes_corpo, dict):
-            funcoes_corpo = json.dumps(funcoes_corpo)
-        
-        estruturas_corpo = data.get('estruturas_corpo')
-        if estruturas_corpo and isinstance(estruturas_corpo, dict):
-            estruturas_corpo = json.dumps(estruturas_corpo)
-        
-        atividades_participacao = data.get('atividades_participacao')
-        if atividades_participacao and isinstance(atividades_participacao, dict):
-            atividades_participacao = json.dumps(atividades_participacao)
-        
-        fatores_ambientais = data.get('fatores_ambientais')
-        if fatores_ambientais and isinstance(fatores_ambientais, dict):
-            fatores_ambientais = json.dumps(fatores_ambientais)
-        
         avaliacao = Avaliacao(
             paciente_id=data['paciente_id'],
             data_avaliacao=data_avaliacao,
@@ -79,10 +76,8 @@ def create_avaliacao():
             objetivos_terapeuticos=data.get('objetivos_terapeuticos'),
             recursos_metodos_tecnicas=data.get('recursos_metodos_tecnicas'),
             quantitativo_atendimentos=data.get('quantitativo_atendimentos'),
-            funcoes_corpo=funcoes_corpo,
-            estruturas_corpo=estruturas_corpo,
-            atividades_participacao=atividades_participacao,
-            fatores_ambientais=fatores_ambientais
+            # Campos da CIF gravados como JSON nativo, sem serialização manual
+            **{campo: data.get(campo) for campo in CAMPOS_CIF}
         )
         
         db.session.add(avaliacao)
@@ -104,31 +99,6 @@ def get_avaliacao(avaliacao_id):
         avaliacao_dict = avaliacao.to_dict()
         avaliacao_dict['anexos'] = [anexo.to_dict() for anexo in avaliacao.anexos]
         
-        # Converter campos JSON de volta para objetos
-        if avaliacao.funcoes_corpo:
-            try:
-                avaliacao_dict['funcoes_corpo'] = json.loads(avaliacao.funcoes_corpo)
-            except json.JSONDecodeError:
-                pass
-        
-        if avaliacao.estruturas_corpo:
-            try:
-                avaliacao_dict['estruturas_corpo'] = json.loads(avaliacao.estruturas_corpo)
-            except json.JSONDecodeError:
-                pass
-        
-        if avaliacao.atividades_participacao:
-            try:
-                avaliacao_dict['atividades_participacao'] = json.loads(avaliacao.atividades_participacao)
-            except json.JSONDecodeError:
-                pass
-        
-        if avaliacao.fatores_ambientais:
-            try:
-                avaliacao_dict['fatores_ambientais'] = json.loads(avaliacao.fatores_ambientais)
-            except json.JSONDecodeError:
-                pass
-        
         return jsonify(avaliacao_dict)
     
     except Exception as e:
@@ -141,6 +111,10 @@ def update_avaliacao(avaliacao_id):
         avaliacao = Avaliacao.query.get_or_404(avaliacao_id)
         data = request.json
         
+        erros_cif = validar_campos_cif(data)
+        if erros_cif:
+            return jsonify({'erro': 'Códigos da CIF inválidos', 'erros': erros_cif}), 400
+        
         # Atualizar campos básicos
         campos_texto = [
             'queixa_principal', 'habitos_vida', 'historia_atual_doenca',
@@ -159,13 +133,9 @@ def update_avaliacao(avaliacao_id):
             avaliacao.quantitativo_atendimentos = data['quantitativo_atendimentos']
         
         # Atualizar campos CIF
-        campos_cif = ['funcoes_corpo', 'estruturas_corpo', 'atividades_participacao', 'fatores_ambientais']
-        for campo in campos_cif:
+        for campo in CAMPOS_CIF:
             if campo in data:
-                valor = data[campo]
-                if isinstance(valor, dict):
-                    valor = json.dumps(valor)
-                setattr(avaliacao, campo, valor)
+                setattr(avaliacao, campo, data[campo])
         
         if 'data_avaliacao' in data:
             try:
@@ -200,35 +170,199 @@ def delete_avaliacao(avaliacao_id):
 
 @avaliacao_bp.route('/avaliacoes/<int:avaliacao_id>/anexos', methods=['POST'])
 def upload_anexo_avaliacao(avaliacao_id):
-    """Upload de anexo para avaliação"""
+    """Iniciar upload de anexo em partes; o conteúdo segue por PUT em /anexos/uploads/<upload_id>"""
     try:
-        avaliacao = Avaliacao.query.get_or_404(avaliacao_id)
-        
-        # TODO: Implementar upload real para S3
-        # Por enquanto, simular o upload
+        Avaliacao.query.get_or_404(avaliacao_id)
         data = request.json
         
         if not data.get('nome_arquivo'):
             return jsonify({'erro': 'Nome do arquivo é obrigatório'}), 400
         
-        anexo = AnexoAvaliacao(
-            avaliacao_id=avaliacao_id,
-            nome_arquivo=data['nome_arquivo'],
+        tamanho_bytes = data.get('tamanho_bytes')
+        if not isinstance(tamanho_bytes, int) or isinstance(tamanho_bytes, bool) or tamanho_bytes < 0:
+            return jsonify({'erro': 'tamanho_bytes deve ser um inteiro não negativo'}), 400
+        
+        upload = UploadAnexoService.iniciar(
+            avaliacao_id,
+            data['nome_arquivo'],
+            tamanho_bytes,
             tipo_arquivo=data.get('tipo_arquivo'),
-            tamanho_bytes=data.get('tamanho_bytes'),
-            url_arquivo=data.get('url_arquivo'),
             categoria=data.get('categoria')
         )
         
-        db.session.add(anexo)
+        # Arquivo vazio não tem partes: o anexo é criado imediatamente
+        if tamanho_bytes == 0:
+            anexo = UploadAnexoService.concluir(upload)
+            db.session.commit()
+            return jsonify(anexo.to_dict()), 201
+        
         db.session.commit()
+        return jsonify(upload.to_dict()), 201
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'erro': str(e)}), 500
+
+def _obter_upload(avaliacao_id, upload_id):
+    return UploadAnexo.query.filter_by(id=upload_id, avaliacao_id=avaliacao_id).first_or_404()
+
+@avaliacao_bp.route('/avaliacoes/<int:avaliacao_id>/anexos/uploads/<upload_id>', methods=['GET'])
+def get_upload_anexo(avaliacao_id, upload_id):
+    """Estado do upload, para retomar a partir dos bytes já recebidos"""
+    return jsonify(_obter_upload(avaliacao_id, upload_id).to_dict())
+
+@avaliacao_bp.route('/avaliacoes/<int:avaliacao_id>/anexos/uploads/<upload_id>', methods=['PUT'])
+def enviar_parte_anexo(avaliacao_id, upload_id):
+    """Receber uma parte do arquivo (Content-Range: bytes inicio-fim/total), gravada em disco por blocos"""
+    try:
+        upload = _obter_upload(avaliacao_id, upload_id)
+        
+        intervalo = parse_content_range_header(request.headers.get('Content-Range'))
+        if intervalo is None or intervalo.units != 'bytes' or intervalo.start is None:
+            return jsonify({'erro': 'Cabeçalho Content-Range obrigatório (bytes inicio-fim/total)'}), 400
+        if intervalo.length != upload.tamanho_bytes:
+            return jsonify({'erro': 'Tamanho total difere do informado ao iniciar o upload'}), 400
+        tamanho_parte = intervalo.stop - intervalo.start
+        if request.content_length is not None and request.content_length != tamanho_parte:
+            return jsonify({'erro': 'Corpo difere do intervalo informado'}), 400
+        
+        try:
+            anexo = UploadAnexoService.receber(upload, intervalo.start, request.stream, tamanho_parte)
+        except ParteInvalida as e:
+            db.session.rollback()
+            # 409 com a posição esperada, para o cliente retomar dali
+            return jsonify({'erro': str(e), 'recebidos': upload.recebidos}), 409
+        except UploadOcupado as e:
+            db.session.rollback()
+            return jsonify({'erro': str(e)}), 409
+        
+        if anexo is None:
+            recebidos = upload.recebidos
+            db.session.commit()
+            return jsonify({'upload_id': upload_id, 'recebidos': recebidos, 'tamanho_bytes': upload.tamanho_bytes})
         
+        db.session.commit()
         return jsonify(anexo.to_dict()), 201
     
+    except HTTPException:
+        raise
     except Exception as e:
         db.session.rollback()
         return jsonify({'erro': str(e)}), 500
 
+@avaliacao_bp.route('/avaliacoes/<int:avaliacao_id>/anexos/uploads/<upload_id>', methods=['DELETE'])
+def cancelar_upload_anexo(avaliacao_id, upload_id):
+    """Cancelar upload em andamento e apagar o arquivo parcial"""
+    try:
+        UploadAnexoService.cancelar(_obter_upload(avaliacao_id, upload_id))
+        db.session.commit()
+        
+        return jsonify({'mensagem': 'Upload cancelado'}), 200
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'erro': str(e)}), 500
+
+# O conteúdo de um hash nunca muda: o navegador reutiliza a cópia sem revalidar.
+# Privado porque são dados de saúde (não deve ficar em caches compartilhados)
+CACHE_ANEXOS = 'private, max-age=31536000, immutable'
+
+def _nome_download(nome_arquivo):
+    """Parâmetros de Content-Disposition como o send_file monta (filename* para nomes não ASCII)"""
+    try:
+        nome_arquivo.encode('ascii')
+        return {'filename': nome_arquivo}
+    except UnicodeEncodeError:
+        return {
+            'filename': unicodedata.normalize('NFKD', nome_arquivo).encode('ascii', 'ignore').decode('ascii'),
+            'filename*': f"UTF-8''{quote(nome_arquivo, safe='!#$&+-.^_`|~')}"
+        }
+
+def _exibivel(mimetype):
+    """Tipos abertos no navegador; os demais são baixados (o tipo vem do cliente)"""
+    # SVG é imagem, mas pode conter scripts
+    if mimetype == 'image/svg+xml':
+        return False
+    return mimetype == 'application/pdf' or mimetype.split('/')[0] in ('image', 'video', 'audio')
+
+def _enviar_objeto(chave, etag, mimetype, nome_arquivo):
+    """Arquivo do armazenamento de anexos, com Range e ETag forte; o envio fica com o servidor web"""
+    inline = _exibivel(mimetype)
+    if not inline:
+        mimetype = 'application/octet-stream'
+    prefixo = current_app.config.get('ANEXOS_X_ACCEL_REDIRECT')
+    if prefixo:
+        # nginx entrega o arquivo de uma location internal (com sendfile e Range);
+        # a revalidação por ETag é respondida aqui, sem chegar ao arquivo
+        response = current_app.response_class(mimetype=mimetype)
+        response.set_etag(etag)
+        response.make_conditional(request)
+        if response.status_code != 304:
+            response.headers['X-Accel-Redirect'] = prefixo.rstrip('/') + '/' + chave
+            response.headers.set('Content-Disposition', 'inline' if inline else 'attachment',
+                                 **_nome_download(nome_arquivo))
+    else:
+        # Sem nginx: X-Sendfile (USE_X_SENDFILE) ou wsgi.file_wrapper, que o
+        # gunicorn envia com sendfile(); Range e If-None-Match tratados pelo Werkzeug
+        response = send_file(
+            os.path.join(ArmazenamentoAnexos.raiz(), *chave.split('/')),
+            mimetype=mimetype,
+            as_attachment=not inline,
+            download_name=nome_arquivo,
+            conditional=True,
+            etag=etag,
+            max_age=None
+        )
+    
+    # Anunciado também na resposta completa, para o player de vídeo pedir trechos
+    response.accept_ranges = 'bytes'
+    response.headers['Cache-Control'] = CACHE_ANEXOS
+    # Conteúdo enviado por usuários: sem adivinhação de tipo e sem scripts na origem da aplicação
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+    response.headers['Content-Security-Policy'] = 'sandbox'
+    return response
+
+@avaliacao_bp.route('/avaliacoes/<int:avaliacao_id>/anexos/<int:anexo_id>/arquivo', methods=['GET'])
+def download_anexo_avaliacao(avaliacao_id, anexo_id):
+    """Conteúdo do anexo, com ETag do hash SHA-256"""
+    try:
+        anexo = AnexoAvaliacao.query.filter_by(id=anexo_id, avaliacao_id=avaliacao_id).first_or_404()
+        if not anexo.sha256:
+            return jsonify({'erro': 'Anexo sem conteúdo armazenado'}), 404
+        
+        if anexo.tipo_arquivo and '/' in anexo.tipo_arquivo:
+            mimetype = anexo.tipo_arquivo
+        else:
+            mimetype = mimetypes.guess_type(anexo.nome_arquivo)[0] or 'application/octet-stream'
+        
+        return _enviar_objeto(ArmazenamentoAnexos.chave(anexo.sha256), anexo.sha256, mimetype, anexo.nome_arquivo)
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        return jsonify({'erro': str(e)}), 500
+
+@avaliacao_bp.route('/avaliacoes/<int:avaliacao_id>/anexos/<int:anexo_id>/arquivo/<tipo>', methods=['GET'])
+def download_derivado_anexo(avaliacao_id, anexo_id, tipo):
+    """Miniatura ou prévia (JPEG) do anexo"""
+    try:
+        anexo = AnexoAvaliacao.query.filter_by(id=anexo_id, avaliacao_id=avaliacao_id).first_or_404()
+        if not anexo.objeto or tipo not in (anexo.objeto.derivados or {}):
+            return jsonify({'erro': 'Prévia não disponível'}), 404
+        
+        nome = f'{os.path.splitext(anexo.nome_arquivo)[0]}.{tipo}.jpg'
+        return _enviar_objeto(ArmazenamentoAnexos.chave_derivado(anexo.sha256, tipo),
+                              f'{anexo.sha256}.{tipo}', 'image/jpeg', nome)
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        return jsonify({'erro': str(e)}), 500
+
 @avaliacao_bp.route('/avaliacoes/<int:avaliacao_id>/anexos/<int:anexo_id>', methods=['DELETE'])
 def delete_anexo_avaliacao(avaliacao_id, anexo_id):
     """Excluir anexo de avaliação"""
@@ -238,8 +372,7 @@ def delete_anexo_avaliacao(avaliacao_id, anexo_id):
             avaliacao_id=avaliacao_id
         ).first_or_404()
         
-        # TODO: Excluir arquivo do S3
-        
+        # O conteúdo é apagado após o commit se nenhum outro anexo o referenciar
         db.session.delete(anexo)
         db.session.commit()
         
@@ -0,0 +1,31 @@
+from flask import Blueprint, jsonify, request
+from src.models.fisio_models import db
+from src.auth.auth_service import token_required
+from src.busca.busca_clinica_service import BuscaClinicaService
+from src.busca.busca_service import BuscaPacienteService
+from src.utils.paginacao import obter_limite
+
+busca_bp = Blueprint('busca', __name__)
+
+@busca_bp.route('/busca/clinica', methods=['GET'])
+@token_required
+def buscar_notas_clinicas():
+    """Buscar termos nas avaliações e evoluções dos pacientes do fisioterapeuta autenticado"""
+    try:
+        termo = request.args.get('q', '').strip()
+        limite = obter_limite(request.args.get('limit', 20, type=int))
+        
+        if not termo:
+            return jsonify({'erro': 'Parâmetro q é obrigatório'}), 400
+        
+        if not BuscaPacienteService.disponivel(db.engine):
+            return jsonify({'erro': 'Busca indexada indisponível neste banco de dados'}), 501
+        
+        resultados = BuscaClinicaService.buscar(termo, request.current_fisioterapeuta.id, limite=limite)
+        for posicao, resultado in enumerate(resultados, start=1):
+            resultado['posicao'] = posicao
+        
+        return jsonify({'resultados': resultados, 'total': len(resultados)})
+    
+    except Exception as e:
+        return jsonify({'erro': str(e)}), 500
@@ -0,0 +1,99 @@
+from datetime import datetime
+from flask import Blueprint, jsonify, request
+from src.auth.auth_service import token_required
+from src.cif.indice_cif_service import IndiceCifService
+from src.cif.registro_cif import REGISTRO_CIF
+from src.utils.paginacao import CursorInvalido, codificar_cursor, decodificar_cursor, obter_limite
+
+cif_bp = Blueprint('cif', __name__)
+
+@cif_bp.route('/cif/codigos', methods=['GET'])
+def get_codigos_cif():
+    """Autocompletar códigos da CIF pelo prefixo (consulta apenas o registro em memória)"""
+    prefixo = request.args.get('prefixo', '').strip().lower()
+    limite = obter_limite(request.args.get('limit', 20, type=int))
+    
+    if not prefixo:
+        return jsonify({'erro': 'Parâmetro prefixo é obrigatório'}), 400
+    
+    codigos, total = REGISTRO_CIF.buscar_prefixo(prefixo, limite)
+    return jsonify({'codigos': codigos, 'total': total})
+
+@cif_bp.route('/cif/codigos/<codigo>', methods=['GET'])
+def get_codigo_cif(codigo):
+    """Código da CIF com seus ancestrais e filhos diretos"""
+    codigo = codigo.strip().lower()
+    if codigo not in REGISTRO_CIF:
+        return jsonify({'erro': 'Código não encontrado'}), 404
+    
+    return jsonify({
+        **REGISTRO_CIF.item(codigo),
+        'ancestrais': [REGISTRO_CIF.item(item) for item in REGISTRO_CIF.ancestrais(codigo)],
+        'filhos': [REGISTRO_CIF.item(item) for item in REGISTRO_CIF.filhos(codigo)]
+    })
+
+def _ler_condicao(texto):
+    """Condição `codigo[:min[:max]]` (ex.: b280:3, d450::1, b280:2:3) como (codigo, min, max)"""
+    codigo, *faixa = texto.strip().lower().split(':')
+    if not codigo or len(faixa) > 2:
+        raise ValueError(texto)
+    faixa = [int(valor) if valor != '' else None for valor in faixa] + [None] * (2 - len(faixa))
+    return (codigo, *faixa)
+
+@cif_bp.route('/cif/coorte', methods=['GET'])
+@token_required
+def get_coorte_cif():
+    """Pacientes do fisioterapeuta autenticado que atendem a todas as condições de código da CIF"""
+    try:
+        limite = obter_limite(request.args.get('limit', type=int))
+        cursor = request.args.get('cursor')
+        
+        # `codigo` repetível, com faixa opcional (codigo:min:max); qualificador_min e
+        # qualificador_max valem para o primeiro código quando ele não traz faixa própria
+        try:
+            condicoes = [_ler_condicao(texto) for texto in request.args.getlist('codigo') if texto.strip()]
+        except ValueError:
+            return jsonify({'erro': 'Condição inválida; use codigo:min:max'}), 400
+        if not condicoes:
+            return jsonify({'erro': 'Parâmetro codigo é obrigatório'}), 400
+        codigo, qualificador_min, qualificador_max = condicoes[0]
+        if qualificador_min is None and qualificador_max is None:
+            condicoes[0] = (codigo, request.args.get('qualificador_min', type=int),
+                            request.args.get('qualificador_max', type=int))
+        
+        try:
+            inicio = datetime.fromisoformat(request.args['data_inicio']) if request.args.get('data_inicio') else None
+            fim = datetime.fromisoformat(request.args['data_fim']) if request.args.get('data_fim') else None
+        except ValueError:
+            return jsonify({'erro': 'Formato de data inválido'}), 400
+        
+        apos = None
+        if cursor:
+            try:
+                apos, = decodificar_cursor(cursor, 1)
+            except CursorInvalido as e:
+                return jsonify({'erro': str(e)}), 400
+            if not isinstance(apos, int):
+                return jsonify({'erro': 'Cursor inválido'}), 400
+        
+        # Lido apenas do índice avaliacoes_cif, sem abrir os documentos JSON
+        pacientes, tem_mais = IndiceCifService.coorte(
+            request.current_fisioterapeuta.id, condicoes,
+            inicio=inicio,
+            fim=fim,
+            apos=apos,
+            limite=limite
+        )
+        
+        return jsonify({
+            'condicoes': [
+                {'codigo': codigo, 'qualificador_min': minimo, 'qualificador_max': maximo}
+                for codigo, minimo, maximo in condicoes
+            ],
+            'pacientes': pacientes,
+            'next_cursor': codificar_cursor([pacientes[-1]['paciente_id']]) if tem_mais else None,
+            'limit': limite
+        })
+    
+    except Exception as e:
+        return jsonify({'erro': str(e)}), 500
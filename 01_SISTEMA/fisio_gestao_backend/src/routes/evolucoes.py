@@ -1,17 +1,110 @@
 from flask import Blueprint, jsonify, request
+from sqlalchemy import delete, insert, select, tuple_, update
+from sqlalchemy.orm import joinedload, selectinload
 from src.models.fisio_models import Evolucao, Paciente, Avaliacao, ProcedimentoEvolucao, Procedimento, db
+from src.utils.paginacao import CursorInvalido, codificar_cursor, decodificar_cursor, obter_limite
 from datetime import datetime
 
 evolucao_bp = Blueprint('evolucao', __name__)
 
+class ProcedimentoInvalido(ValueError):
+    """Id de procedimento que não é um inteiro"""
+
+def _id_procedimento(valor):
+    """Converter o id recebido (número ou texto numérico) em int"""
+    if isinstance(valor, bool) or (isinstance(valor, float) and not valor.is_integer()):
+        raise ProcedimentoInvalido(f'Id de procedimento inválido: {valor!r}')
+    try:
+        return int(valor)
+    except (TypeError, ValueError):
+        raise ProcedimentoInvalido(f'Id de procedimento inválido: {valor!r}') from None
+
+def _ler_procedimentos(procedimentos_ids):
+    """Normalizar procedimentos_ids em {procedimento_id: observacoes}, só com procedimentos existentes"""
+    pedidos = {}
+    for proc_data in procedimentos_ids or []:
+        if isinstance(proc_data, dict):
+            procedimento_id = proc_data.get('procedimento_id')
+            observacoes_proc = proc_data.get('observacoes', '')
+        else:
+            procedimento_id = proc_data
+            observacoes_proc = ''
+        
+        if procedimento_id not in (None, ''):
+            pedidos[_id_procedimento(procedimento_id)] = observacoes_proc
+    
+    if not pedidos:
+        return {}
+    
+    # Uma única consulta IN para todos os ids; inexistentes são ignorados
+    existentes = set(db.session.execute(
+        select(Procedimento.id).where(Procedimento.id.in_(list(pedidos)))
+    ).scalars())
+    return {procedimento_id: observacoes for procedimento_id, observacoes in pedidos.items()
+            if procedimento_id in existentes}
+
+def _sincronizar_procedimentos(evolucao_id, pedidos, atuais=()):
+    """Aplicar a diferença entre os vínculos atuais e os pedidos (um comando por tipo de alteração)"""
+    # Vínculos repetidos do mesmo procedimento (gravados antes da sincronização por diferença):
+    # mantém o mais antigo e remove os demais
+    mantidos = {}
+    removidos = []
+    for linha in sorted(atuais, key=lambda linha: linha.id):
+        if linha.procedimento_id in pedidos and linha.procedimento_id not in mantidos:
+            mantidos[linha.procedimento_id] = linha
+        else:
+            removidos.append(linha.id)
+    atuais = mantidos
+    
+    if removidos:
+        db.session.execute(
+            delete(ProcedimentoEvolucao)
+            .where(ProcedimentoEvolucao.id.in_(removidos))
+            .execution_options(synchronize_session=False)
+        )
+    
+    alterados = [
+        {'id': atuais[procedimento_id].id, 'observacoes': observacoes}
+        for procedimento_id, observacoes in pedidos.items()
+        if procedimento_id in atuais and atuais[procedimento_id].observacoes != observacoes
+    ]
+    if alterados:
+        db.session.execute(update(ProcedimentoEvolucao), alterados)
+    
+    novos = [
+        {'evolucao_id': evolucao_id, 'procedimento_id': procedimento_id, 'observacoes': observacoes}
+        for procedimento_id, observacoes in pedidos.items()
+        if procedimento_id not in atuais
+    ]
+    if novos:
+        db.session.execute(insert(ProcedimentoEvolucao), novos)
+
+def _evolucao_dict(evolucao):
+    """Evolução com seus procedimentos, carregados com o catálogo em uma consulta"""
+    evolucao_dict = evolucao.to_dict()
+    vinculos = (
+        ProcedimentoEvolucao.query
+        .options(joinedload(ProcedimentoEvolucao.procedimento))
+        .filter(ProcedimentoEvolucao.evolucao_id == evolucao.id)
+        .order_by(ProcedimentoEvolucao.id)
+        .all()
+    )
+    evolucao_dict['procedimentos'] = [proc.to_dict() for proc in vinculos]
+    return evolucao_dict
+
 @evolucao_bp.route('/evolucoes', methods=['GET'])
 def get_evolucoes():
-    """Listar evoluções com filtros opcionais"""
+    """Listar evoluções com filtros opcionais e paginação por cursor"""
     try:
         paciente_id = request.args.get('paciente_id', type=int)
         avaliacao_id = request.args.get('avaliacao_id', type=int)
+        limite = obter_limite(request.args.get('limit', type=int))
+        cursor = request.args.get('cursor')
         
-        query = Evolucao.query
+        # Procedimentos e catálogo em uma consulta IN cada, qualquer que seja o tamanho da página
+        query = Evolucao.query.options(
+            selectinload(Evolucao.procedimentos).selectinload(ProcedimentoEvolucao.procedimento)
+        )
         
         if paciente_id:
             query = query.filter(Evolucao.paciente_id == paciente_id)
@@ -19,16 +112,44 @@ def get_evolucoes():
         if avaliacao_id:
             query = query.filter(Evolucao.avaliacao_id == avaliacao_id)
         
-        evolucoes = query.order_by(Evolucao.data_sessao.desc()).all()
+        if cursor:
+            try:
+                ultima_data, ultimo_id = decodificar_cursor(cursor, 2)
+                ultima_data = datetime.fromisoformat(ultima_data)
+            except (CursorInvalido, TypeError, ValueError):
+                return jsonify({'erro': 'Cursor inválido'}), 400
+            query = query.filter(
+                tuple_(Evolucao.data_sessao, Evolucao.id) < tuple_(ultima_data, ultimo_id)
+            )
+        
+        # Buscar um registro a mais para saber se existe próxima página
+        evolucoes = query.order_by(Evolucao.data_sessao.desc(), Evolucao.id.desc()).limit(limite + 1).all()
+        
+        next_cursor = None
+        if len(evolucoes) > limite:
+            evolucoes = evolucoes[:limite]
+            ultima = evolucoes[-1]
+            next_cursor = codificar_cursor([ultima.data_sessao, ultima.id])
         
-        # Incluir procedimentos nas evoluções
+        # Incluir procedimentos nas evoluções; o catálogo vai uma vez por procedimento
         evolucoes_dict = []
+        catalogo = {}
         for evolucao in evolucoes:
             evolucao_dict = evolucao.to_dict()
-            evolucao_dict['procedimentos'] = [proc.to_dict() for proc in evolucao.procedimentos]
+            evolucao_dict['procedimentos'] = [
+                proc.to_dict(incluir_procedimento=False) for proc in evolucao.procedimentos
+            ]
+            for proc in evolucao.procedimentos:
+                if proc.procedimento and proc.procedimento_id not in catalogo:
+                    catalogo[proc.procedimento_id] = proc.procedimento.to_dict()
             evolucoes_dict.append(evolucao_dict)
         
-        return jsonify(evolucoes_dict)
+        return jsonify({
+            'evolucoes': evolucoes_dict,
+            'procedimentos': {str(procedimento_id): dados for procedimento_id, dados in catalogo.items()},
+            'next_cursor': next_cursor,
+            'limit': limite
+        })
     
     except Exception as e:
         return jsonify({'erro': str(e)}), 500
@@ -63,6 +184,11 @@ def create_evolucao():
         except ValueError:
             return jsonify({'erro': 'Formato de data inválido'}), 400
         
+        try:
+            pedidos = _ler_procedimentos(data.get('procedimentos_ids', []))
+        except ProcedimentoInvalido as e:
+            return jsonify({'erro': str(e)}), 400
+        
         evolucao = Evolucao(
             paciente_id=data['paciente_id'],
             avaliacao_id=data.get('avaliacao_id'),
@@ -77,31 +203,12 @@ def create_evolucao():
         db.session.flush()  # Para obter o ID da evolução
         
         # Adicionar procedimentos se fornecidos
-        procedimentos_ids = data.get('procedimentos_ids', [])
-        for proc_data in procedimentos_ids:
-            if isinstance(proc_data, dict):
-                procedimento_id = proc_data.get('procedimento_id')
-                observacoes_proc = proc_data.get('observacoes', '')
-            else:
-                procedimento_id = proc_data
-                observacoes_proc = ''
-            
-            if procedimento_id:
-                # Verificar se o procedimento existe
-                procedimento = Procedimento.query.get(procedimento_id)
-                if procedimento:
-                    proc_evolucao = ProcedimentoEvolucao(
-                        evolucao_id=evolucao.id,
-                        procedimento_id=procedimento_id,
-                        observacoes=observacoes_proc
-                    )
-                    db.session.add(proc_evolucao)
+        _sincronizar_procedimentos(evolucao.id, pedidos)
         
         db.session.commit()
         
         # Retornar evolução com procedimentos
-        evolucao_dict = evolucao.to_dict()
-        evolucao_dict['procedimentos'] = [proc.to_dict() for proc in evolucao.procedimentos]
+        evolucao_dict = _evolucao_dict(evolucao)
         
         return jsonify(evolucao_dict), 201
     
@@ -116,10 +223,7 @@ def get_evolucao(evolucao_id):
         evolucao = Evolucao.query.get_or_404(evolucao_id)
         
         # Incluir procedimentos na resposta
-        evolucao_dict = evolucao.to_dict()
-        evolucao_dict['procedimentos'] = [proc.to_dict() for proc in evolucao.procedimentos]
-        
-        return jsonify(evolucao_dict)
+        return jsonify(_evolucao_dict(evolucao))
     
     except Exception as e:
         return jsonify({'erro': str(e)}), 500
@@ -153,39 +257,24 @@ def update_evolucao(evolucao_id):
         if 'avaliacao_id' in data:
             evolucao.avaliacao_id = data['avaliacao_id']
         
-        # Atualizar procedimentos se fornecidos
+        # Atualizar procedimentos se fornecidos: só vínculos incluídos, removidos ou alterados
         if 'procedimentos_ids' in data:
-            # Remover procedimentos existentes
-            ProcedimentoEvolucao.query.filter_by(evolucao_id=evolucao_id).delete()
-            
-            # Adicionar novos procedimentos
-            procedimentos_ids = data['procedimentos_ids']
-            for proc_data in procedimentos_ids:
-                if isinstance(proc_data, dict):
-                    procedimento_id = proc_data.get('procedimento_id')
-                    observacoes_proc = proc_data.get('observacoes', '')
-                else:
-                    procedimento_id = proc_data
-                    observacoes_proc = ''
-                
-                if procedimento_id:
-                    procedimento = Procedimento.query.get(procedimento_id)
-                    if procedimento:
-                        proc_evolucao = ProcedimentoEvolucao(
-                            evolucao_id=evolucao_id,
-                            procedimento_id=procedimento_id,
-                            observacoes=observacoes_proc
-                        )
-                        db.session.add(proc_evolucao)
+            try:
+                pedidos = _ler_procedimentos(data['procedimentos_ids'])
+            except ProcedimentoInvalido as e:
+                db.session.rollback()
+                return jsonify({'erro': str(e)}), 400
+            atuais = db.session.execute(
+                select(ProcedimentoEvolucao.id, ProcedimentoEvolucao.procedimento_id, ProcedimentoEvolucao.observacoes)
+                .where(ProcedimentoEvolucao.evolucao_id == evolucao_id)
+            ).all()
+            _sincronizar_procedimentos(evolucao_id, pedidos, atuais)
         
         evolucao.data_atualizacao = datetime.utcnow()
         db.session.commit()
         
         # Retornar evolução atualizada com procedimentos
-        evolucao_dict = evolucao.to_dict()
-        evolucao_dict['procedimentos'] = [proc.to_dict() for proc in evolucao.procedimentos]
-        
-        return jsonify(evolucao_dict)
+        return jsonify(_evolucao_dict(evolucao))
     
     except Exception as e:
         db.session.rollback()
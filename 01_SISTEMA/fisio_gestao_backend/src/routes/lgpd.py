@@ -4,7 +4,7 @@ import json
 import io
 import csv
 from src.models.fisio_models import Paciente, Avaliacao, Evolucao, Agendamento, db
-from src.audit.audit_service import AuditoriaService
+from src.audit.audit_service import AuditoriaService, LogAuditoria
 from src.auth.auth_service import token_required
 
 lgpd_bp = Blueprint('lgpd', __name__)
@@ -1,21 +1,58 @@
-from flask import Blueprint, jsonify, request
-from src.models.fisio_models import Paciente, db
+from flask import Blueprint, abort, current_app, jsonify, request, stream_with_context
+from werkzeug.exceptions import HTTPException
+from sqlalchemy import tuple_
+from src.models.fisio_models import Fisioterapeuta, Paciente, db
+from src.audit.audit_service import AuditoriaService
+from src.busca.busca_service import BuscaPacienteService
+from src.cache.prontuario_cache import ProntuarioCache
+from src.prontuario.prontuario_service import ProntuarioService
+from src.prontuario.linha_do_tempo import LinhaDoTempoService
+from src.utils.paginacao import (
+    CursorInvalido, codificar_cursor, decodificar_cursor, obter_limite, serializar_valor
+)
 from datetime import datetime
+import csv
+import io
+import json
 
 paciente_bp = Blueprint('paciente', __name__)
 
+def _parametro_booleano(nome):
+    """Ler parâmetro booleano da query string ('true'/'false', '1'/'0')"""
+    valor = request.args.get(nome)
+    if valor is None or valor == '':
+        return None
+    return valor.lower() in ('true', '1', 'sim')
+
 @paciente_bp.route('/pacientes', methods=['GET'])
 def get_pacientes():
-    """Listar pacientes com filtros opcionais"""
+    """Listar pacientes com filtros opcionais e paginação por cursor"""
     try:
         # Parâmetros de filtro
-        ativo = request.args.get('ativo', type=bool)
-        arquivado = request.args.get('arquivado', type=bool)
+        ativo = _parametro_booleano('ativo')
+        arquivado = _parametro_booleano('arquivado')
         fisioterapeuta_id = request.args.get('fisioterapeuta_id', type=int)
         nome = request.args.get('nome', '')
         
-        # Construir query
-        query = Paciente.query
+        # Parâmetros de paginação e projeção
+        limite = obter_limite(request.args.get('limit', type=int))
+        cursor = request.args.get('cursor')
+        fields = request.args.get('fields')
+        
+        if fields:
+            campos = [campo.strip() for campo in fields.split(',') if campo.strip()]
+            invalidos = [campo for campo in campos if campo not in Paciente.CAMPOS_PUBLICOS]
+            if invalidos:
+                return jsonify({'erro': f'Campos inválidos: {", ".join(invalidos)}'}), 400
+            # id e nome_completo compõem a chave do cursor
+            for campo in ('nome_completo', 'id'):
+                if campo not in campos:
+                    campos.insert(0, campo)
+        else:
+            campos = list(Paciente.CAMPOS_PUBLICOS)
+        
+        # Construir query apenas com as colunas solicitadas
+        query = db.session.query(*[getattr(Paciente, campo) for campo in campos])
         
         if ativo is not None:
             query = query.filter(Paciente.ativo == ativo)
@@ -27,59 +64,238 @@ def get_pacientes():
             query = query.filter(Paciente.fisioterapeuta_id == fisioterapeuta_id)
         
         if nome:
-            query = query.filter(Paciente.nome_completo.ilike(f'%{nome}%'))
+            if BuscaPacienteService.disponivel(db.engine):
+                query = query.filter(Paciente.id.in_(BuscaPacienteService.filtro_ids(nome)))
+            else:
+                query = query.filter(Paciente.nome_completo.ilike(f'%{nome}%'))
+        
+        if cursor:
+            try:
+                ultimo_nome, ultimo_id = decodificar_cursor(cursor, 2)
+            except CursorInvalido as e:
+                return jsonify({'erro': str(e)}), 400
+            query = query.filter(
+                tuple_(Paciente.nome_completo, Paciente.id) > tuple_(ultimo_nome, ultimo_id)
+            )
         
-        pacientes = query.all()
-        return jsonify([paciente.to_dict() for paciente in pacientes])
+        # Buscar um registro a mais para saber se existe próxima página
+        linhas = query.order_by(Paciente.nome_completo, Paciente.id).limit(limite + 1).all()
+        
+        next_cursor = None
+        if len(linhas) > limite:
+            linhas = linhas[:limite]
+            ultima = linhas[-1]
+            next_cursor = codificar_cursor([ultima.nome_completo, ultima.id])
+        
+        pacientes = [
+            {campo: serializar_valor(valor) for campo, valor in zip(campos, linha)}
+            for linha in linhas
+        ]
+        
+        return jsonify({
+            'pacientes': pacientes,
+            'next_cursor': next_cursor,
+            'limit': limite
+        })
     
     except Exception as e:
         return jsonify({'erro': str(e)}), 500
 
+@paciente_bp.route('/pacientes/busca', methods=['GET'])
+def buscar_pacientes():
+    """Buscar pacientes por nome com ranking de relevância"""
+    try:
+        termo = request.args.get('q', '').strip()
+        limite = obter_limite(request.args.get('limit', 20, type=int))
+        fisioterapeuta_id = request.args.get('fisioterapeuta_id', type=int)
+        
+        if not termo:
+            return jsonify({'erro': 'Parâmetro q é obrigatório'}), 400
+        
+        if not BuscaPacienteService.disponivel(db.engine):
+            return jsonify({'erro': 'Busca indexada indisponível neste banco de dados'}), 501
+        
+        resultados = BuscaPacienteService.buscar(
+            termo,
+            limite=limite,
+            fisioterapeuta_id=fisioterapeuta_id,
+            apenas_ativos=True
+        )
+        
+        pacientes = [
+            {
+                'id': resultado.id,
+                'nome_completo': resultado.nome_completo,
+                'data_nascimento': serializar_valor(resultado.data_nascimento),
+                'telefone': resultado.telefone,
+                'posicao': posicao,
+                'correspondencia': 'prefixo' if resultado.grupo == 0 else 'parcial'
+            }
+            for posicao, resultado in enumerate(resultados, start=1)
+        ]
+        
+        return jsonify({'pacientes': pacientes, 'total': len(pacientes)})
+    
+    except Exception as e:
+        return jsonify({'erro': str(e)}), 500
+
+# Campos aceitos no cadastro de pacientes (além da data de nascimento)
+CAMPOS_CADASTRO = (
+    'nome_completo', 'naturalidade', 'estado_civil', 'genero', 'local_nascimento',
+    'profissao', 'endereco_residencial', 'endereco_comercial', 'telefone', 'email',
+    'fisioterapeuta_id'
+)
+
+# Linhas inseridas por comando/transação na importação em lote
+LOTE_IMPORTACAO = 1000
+
+# Máximo de erros detalhados no relatório de importação
+MAX_ERROS_RELATORIO = 1000
+
+def _validar_paciente(data):
+    """Validar dados de cadastro; retorna (valores, mensagem de erro)"""
+    # Validações obrigatórias
+    if not data.get('nome_completo'):
+        return None, 'Nome completo é obrigatório'
+    
+    if not data.get('data_nascimento'):
+        return None, 'Data de nascimento é obrigatória'
+    
+    if not data.get('fisioterapeuta_id'):
+        return None, 'Fisioterapeuta é obrigatório'
+    
+    # Converter data de nascimento
+    try:
+        data_nascimento = datetime.strptime(data['data_nascimento'], '%Y-%m-%d').date()
+    except (TypeError, ValueError):
+        return None, 'Formato de data inválido. Use YYYY-MM-DD'
+    
+    valores = {campo: data.get(campo) or None for campo in CAMPOS_CADASTRO}
+    valores['nome_completo'] = data['nome_completo']
+    valores['data_nascimento'] = data_nascimento
+    try:
+        valores['fisioterapeuta_id'] = int(data['fisioterapeuta_id'])
+    except (TypeError, ValueError):
+        return None, 'Fisioterapeuta inválido'
+    
+    return valores, None
+
 @paciente_bp.route('/pacientes', methods=['POST'])
 def create_paciente():
     """Criar novo paciente"""
     try:
         data = request.json
         
-        # Validações obrigatórias
-        if not data.get('nome_completo'):
-            return jsonify({'erro': 'Nome completo é obrigatório'}), 400
+        valores, erro = _validar_paciente(data)
+        if erro:
+            return jsonify({'erro': erro}), 400
         
-        if not data.get('data_nascimento'):
-            return jsonify({'erro': 'Data de nascimento é obrigatória'}), 400
+        paciente = Paciente(**valores)
         
-        if not data.get('fisioterapeuta_id'):
-            return jsonify({'erro': 'Fisioterapeuta é obrigatório'}), 400
+        db.session.add(paciente)
+        db.session.commit()
         
-        # Converter data de nascimento
+        return jsonify(paciente.to_dict()), 201
+    
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'erro': str(e)}), 500
+
+def _ler_linhas_importacao(formato):
+    """Ler corpo da requisição linha a linha, sem carregar o arquivo inteiro"""
+    texto = io.TextIOWrapper(io.BufferedReader(request.stream), encoding='utf-8-sig', newline='')
+    
+    if formato == 'csv':
+        # Linha 1 é o cabeçalho
+        for numero, registro in enumerate(csv.DictReader(texto), start=2):
+            yield numero, registro, None
+        return
+    
+    for numero, linha in enumerate(texto, start=1):
+        if not linha.strip():
+            continue
         try:
-            data_nascimento = datetime.strptime(data['data_nascimento'], '%Y-%m-%d').date()
+            registro = json.loads(linha)
         except ValueError:
-            return jsonify({'erro': 'Formato de data inválido. Use YYYY-MM-DD'}), 400
-        
-        paciente = Paciente(
-            nome_completo=data['nome_completo'],
-            naturalidade=data.get('naturalidade'),
-            estado_civil=data.get('estado_civil'),
-            genero=data.get('genero'),
-            local_nascimento=data.get('local_nascimento'),
-            data_nascimento=data_nascimento,
-            profissao=data.get('profissao'),
-            endereco_residencial=data.get('endereco_residencial'),
-            endereco_comercial=data.get('endereco_comercial'),
-            telefone=data.get('telefone'),
-            email=data.get('email'),
-            fisioterapeuta_id=data['fisioterapeuta_id']
+            yield numero, None, 'JSON inválido'
+            continue
+        if not isinstance(registro, dict):
+            yield numero, None, 'Cada linha deve ser um objeto JSON'
+            continue
+        yield numero, registro, None
+
+def _inserir_lote(lote):
+    """Inserir lote em um único executemany e indexar nomes para busca"""
+    resultado = db.session.execute(
+        Paciente.__table__.insert().returning(Paciente.id, sort_by_parameter_order=True),
+        lote
+    )
+    ids = resultado.scalars().all()
+    if BuscaPacienteService.disponivel(db.engine):
+        BuscaPacienteService.indexar_lote(
+            db.session.connection(),
+            [(paciente_id, valores['nome_completo']) for paciente_id, valores in zip(ids, lote)]
         )
+    db.session.commit()
+    return len(ids)
+
+@paciente_bp.route('/pacientes/importar', methods=['POST'])
+def importar_pacientes():
+    """Importar pacientes em lote a partir de CSV ou NDJSON"""
+    importados = 0
+    try:
+        formato = request.args.get('formato')
+        if not formato:
+            formato = 'csv' if request.mimetype == 'text/csv' else 'ndjson'
+        if formato not in ('csv', 'ndjson'):
+            return jsonify({'erro': 'Formato inválido. Use csv ou ndjson'}), 400
         
-        db.session.add(paciente)
-        db.session.commit()
+        fisioterapeutas_ids = set(db.session.scalars(db.select(Fisioterapeuta.id)))
         
-        return jsonify(paciente.to_dict()), 201
+        total_linhas = 0
+        rejeitados = 0
+        erros = []
+        lote = []
+        
+        for numero, registro, erro in _ler_linhas_importacao(formato):
+            total_linhas += 1
+            if erro is None:
+                valores, erro = _validar_paciente(registro)
+                if erro is None and valores['fisioterapeuta_id'] not in fisioterapeutas_ids:
+                    erro = 'Fisioterapeuta não encontrado'
+            
+            if erro:
+                rejeitados += 1
+                if len(erros) < MAX_ERROS_RELATORIO:
+                    erros.append({'linha': numero, 'erro': erro})
+                continue
+            
+            lote.append(valores)
+            if len(lote) >= LOTE_IMPORTACAO:
+                importados += _inserir_lote(lote)
+                lote = []
+        
+        if lote:
+            importados += _inserir_lote(lote)
+        
+        AuditoriaService.log_acao(
+            acao='IMPORTACAO_PACIENTES',
+            tabela='pacientes',
+            observacoes=f'Formato: {formato}; importados: {importados}; rejeitados: {rejeitados}'
+        )
+        
+        return jsonify({
+            'total_linhas': total_linhas,
+            'importados': importados,
+            'rejeitados': rejeitados,
+            'erros': erros,
+            'erros_omitidos': rejeitados - len(erros)
+        }), 200 if importados or not rejeitados else 400
     
     except Exception as e:
         db.session.rollback()
-        return jsonify({'erro': str(e)}), 500
+        # Lotes anteriores já foram confirmados
+        return jsonify({'erro': str(e), 'importados': importados}), 500
 
 @paciente_bp.route('/pacientes/<int:paciente_id>', methods=['GET'])
 def get_paciente(paciente_id):
@@ -175,26 +391,69 @@ def arquivar_paciente(paciente_id):
         db.session.rollback()
         return jsonify({'erro': str(e)}), 500
 
-@paciente_bp.route('/pacientes/<int:paciente_id>/prontuario', methods=['GET'])
-def get_prontuario_paciente(paciente_id):
-    """Obter prontuário completo do paciente"""
+@paciente_bp.route('/pacientes/<int:paciente_id>/linha-do-tempo', methods=['GET'])
+def get_linha_do_tempo_paciente(paciente_id):
+    """Linha do tempo do paciente (avaliações, evoluções e agendamentos), paginada e em streaming"""
     try:
-        paciente = Paciente.query.get_or_404(paciente_id)
+        if db.session.get(Paciente, paciente_id) is None:
+            abort(404)
         
-        # Buscar todas as informações relacionadas
-        avaliacoes = [avaliacao.to_dict() for avaliacao in paciente.avaliacoes]
-        evolucoes = [evolucao.to_dict() for evolucao in paciente.evolucoes]
-        agendamentos = [agendamento.to_dict() for agendamento in paciente.agendamentos]
+        limite = obter_limite(request.args.get('limit', type=int))
+        cursor = request.args.get('cursor')
+        apos = None
+        if cursor:
+            try:
+                apos = LinhaDoTempoService.ler_cursor(decodificar_cursor(cursor, 3))
+            except CursorInvalido as e:
+                return jsonify({'erro': str(e)}), 400
         
-        prontuario = {
-            'paciente': paciente.to_dict(),
-            'avaliacoes': avaliacoes,
-            'evolucoes': evolucoes,
-            'agendamentos': agendamentos
-        }
+        def gerar():
+            # Um evento a mais indica se há próxima página; nada é acumulado além do evento atual
+            eventos = LinhaDoTempoService.eventos(paciente_id, apos, limite + 1)
+            yield '{"eventos":['
+            anterior = None
+            next_cursor = None
+            for indice, evento in enumerate(eventos):
+                if indice == limite:
+                    next_cursor = codificar_cursor(LinhaDoTempoService.cursor(anterior))
+                    break
+                yield (',' if indice else '') + json.dumps(LinhaDoTempoService.evento_dict(evento))
+                anterior = evento
+            yield '],' + json.dumps({'next_cursor': next_cursor, 'limit': limite})[1:]
         
-        return jsonify(prontuario)
+        return current_app.response_class(stream_with_context(gerar()), mimetype='application/json')
     
+    except HTTPException:
+        raise
     except Exception as e:
         return jsonify({'erro': str(e)}), 500
 
+@paciente_bp.route('/pacientes/<int:paciente_id>/prontuario', methods=['GET'])
+def get_prontuario_paciente(paciente_id):
+    """Obter prontuário completo do paciente (com cache e ETag)"""
+    try:
+        versao = ProntuarioCache.versao(paciente_id)
+        if versao is None:
+            abort(404)
+        
+        etag = ProntuarioCache.etag(paciente_id, versao)
+        if etag in request.if_none_match:
+            response = current_app.response_class(status=304)
+        else:
+            corpo = ProntuarioCache.obter(paciente_id, versao)
+            if corpo is None:
+                corpo = ProntuarioService.montar_json(paciente_id)
+                if corpo is None:
+                    abort(404)
+                ProntuarioCache.armazenar(paciente_id, versao, corpo)
+            response = current_app.response_class(corpo, mimetype='application/json')
+        
+        response.set_etag(etag)
+        # Dados de saúde: sempre revalidar e nunca armazenar em caches compartilhados
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        return jsonify({'erro': str(e)}), 500
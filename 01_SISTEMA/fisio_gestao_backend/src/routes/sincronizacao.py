@@ -0,0 +1,37 @@
+from flask import Blueprint, jsonify, request
+from src.auth.auth_service import token_required
+from src.sincronizacao.sincronizacao_service import SincronizacaoService
+from src.utils.paginacao import CursorInvalido, codificar_cursor, decodificar_cursor, obter_limite
+
+sincronizacao_bp = Blueprint('sincronizacao', __name__)
+
+@sincronizacao_bp.route('/sincronizacao/alteracoes', methods=['GET'])
+@token_required
+def get_alteracoes():
+    """Alterações nos registros do fisioterapeuta autenticado desde o cursor (sincronização incremental)"""
+    try:
+        limite = obter_limite(request.args.get('limit', 100, type=int))
+        cursor = request.args.get('cursor')
+        
+        apos = 0
+        if cursor:
+            try:
+                apos, = decodificar_cursor(cursor, 1)
+            except CursorInvalido as e:
+                return jsonify({'erro': str(e)}), 400
+            if not isinstance(apos, int):
+                return jsonify({'erro': 'Cursor inválido'}), 400
+        
+        itens, tem_mais = SincronizacaoService.alteracoes(request.current_fisioterapeuta.id, apos, limite)
+        
+        # Sempre devolver um cursor: sem alterações, o cliente continua de onde estava
+        posicao = itens[-1]['versao'] if itens else apos
+        return jsonify({
+            'alteracoes': itens,
+            'cursor': codificar_cursor([posicao]),
+            'tem_mais': tem_mais,
+            'limit': limite
+        })
+    
+    except Exception as e:
+        return jsonify({'erro': str(e)}), 500
@@ -0,0 +1,159 @@
+from datetime import datetime
+from sqlalchemy import DDL, event, func, select
+from src.models.fisio_models import Agendamento, Avaliacao, Evolucao, Paciente, db
+
+# Tabelas acompanhadas -> (tipo exposto no feed, modelo)
+TABELAS_SINCRONIZADAS = {
+    'pacientes': ('paciente', Paciente),
+    'avaliacoes': ('avaliacao', Avaliacao),
+    'evolucoes': ('evolucao', Evolucao),
+    'agendamentos': ('agendamento', Agendamento),
+}
+_AGORA = "datetime('now')"
+
+
+class LogAlteracao(db.Model):
+    """Registro de alterações para sincronização incremental (id crescente é a posição do feed)"""
+    __tablename__ = 'log_alteracoes'
+    __table_args__ = (
+        db.Index('ix_log_alteracoes_fisioterapeuta', 'fisioterapeuta_id', 'id'),
+        # AUTOINCREMENT: ids nunca são reaproveitados, mesmo após limpeza do log
+        {'sqlite_autoincrement': True},
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    tabela = db.Column(db.String(50), nullable=False)
+    registro_id = db.Column(db.Integer, nullable=False)
+    operacao = db.Column(db.String(10), nullable=False)  # insert, update, delete
+    fisioterapeuta_id = db.Column(db.Integer)  # dono do paciente no momento da alteração
+    data_hora = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'tabela': self.tabela,
+            'registro_id': self.registro_id,
+            'operacao': self.operacao,
+            'fisioterapeuta_id': self.fisioterapeuta_id,
+            'data_hora': self.data_hora.isoformat() if self.data_hora else None
+        }
+
+
+def _dono(tabela, linha):
+    if tabela == 'pacientes':
+        return f'{linha}.fisioterapeuta_id'
+    return f'(SELECT fisioterapeuta_id FROM pacientes WHERE id = {linha}.paciente_id)'
+
+
+def _registrar(tabela, operacao, linha):
+    return (
+        "INSERT INTO log_alteracoes (tabela, registro_id, operacao, fisioterapeuta_id, data_hora) "
+        f"VALUES ('{tabela}', {linha}.id, '{operacao}', {_dono(tabela, linha)}, {_AGORA});"
+    )
+
+
+def _gatilhos(tabela):
+    return (
+        f"""CREATE TRIGGER IF NOT EXISTS tg_{tabela}_log_insert
+        AFTER INSERT ON {tabela}
+        BEGIN {_registrar(tabela, 'insert', 'NEW')} END""",
+        f"""CREATE TRIGGER IF NOT EXISTS tg_{tabela}_log_update
+        AFTER UPDATE ON {tabela}
+        BEGIN {_registrar(tabela, 'update', 'NEW')} END""",
+        f"""CREATE TRIGGER IF NOT EXISTS tg_{tabela}_log_delete
+        AFTER DELETE ON {tabela}
+        BEGIN {_registrar(tabela, 'delete', 'OLD')} END""",
+    )
+
+
+def _transferencia_paciente():
+    # Paciente que muda de fisioterapeuta: o anterior recebe exclusões e o novo
+    # recebe os registros clínicos, que não mudam por conta própria
+    comandos = [
+        "INSERT INTO log_alteracoes (tabela, registro_id, operacao, fisioterapeuta_id, data_hora) "
+        f"VALUES ('pacientes', NEW.id, 'delete', OLD.fisioterapeuta_id, {_AGORA});"
+    ]
+    for tabela in ('avaliacoes', 'evolucoes', 'agendamentos'):
+        for operacao, dono in (('delete', 'OLD'), ('update', 'NEW')):
+            comandos.append(
+                "INSERT INTO log_alteracoes (tabela, registro_id, operacao, fisioterapeuta_id, data_hora) "
+                f"SELECT '{tabela}', id, '{operacao}', {dono}.fisioterapeuta_id, {_AGORA} "
+                f"FROM {tabela} WHERE paciente_id = NEW.id;"
+            )
+    return f"""CREATE TRIGGER IF NOT EXISTS tg_pacientes_log_transferencia
+    AFTER UPDATE OF fisioterapeuta_id ON pacientes
+    WHEN OLD.fisioterapeuta_id IS NOT NEW.fisioterapeuta_id
+    BEGIN {' '.join(comandos)} END"""
+
+
+# Gatilhos (e não eventos do mapper) para registrar também as gravações em
+# lote feitas com insert()/update() do Core: séries, status em lote,
+# importação de pacientes e lembretes
+GATILHOS_LOG_ALTERACOES = {
+    tabela: _gatilhos(tabela) + ((_transferencia_paciente(),) if tabela == 'pacientes' else ())
+    for tabela in TABELAS_SINCRONIZADAS
+}
+
+for _tabela, (_, _modelo) in TABELAS_SINCRONIZADAS.items():
+    for _gatilho in GATILHOS_LOG_ALTERACOES[_tabela]:
+        event.listen(_modelo.__table__, 'after_create', DDL(_gatilho).execute_if(dialect='sqlite'))
+
+
+def registrar_existentes(connection):
+    """Carga inicial do log com os registros já existentes (migração)"""
+    for tabela in TABELAS_SINCRONIZADAS:
+        connection.exec_driver_sql(
+            "INSERT INTO log_alteracoes (tabela, registro_id, operacao, fisioterapeuta_id, data_hora) "
+            f"SELECT '{tabela}', id, 'insert', {_dono(tabela, tabela)}, {_AGORA} FROM {tabela} "
+            f"WHERE NOT EXISTS (SELECT 1 FROM log_alteracoes l "
+            f"WHERE l.tabela = '{tabela}' AND l.registro_id = {tabela}.id)"
+        )
+
+
+class SincronizacaoService:
+    @staticmethod
+    def alteracoes(fisioterapeuta_id, apos=0, limite=100):
+        """Estado atual de cada registro alterado após a posição `apos`, em ordem de alteração
+
+        Cada registro aparece uma vez, na posição da sua alteração mais recente;
+        registros excluídos (ou transferidos a outro fisioterapeuta) vêm como
+        marcadores de exclusão. Retorna (itens, tem_mais).
+        """
+        ultimas = (
+            select(func.max(LogAlteracao.id).label('versao'))
+            .where(LogAlteracao.fisioterapeuta_id == fisioterapeuta_id, LogAlteracao.id > apos)
+            .group_by(LogAlteracao.tabela, LogAlteracao.registro_id)
+            .order_by(func.max(LogAlteracao.id))
+            .limit(limite + 1)
+            .subquery()
+        )
+        registros = db.session.execute(
+            select(LogAlteracao.id, LogAlteracao.tabela, LogAlteracao.registro_id, LogAlteracao.operacao)
+            .join(ultimas, LogAlteracao.id == ultimas.c.versao)
+            .order_by(LogAlteracao.id)
+        ).all()
+        tem_mais = len(registros) > limite
+        registros = registros[:limite]
+
+        # Uma consulta por tabela para o estado atual dos registros ainda existentes
+        por_tabela = {}
+        for registro in registros:
+            if registro.operacao != 'delete':
+                por_tabela.setdefault(registro.tabela, []).append(registro.registro_id)
+        atuais = {}
+        for tabela, ids in por_tabela.items():
+            modelo = TABELAS_SINCRONIZADAS[tabela][1]
+            for objeto in modelo.query.filter(modelo.id.in_(ids)):
+                atuais[(tabela, objeto.id)] = objeto
+
+        itens = []
+        for registro in registros:
+            objeto = atuais.get((registro.tabela, registro.registro_id))
+            itens.append({
+                'tipo': TABELAS_SINCRONIZADAS[registro.tabela][0],
+                'id': registro.registro_id,
+                'versao': registro.id,
+                'excluido': objeto is None,
+                'dados': objeto.to_dict() if objeto is not None else None
+            })
+        return itens, tem_mais
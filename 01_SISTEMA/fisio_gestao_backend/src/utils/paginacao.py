@@ -0,0 +1,42 @@
+import base64
+import json
+from datetime import date, datetime
+
+LIMITE_PADRAO = 50
+LIMITE_MAXIMO = 200
+
+
+class CursorInvalido(ValueError):
+    """Cursor de paginação malformado ou adulterado"""
+
+
+def codificar_cursor(valores):
+    """Gerar cursor opaco a partir dos valores da chave de ordenação"""
+    bruto = json.dumps([serializar_valor(v) for v in valores], separators=(',', ':'))
+    return base64.urlsafe_b64encode(bruto.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decodificar_cursor(cursor, tamanho):
+    """Decodificar cursor opaco em lista de valores da chave de ordenação"""
+    try:
+        preenchimento = '=' * (-len(cursor) % 4)
+        valores = json.loads(base64.urlsafe_b64decode(cursor + preenchimento).decode('utf-8'))
+    except (ValueError, UnicodeDecodeError):
+        raise CursorInvalido('Cursor inválido')
+    
+    if not isinstance(valores, list) or len(valores) != tamanho:
+        raise CursorInvalido('Cursor inválido')
+    return valores
+
+
+def obter_limite(valor):
+    """Normalizar parâmetro limit dentro dos limites permitidos"""
+    if valor is None:
+        return LIMITE_PADRAO
+    return max(1, min(valor, LIMITE_MAXIMO))
+
+
+def serializar_valor(valor):
+    if isinstance(valor, (datetime, date)):
+        return valor.isoformat()
+    return valor
@@ -1,8 +1,31 @@
 import pytest
+import hashlib
+import io
 import json
+import os
+import re
+import socketserver
+import threading
+from datetime import datetime, timedelta
 from src.main import app
-from src.models.fisio_models import db, Fisioterapeuta, Paciente
+from src.models.fisio_models import (
+    db, Fisioterapeuta, Paciente, Avaliacao, Evolucao, Agendamento, Procedimento, ProcedimentoEvolucao
+)
+from src.prontuario.prontuario_service import ProntuarioService
 from src.auth.auth_service import AuthService
+from src.audit.audit_service import LogAuditoria
+from src.database.migrations import MIGRACOES, aplicar_migracoes, versao_atual
+from sqlalchemy import create_engine, event, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from src.agenda.agenda_service import AgendaService
+from src.anexos.armazenamento_service import ObjetoAnexo, UploadAnexo, comando_limpar_uploads
+from src.anexos.derivados_service import DerivadosService, GeradorDerivados
+from src.cif.indice_cif_service import IndiceCif, IndiceCifService, codigos_cif
+from src.cif.registro_cif import REGISTRO_CIF
+from src.agenda.indicadores_service import IndicadoresAgendaService, ResumoDiarioAgenda, comando_resumo_agenda
+from src.lembretes.canais import criar_canais
+from src.lembretes.lembrete_service import DespachanteLembretes, LembreteOutbox, LembreteService
 
 @pytest.fixture
 def client():
@@ -155,7 +178,42 @@ class TestPacientes:
         
         assert response.status_code == 200
         data_response = json.loads(response.data)
-        assert isinstance(data_response, list)
+        assert isinstance(data_response['pacientes'], list)
+        assert 'next_cursor' in data_response
+    
+    def test_listar_pacientes_paginacao_cursor(self, client, token_auth, fisioterapeuta_teste):
+        """Testar paginação por cursor e seleção de campos"""
+        for nome in ['Carla', 'Ana', 'Bruno', 'Daniel', 'Ana']:
+            db.session.add(Paciente(
+                nome_completo=nome,
+                data_nascimento=datetime(1990, 1, 1).date(),
+                fisioterapeuta_id=fisioterapeuta_teste.id
+            ))
+        db.session.commit()
+        
+        headers = {'Authorization': token_auth}
+        vistos = []
+        cursor = None
+        while True:
+            url = '/api/pacientes?limit=2&fields=telefone'
+            if cursor:
+                url += f'&cursor={cursor}'
+            data_response = json.loads(client.get(url, headers=headers).data)
+            for paciente in data_response['pacientes']:
+                assert set(paciente.keys()) == {'id', 'nome_completo', 'telefone'}
+            vistos.extend(p['nome_completo'] for p in data_response['pacientes'])
+            cursor = data_response['next_cursor']
+            if not cursor:
+                break
+        
+        assert vistos == ['Ana', 'Ana', 'Bruno', 'Carla', 'Daniel']
+    
+    def test_listar_pacientes_campo_invalido(self, client, token_auth):
+        """Testar rejeição de campos inexistentes em fields"""
+        headers = {'Authorization': token_auth}
+        response = client.get('/api/pacientes?fields=senha_hash', headers=headers)
+        
+        assert response.status_code == 400
     
     def test_criar_paciente_sem_nome(self, client, token_auth):
         """Testar erro ao criar paciente sem nome"""
@@ -172,6 +230,1689 @@ class TestPacientes:
         
         assert response.status_code == 400
 
+class TestImportacaoPacientes:
+    """Testes para importação de pacientes em lote"""
+    
+    def test_importar_csv_com_relatorio_de_erros(self, client, token_auth, fisioterapeuta_teste):
+        """Testar importação CSV com linhas válidas e inválidas"""
+        fid = fisioterapeuta_teste.id
+        csv_data = (
+            'nome_completo,data_nascimento,fisioterapeuta_id,telefone\n'
+            f'Ana Importada,1980-01-01,{fid},(51) 1111-1111\n'
+            f',1981-01-01,{fid},\n'
+            f'Bruno Importado,01/02/1982,{fid},\n'
+            'Carla Importada,1983-01-01,999,\n'
+            f'Diego Importado,1984-01-01,{fid},\n'
+        )
+        
+        headers = {'Authorization': token_auth}
+        response = client.post('/api/pacientes/importar',
+                             data=csv_data.encode('utf-8'),
+                             content_type='text/csv',
+                             headers=headers)
+        
+        assert response.status_code == 200
+        relatorio = json.loads(response.data)
+        assert relatorio['importados'] == 2
+        assert relatorio['rejeitados'] == 3
+        assert [erro['linha'] for erro in relatorio['erros']] == [3, 4, 5]
+        assert Paciente.query.filter_by(nome_completo='Ana Importada').one().telefone == '(51) 1111-1111'
+        
+        # Pacientes importados também entram no índice de busca
+        response = client.get('/api/pacientes/busca?q=diego', headers=headers)
+        assert len(json.loads(response.data)['pacientes']) == 1
+    
+    def test_importar_ndjson(self, client, token_auth, fisioterapeuta_teste):
+        """Testar importação NDJSON"""
+        linhas = [
+            json.dumps({'nome_completo': f'Paciente {i}', 'data_nascimento': '1990-01-01',
+                        'fisioterapeuta_id': fisioterapeuta_teste.id})
+            for i in range(5)
+        ]
+        linhas.insert(2, '{invalido')
+        
+        headers = {'Authorization': token_auth}
+        response = client.post('/api/pacientes/importar',
+                             data='\n'.join(linhas),
+                             content_type='application/x-ndjson',
+                             headers=headers)
+        
+        relatorio = json.loads(response.data)
+        assert relatorio['importados'] == 5
+        assert relatorio['erros'] == [{'linha': 3, 'erro': 'JSON inválido'}]
+
+class TestBuscaPacientes:
+    """Testes para busca indexada de pacientes por nome"""
+    
+    def _criar(self, nome, fisioterapeuta_id):
+        paciente = Paciente(
+            nome_completo=nome,
+            data_nascimento=datetime(1990, 1, 1).date(),
+            fisioterapeuta_id=fisioterapeuta_id
+        )
+        db.session.add(paciente)
+        db.session.commit()
+        return paciente
+    
+    def test_busca_sem_acentos_prefixo_e_infixo(self, client, token_auth, fisioterapeuta_teste):
+        """Testar busca insensível a acentos por prefixo e trecho do nome"""
+        self._criar('João Conceição', fisioterapeuta_teste.id)
+        self._criar('Joana Silva', fisioterapeuta_teste.id)
+        self._criar('Márcia Oliveira', fisioterapeuta_teste.id)
+        
+        headers = {'Authorization': token_auth}
+        
+        response = client.get('/api/pacientes/busca?q=joao', headers=headers)
+        nomes = [p['nome_completo'] for p in json.loads(response.data)['pacientes']]
+        assert nomes == ['João Conceição']
+        
+        response = client.get('/api/pacientes/busca?q=jo', headers=headers)
+        nomes = [p['nome_completo'] for p in json.loads(response.data)['pacientes']]
+        assert set(nomes) == {'João Conceição', 'Joana Silva'}
+        
+        response = client.get('/api/pacientes/busca?q=ceicao', headers=headers)
+        data_response = json.loads(response.data)
+        assert [p['nome_completo'] for p in data_response['pacientes']] == ['João Conceição']
+        assert data_response['pacientes'][0]['correspondencia'] == 'parcial'
+        
+        # Palavra curta continua obrigatória quando a outra só casa por trecho
+        self._criar('Carla Silva', fisioterapeuta_teste.id)
+        response = client.get('/api/pacientes/busca?q=jo%20ilva', headers=headers)
+        assert [p['nome_completo'] for p in json.loads(response.data)['pacientes']] == ['Joana Silva']
+        response = client.get('/api/pacientes?nome=jo%20ilva', headers=headers)
+        assert [p['nome_completo'] for p in json.loads(response.data)['pacientes']] == ['Joana Silva']
+        
+        response = client.get('/api/pacientes?nome=LIVEI', headers=headers)
+        nomes = [p['nome_completo'] for p in json.loads(response.data)['pacientes']]
+        assert nomes == ['Márcia Oliveira']
+    
+    def test_busca_reflete_alteracao_de_nome(self, client, token_auth, fisioterapeuta_teste):
+        """Testar sincronização do índice ao renomear paciente"""
+        paciente = self._criar('Pedro Alves', fisioterapeuta_teste.id)
+        paciente.nome_completo = 'Pedro Álvares Cabral'
+        db.session.commit()
+        
+        headers = {'Authorization': token_auth}
+        response = client.get('/api/pacientes/busca?q=cabral', headers=headers)
+        
+        assert [p['id'] for p in json.loads(response.data)['pacientes']] == [paciente.id]
+
+class TestBuscaClinica:
+    """Testes para busca textual nas notas clínicas"""
+    
+    def _paciente(self, nome, fisioterapeuta_id):
+        paciente = Paciente(nome_completo=nome, data_nascimento=datetime(1980, 1, 1).date(),
+                            fisioterapeuta_id=fisioterapeuta_id)
+        db.session.add(paciente)
+        db.session.commit()
+        return paciente
+    
+    def _buscar(self, client, token_auth, termo):
+        response = client.get(f'/api/busca/clinica?q={termo}', headers={'Authorization': token_auth})
+        assert response.status_code == 200, response.data
+        return json.loads(response.data)['resultados']
+    
+    def test_busca_com_radical_trecho_e_escopo(self, client, token_auth, fisioterapeuta_teste):
+        """Testar radicais sem acento, trechos destacados, sincronização e escopo por fisioterapeuta"""
+        outro = Fisioterapeuta(nome='Dra. Outra', email='outra@fisio.com',
+                               senha_hash=AuthService.hash_password('senha123'), crefito='CREFITO-OUTRA')
+        db.session.add(outro)
+        db.session.commit()
+        
+        paciente = self._paciente('Paciente Lombar', fisioterapeuta_teste.id)
+        alheio = self._paciente('Paciente Alheio', outro.id)
+        avaliacao = Avaliacao(paciente_id=paciente.id, queixa_principal='Dor nas costas',
+                              diagnostico_fisioterapeutico='Lombalgia irradiada para membro inferior esquerdo')
+        evolucao = Evolucao(paciente_id=paciente.id, data_sessao=datetime(2025, 3, 1, 9, 0),
+                            resposta_paciente='Redução da irradiação após mobilização')
+        db.session.add_all([avaliacao, evolucao,
+                            Avaliacao(paciente_id=alheio.id, queixa_principal='Lombalgia irradiada')])
+        db.session.commit()
+        
+        resultados = self._buscar(client, token_auth, 'lombalgia irradiada')
+        assert [(r['tipo'], r['id']) for r in resultados] == [('avaliacao', avaliacao.id)]
+        assert resultados[0]['campo'] == 'diagnostico_fisioterapeutico'
+        assert '<mark>Lombalgia</mark> <mark>irradiada</mark>' in resultados[0]['trecho']
+        assert resultados[0]['nome_paciente'] == 'Paciente Lombar'
+        
+        # "irradiação" e "irradiada" compartilham o radical
+        resultados = self._buscar(client, token_auth, 'IRRADIAÇÃO')
+        assert {(r['tipo'], r['id']) for r in resultados} == {('avaliacao', avaliacao.id), ('evolucao', evolucao.id)}
+        
+        # Edição e exclusão atualizam o índice
+        client.put(f'/api/evolucoes/{evolucao.id}', data=json.dumps({'resposta_paciente': 'Sem dor'}),
+                   content_type='application/json')
+        assert [r['tipo'] for r in self._buscar(client, token_auth, 'irradiacao')] == ['avaliacao']
+        assert [r['id'] for r in self._buscar(client, token_auth, 'sem dor')] == [evolucao.id]
+        client.delete(f'/api/evolucoes/{evolucao.id}')
+        assert self._buscar(client, token_auth, 'sem dor') == []
+        
+        # Paciente transferido sai do escopo do fisioterapeuta anterior
+        paciente.fisioterapeuta_id = outro.id
+        db.session.commit()
+        assert self._buscar(client, token_auth, 'lombalgia') == []
+        
+        assert client.get('/api/busca/clinica?q=dor').status_code == 401
+        assert client.get('/api/busca/clinica', headers={'Authorization': token_auth}).status_code == 400
+    
+    def test_trecho_escapa_html(self, client, token_auth, fisioterapeuta_teste):
+        """Testar que o trecho destacado escapa o HTML da nota e só contém as marcas da busca"""
+        paciente = self._paciente('Paciente Nota', fisioterapeuta_teste.id)
+        db.session.add(Evolucao(paciente_id=paciente.id, data_sessao=datetime(2025, 3, 1, 9, 0),
+                                observacoes='Cervicalgia <script>alert("x")</script> & <b>tensão</b>'))
+        db.session.commit()
+        
+        resultados = self._buscar(client, token_auth, 'cervicalgia')
+        assert resultados[0]['campo'] == 'observacoes'
+        trecho = resultados[0]['trecho']
+        assert '<script>' not in trecho and '<b>' not in trecho
+        assert trecho.startswith('<mark>Cervicalgia</mark> &lt;script&gt;alert(&quot;x&quot;)&lt;/script&gt; &amp;')
+        assert re.sub(r'&\w+;', '', trecho.replace('<mark>', '').replace('</mark>', '')).count('<') == 0
+
+class TestProntuario:
+    """Testes para prontuário com cache e requisição condicional"""
+    
+    def test_prontuario_etag_e_invalidacao(self, client, token_auth, fisioterapeuta_teste):
+        """Testar 304 com ETag inalterado e nova versão após evolução"""
+        paciente = Paciente(
+            nome_completo='Paciente Prontuário',
+            data_nascimento=datetime(1980, 5, 1).date(),
+            fisioterapeuta_id=fisioterapeuta_teste.id
+        )
+        db.session.add(paciente)
+        db.session.commit()
+        
+        headers = {'Authorization': token_auth}
+        url = f'/api/pacientes/{paciente.id}/prontuario'
+        response = client.get(url, headers=headers)
+        assert response.status_code == 200
+        etag = response.headers['ETag']
+        assert json.loads(response.data)['evolucoes'] == []
+        
+        response = client.get(url, headers={**headers, 'If-None-Match': etag})
+        assert response.status_code == 304
+        
+        db.session.add(Evolucao(paciente_id=paciente.id, data_sessao=datetime(2025, 1, 10, 9, 0)))
+        db.session.commit()
+        
+        response = client.get(url, headers={**headers, 'If-None-Match': etag})
+        assert response.status_code == 200
+        assert response.headers['ETag'] != etag
+        assert len(json.loads(response.data)['evolucoes']) == 1
+        
+        # UPDATE em lote fora do ORM (lembrete enviado) também gera nova versão
+        agendamento = Agendamento(paciente_id=paciente.id, data_hora=datetime(2025, 1, 17, 9, 0))
+        db.session.add(agendamento)
+        db.session.flush()
+        item = LembreteOutbox(agendamento_id=agendamento.id, canal='email', destino='p@fisio.com',
+                              nome_paciente=paciente.nome_completo, data_hora=agendamento.data_hora, status='enviando')
+        db.session.add(item)
+        db.session.commit()
+        etag = client.get(url, headers=headers).headers['ETag']
+        LembreteService.registrar_resultados([item], [None])
+        response = client.get(url, headers={**headers, 'If-None-Match': etag})
+        assert response.status_code == 200
+        assert json.loads(response.data)['agendamentos'][0]['lembrete_enviado'] is True
+    
+    def test_prontuario_sql_equivale_ao_orm(self, client, fisioterapeuta_teste):
+        """Testar que a montagem em SQL gera o mesmo documento que o ORM"""
+        paciente = Paciente(
+            nome_completo='Paciente SQL',
+            data_nascimento=datetime(1975, 2, 3).date(),
+            fisioterapeuta_id=fisioterapeuta_teste.id,
+            consentimento_comunicacao=True,
+            data_consentimento=datetime(2025, 3, 1, 8, 30)
+        )
+        db.session.add(paciente)
+        db.session.flush()
+        db.session.add(Avaliacao(paciente_id=paciente.id, queixa_principal='Dor "lombar"',
+                                 funcoes_corpo={'b280': {'qualificador': 2, 'nota': 'Dor "aguda"'}},
+                                 atividades_participacao=['d450', 'd455']))
+        db.session.add(Evolucao(paciente_id=paciente.id, data_sessao=datetime(2025, 3, 2, 14, 0)))
+        db.session.add(Evolucao(paciente_id=paciente.id, data_sessao=datetime(2025, 3, 5, 14, 0, 0, 123)))
+        db.session.add(Agendamento(paciente_id=paciente.id, data_hora=datetime(2025, 3, 9, 10, 0)))
+        db.session.commit()
+        db.session.expire_all()
+        
+        documento_sql = json.loads(ProntuarioService.montar_json(paciente.id))
+        documento_orm = json.loads(json.dumps(ProntuarioService.montar(paciente.id)))
+        
+        assert documento_sql == documento_orm
+        assert ProntuarioService.montar_json(9999) is None
+    
+    def test_linha_do_tempo_intercalada(self, client, fisioterapeuta_teste):
+        """Testar intercalação das três fontes em ordem decrescente, com cursor estável em empates"""
+        paciente = Paciente(nome_completo='Paciente Linha do Tempo', data_nascimento=datetime(1970, 7, 7).date(),
+                            fisioterapeuta_id=fisioterapeuta_teste.id)
+        db.session.add(paciente)
+        db.session.flush()
+        empate = datetime(2025, 4, 10, 9, 0)
+        db.session.add_all([
+            Avaliacao(paciente_id=paciente.id, data_avaliacao=datetime(2025, 4, 1, 8, 0), queixa_principal='Dor'),
+            Avaliacao(paciente_id=paciente.id, data_avaliacao=empate),
+            *[Evolucao(paciente_id=paciente.id, data_sessao=datetime(2025, 4, d, 9, 0)) for d in (3, 10, 17)],
+            Evolucao(paciente_id=paciente.id, data_sessao=empate),
+            *[Agendamento(paciente_id=paciente.id, data_hora=datetime(2025, 4, d, 9, 0)) for d in (10, 24)],
+        ])
+        db.session.commit()
+        
+        eventos = []
+        url = f'/api/pacientes/{paciente.id}/linha-do-tempo?limit=3'
+        cursor = None
+        while True:
+            response = client.get(url + (f'&cursor={cursor}' if cursor else ''))
+            assert response.status_code == 200
+            pagina = json.loads(response.data)
+            assert len(pagina['eventos']) <= 3
+            eventos.extend(pagina['eventos'])
+            cursor = pagina['next_cursor']
+            if not cursor:
+                break
+        
+        assert [(e['data'][:10], e['tipo']) for e in eventos] == [
+            ('2025-04-24', 'agendamento'),
+            ('2025-04-17', 'evolucao'),
+            ('2025-04-10', 'avaliacao'),
+            ('2025-04-10', 'evolucao'),
+            ('2025-04-10', 'evolucao'),
+            ('2025-04-10', 'agendamento'),
+            ('2025-04-03', 'evolucao'),
+            ('2025-04-01', 'avaliacao'),
+        ]
+        assert eventos[-1]['dados']['queixa_principal'] == 'Dor'
+        assert len({(e['tipo'], e['id']) for e in eventos}) == len(eventos)
+        
+        assert client.get(f'/api/pacientes/{paciente.id}/linha-do-tempo?cursor=x').status_code == 400
+        assert client.get('/api/pacientes/9999/linha-do-tempo').status_code == 404
+    
+    def test_prontuario_paciente_inexistente(self, client, token_auth):
+        """Testar 404 para paciente inexistente"""
+        headers = {'Authorization': token_auth}
+        response = client.get('/api/pacientes/9999/prontuario', headers=headers)
+        
+        assert response.status_code == 404
+
+class TestAvaliacoes:
+    """Testes para avaliações e campos da CIF"""
+    
+    def test_campos_cif_json_nativo(self, client, fisioterapeuta_teste):
+        """Testar que os campos da CIF são gravados e lidos como JSON, sem serialização manual"""
+        paciente = Paciente(nome_completo='Paciente CIF', data_nascimento=datetime(1990, 1, 1).date(),
+                            fisioterapeuta_id=fisioterapeuta_teste.id)
+        db.session.add(paciente)
+        db.session.commit()
+        
+        funcoes = {'b280': {'qualificador': 3, 'descricao': 'Sensação de dor'}}
+        response = client.post('/api/avaliacoes', data=json.dumps({
+            'paciente_id': paciente.id,
+            'funcoes_corpo': funcoes,
+            'estruturas_corpo': ['s7601']
+        }), content_type='application/json')
+        assert response.status_code == 201
+        avaliacao_id = json.loads(response.data)['id']
+        
+        avaliacao = json.loads(client.get(f'/api/avaliacoes/{avaliacao_id}').data)
+        assert avaliacao['funcoes_corpo'] == funcoes
+        assert avaliacao['estruturas_corpo'] == ['s7601']
+        assert avaliacao['fatores_ambientais'] is None
+        
+        response = client.put(f'/api/avaliacoes/{avaliacao_id}', data=json.dumps({
+            'fatores_ambientais': {'e310': '+2'},
+            'estruturas_corpo': None
+        }), content_type='application/json')
+        assert response.status_code == 200
+        
+        bruto = db.session.execute(db.text(
+            'SELECT funcoes_corpo, estruturas_corpo, fatores_ambientais FROM avaliacoes WHERE id = :id'
+        ), {'id': avaliacao_id}).one()
+        assert json.loads(bruto.funcoes_corpo) == funcoes
+        assert bruto.estruturas_corpo is None
+        assert json.loads(bruto.fatores_ambientais) == {'e310': '+2'}
+    
+    def test_migracao_cif_texto_legado(self):
+        """Testar que valores legados em texto livre viram strings JSON e JSON válido é mantido"""
+        engine = create_engine('sqlite://')
+        db.metadata.create_all(engine)
+        with engine.begin() as conn:
+            conn.exec_driver_sql(
+                "INSERT INTO avaliacoes (paciente_id, funcoes_corpo, estruturas_corpo, fatores_ambientais) "
+                "VALUES (1, '{\"b280\": 2}', 'sem alterações', NULL)"
+            )
+        
+        aplicar_migracoes(engine)
+        
+        with engine.connect() as conn:
+            linha = conn.execute(
+                select(Avaliacao.funcoes_corpo, Avaliacao.estruturas_corpo, Avaliacao.fatores_ambientais)
+            ).one()
+        assert tuple(linha) == ({'b280': 2}, 'sem alterações', None)
+    
+    def test_coorte_por_codigo_cif(self, client, token_auth, fisioterapeuta_teste):
+        """Testar índice invertido da CIF: manutenção na gravação e consulta por código e qualificador"""
+        pacientes = [Paciente(nome_completo=f'Paciente Coorte {i}', data_nascimento=datetime(1980, 1, 1).date(),
+                              fisioterapeuta_id=fisioterapeuta_teste.id) for i in range(3)]
+        db.session.add_all(pacientes)
+        db.session.commit()
+        
+        def criar(paciente, data, **cif):
+            response = client.post('/api/avaliacoes', data=json.dumps({
+                'paciente_id': paciente.id, 'data_avaliacao': data, **cif
+            }), content_type='application/json')
+            assert response.status_code == 201
+            return json.loads(response.data)['id']
+        
+        criar(pacientes[0], '2025-01-10T09:00:00', funcoes_corpo={'b280': 4},
+              atividades_participacao=[{'codigo': 'd450', 'qualificador': 3}])
+        criar(pacientes[0], '2025-03-10T09:00:00', funcoes_corpo={'b280': {'qualificador': 1}},
+              atividades_participacao=[{'codigo': 'd450', 'qualificador': 1}])
+        segunda = criar(pacientes[1], '2025-02-01T09:00:00', funcoes_corpo={'b280.3': 'b280.3'})
+        criar(pacientes[2], '2025-02-01T09:00:00', fatores_ambientais={'e310': '+2', 'xyz': 1})
+        
+        headers = {'Authorization': token_auth}
+        def coorte(consulta):
+            response = client.get(f'/api/cif/coorte?{consulta}', headers=headers)
+            assert response.status_code == 200, response.data
+            return json.loads(response.data)
+        
+        resultado = coorte('codigo=b280&qualificador_min=3')
+        assert [p['paciente_id'] for p in resultado['pacientes']] == [pacientes[0].id, pacientes[1].id]
+        
+        resultado = coorte('codigo=d450')
+        assert resultado['pacientes'][0]['codigos']['d450']['primeiro_qualificador'] == 3
+        assert resultado['pacientes'][0]['codigos']['d450']['ultimo_qualificador'] == 1
+        
+        # Condições combinadas (E): a faixa seleciona o paciente, a trajetória vem completa
+        resultado = coorte('codigo=b280:3&codigo=d450')
+        assert [p['paciente_id'] for p in resultado['pacientes']] == [pacientes[0].id]
+        trajetoria = resultado['pacientes'][0]['codigos']
+        assert [item['qualificador'] for item in trajetoria['b280']['avaliacoes']] == [4, 1]
+        assert (trajetoria['d450']['primeiro_qualificador'], trajetoria['d450']['ultimo_qualificador']) == (3, 1)
+        assert coorte('codigo=b280:3&codigo=d450:4')['pacientes'] == []
+        assert [p['paciente_id'] for p in coorte('codigo=d450::1&codigo=b280:4:4')['pacientes']] == [pacientes[0].id]
+        assert client.get('/api/cif/coorte?codigo=b280:x', headers=headers).status_code == 400
+        
+        resultado = coorte('codigo=b280&data_inicio=2025-02-01&limit=1')
+        assert [p['paciente_id'] for p in resultado['pacientes']] == [pacientes[0].id]
+        resultado = coorte(f"codigo=b280&data_inicio=2025-02-01&limit=1&cursor={resultado['next_cursor']}")
+        assert [p['paciente_id'] for p in resultado['pacientes']] == [pacientes[1].id]
+        assert resultado['next_cursor'] is None
+        
+        # Facilitador dos fatores ambientais fica negativo; códigos inválidos são ignorados
+        assert IndiceCif.query.filter_by(paciente_id=pacientes[2].id).one().qualificador == -2
+        
+        client.put(f'/api/avaliacoes/{segunda}', data=json.dumps({'funcoes_corpo': {'b280': 2}}),
+                   content_type='application/json')
+        assert [p['paciente_id'] for p in coorte('codigo=b280&qualificador_min=3')['pacientes']] == [pacientes[0].id]
+        
+        client.delete(f'/api/avaliacoes/{segunda}')
+        assert IndiceCif.query.filter_by(avaliacao_id=segunda).count() == 0
+        
+        # Carga inicial reconstrói o índice a partir do JSON
+        db.session.execute(IndiceCif.__table__.delete())
+        assert IndiceCifService.reindexar(db.session.connection()) == 3
+        db.session.commit()
+        assert IndiceCif.query.count() == 5
+        assert codigos_cif(['d450', 'B280.2', 7]) == {'d450': None, 'b280': 2}
+        
+        # 8 (não especificado) e 9 (não aplicável) não contam como deficiência grave
+        sem_grau = criar(pacientes[2], '2025-04-01T09:00:00', funcoes_corpo={'b280': 8, 'b152': 9})
+        assert {linha.qualificador for linha in IndiceCif.query.filter_by(avaliacao_id=sem_grau)} == {None}
+        assert pacientes[2].id not in [p['paciente_id'] for p in coorte('codigo=b280&qualificador_min=3')['pacientes']]
+        
+        assert client.get('/api/cif/coorte', headers=headers).status_code == 400
+    
+    def test_validacao_cif_na_gravacao(self, client, fisioterapeuta_teste):
+        """Testar recusa de códigos inexistentes, de outro componente ou com qualificador fora da escala"""
+        paciente = Paciente(nome_completo='Paciente Validação CIF', data_nascimento=datetime(1980, 1, 1).date(),
+                            fisioterapeuta_id=fisioterapeuta_teste.id)
+        db.session.add(paciente)
+        db.session.commit()
+        
+        def criar(**cif):
+            return client.post('/api/avaliacoes', data=json.dumps({'paciente_id': paciente.id, **cif}),
+                               content_type='application/json')
+        
+        response = criar(funcoes_corpo={'b280': 5, 'b999': 1, 'd450': 2, 'observacoes': 'texto livre'},
+                         fatores_ambientais={'e310': '+2', 'e115': '+5'})
+        assert response.status_code == 400
+        erros = json.loads(response.data)['erros']
+        assert sorted((erro['campo'], erro['codigo']) for erro in erros) == [
+            ('fatores_ambientais', 'e115'),
+            ('funcoes_corpo', 'b280'),
+            ('funcoes_corpo', 'b999'),
+            ('funcoes_corpo', 'd450'),
+        ]
+        
+        response = criar(funcoes_corpo={'b280': 3, 'b28013': {'qualificador': 8}},
+                         estruturas_corpo=['s7601.2'], fatores_ambientais={'e310': '+2', 'e1151': 4})
+        assert response.status_code == 201
+        avaliacao_id = json.loads(response.data)['id']
+        
+        response = client.put(f'/api/avaliacoes/{avaliacao_id}', data=json.dumps({
+            'atividades_participacao': [{'codigo': 'd4501', 'qualificador': 'x'}]
+        }), content_type='application/json')
+        assert response.status_code == 400
+        assert Avaliacao.query.get(avaliacao_id).atividades_participacao is None
+    
+    def test_registro_cif_autocompletar(self, client):
+        """Testar autocompletar por prefixo e navegação entre pai e filhos sem consultar o banco"""
+        assert len(REGISTRO_CIF) > 1400
+        
+        comandos = []
+        def contar(conn, cursor, statement, parameters, context, executemany):
+            comandos.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', contar)
+        try:
+            response = client.get('/api/cif/codigos?prefixo=B280&limit=3')
+            detalhe = client.get('/api/cif/codigos/b2801')
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', contar)
+        assert comandos == []
+        
+        dados = json.loads(response.data)
+        assert [item['codigo'] for item in dados['codigos']] == ['b280', 'b2800', 'b2801']
+        assert dados['codigos'][0]['titulo'] == 'Sensação de dor'
+        assert dados['total'] == 15
+        
+        detalhe = json.loads(detalhe.data)
+        assert [item['codigo'] for item in detalhe['ancestrais']] == ['b2', 'b280']
+        assert 'b28013' in [item['codigo'] for item in detalhe['filhos']]
+        assert all(len(item['codigo']) == 6 for item in detalhe['filhos'])
+        assert REGISTRO_CIF.filhos('d4') and all(len(codigo) == 4 for codigo in REGISTRO_CIF.filhos('d4'))
+        
+        assert client.get('/api/cif/codigos/x999').status_code == 404
+        assert client.get('/api/cif/codigos').status_code == 400
+
+class TestAnexos:
+    """Testes para upload em partes e armazenamento de anexos por hash"""
+    
+    @pytest.fixture
+    def avaliacao_id(self, client, fisioterapeuta_teste, tmp_path):
+        diretorio_original = app.config['ANEXOS_DIRETORIO']
+        app.config['ANEXOS_DIRETORIO'] = str(tmp_path)
+        paciente = Paciente(nome_completo='Paciente Anexo', data_nascimento=datetime(1990, 1, 1).date(),
+                            fisioterapeuta_id=fisioterapeuta_teste.id)
+        db.session.add(paciente)
+        db.session.flush()
+        avaliacao = Avaliacao(paciente_id=paciente.id, data_avaliacao=datetime(2024, 3, 1))
+        db.session.add(avaliacao)
+        db.session.commit()
+        yield avaliacao.id
+        app.config['ANEXOS_DIRETORIO'] = diretorio_original
+    
+    def enviar(self, client, avaliacao_id, conteudo, partes=1):
+        response = client.post(f'/api/avaliacoes/{avaliacao_id}/anexos', data=json.dumps({
+            'nome_arquivo': 'exame.pdf', 'tipo_arquivo': 'application/pdf', 'tamanho_bytes': len(conteudo)
+        }), content_type='application/json')
+        assert response.status_code == 201
+        upload_id = json.loads(response.data)['upload_id']
+        tamanho = -(-len(conteudo) // partes)
+        for inicio in range(0, len(conteudo), tamanho):
+            parte = conteudo[inicio:inicio + tamanho]
+            response = client.put(f'/api/avaliacoes/{avaliacao_id}/anexos/uploads/{upload_id}', data=parte, headers={
+                'Content-Range': f'bytes {inicio}-{inicio + len(parte) - 1}/{len(conteudo)}'
+            })
+        assert response.status_code == 201
+        return json.loads(response.data)
+    
+    def test_upload_em_partes_retomavel(self, client, avaliacao_id, tmp_path):
+        """Testar upload em partes, parte fora de ordem, retomada e gravação por hash"""
+        conteudo = bytes(range(256)) * 40
+        response = client.post(f'/api/avaliacoes/{avaliacao_id}/anexos', data=json.dumps({
+            'nome_arquivo': 'video.mp4', 'tipo_arquivo': 'video/mp4', 'tamanho_bytes': len(conteudo)
+        }), content_type='application/json')
+        assert response.status_code == 201
+        upload_id = json.loads(response.data)['upload_id']
+        url = f'/api/avaliacoes/{avaliacao_id}/anexos/uploads/{upload_id}'
+        
+        response = client.put(url, data=conteudo[:4000], headers={'Content-Range': f'bytes 0-3999/{len(conteudo)}'})
+        assert response.status_code == 200
+        assert json.loads(response.data)['recebidos'] == 4000
+        
+        # Parte fora de ordem: o servidor informa de onde retomar
+        response = client.put(url, data=conteudo[6000:], headers={'Content-Range': f'bytes 6000-10239/{len(conteudo)}'})
+        assert response.status_code == 409
+        assert json.loads(response.data)['recebidos'] == 4000
+        assert client.put(url, data=conteudo[4000:5000]).status_code == 400
+        assert json.loads(client.get(url).data)['recebidos'] == 4000
+        
+        response = client.put(url, data=conteudo[4000:], headers={'Content-Range': f'bytes 4000-10239/{len(conteudo)}'})
+        assert response.status_code == 201
+        anexo = json.loads(response.data)
+        sha256 = hashlib.sha256(conteudo).hexdigest()
+        assert anexo['sha256'] == sha256
+        assert anexo['tamanho_bytes'] == len(conteudo)
+        assert anexo['url_arquivo'] == f'objetos/{sha256[:2]}/{sha256[2:4]}/{sha256}'
+        assert (tmp_path / anexo['url_arquivo']).read_bytes() == conteudo
+        assert not (tmp_path / 'uploads' / upload_id).exists()
+        assert client.get(url).status_code == 404
+        
+        avaliacao = json.loads(client.get(f'/api/avaliacoes/{avaliacao_id}').data)
+        assert [item['sha256'] for item in avaliacao['anexos']] == [sha256]
+    
+    def test_conteudo_duplicado_e_exclusao(self, client, avaliacao_id, tmp_path):
+        """Testar que conteúdo repetido é gravado uma vez e apagado só sem referências"""
+        conteudo = b'laudo de ressonancia' * 100
+        primeiro = self.enviar(client, avaliacao_id, conteudo, partes=3)
+        segundo = self.enviar(client, avaliacao_id, conteudo)
+        assert primeiro['url_arquivo'] == segundo['url_arquivo']
+        assert db.session.get(ObjetoAnexo, primeiro['sha256']).referencias == 2
+        arquivo = tmp_path / primeiro['url_arquivo']
+        
+        response = client.delete(f'/api/avaliacoes/{avaliacao_id}/anexos/{primeiro["id"]}')
+        assert response.status_code == 200
+        assert arquivo.read_bytes() == conteudo
+        assert db.session.get(ObjetoAnexo, primeiro['sha256']).referencias == 1
+        
+        # Exclusão em cascata pela avaliação também libera o objeto
+        response = client.delete(f'/api/avaliacoes/{avaliacao_id}')
+        assert response.status_code == 200
+        assert not arquivo.exists()
+        assert not list(arquivo.parent.iterdir())
+        db.session.expire_all()
+        assert db.session.get(ObjetoAnexo, primeiro['sha256']) is None
+    
+    def test_falha_no_commit_preserva_parcial(self, client, avaliacao_id, tmp_path):
+        """Testar que, se o commit da última parte falha, o arquivo volta a ser o parcial e o upload é retomado"""
+        existente = self.enviar(client, avaliacao_id, b'conteudo repetido' * 50)
+        for conteudo in [b'conteudo novo' * 50, b'conteudo repetido' * 50]:
+            response = client.post(f'/api/avaliacoes/{avaliacao_id}/anexos', data=json.dumps({
+                'nome_arquivo': 'exame.pdf', 'tamanho_bytes': len(conteudo)
+            }), content_type='application/json')
+            upload_id = json.loads(response.data)['upload_id']
+            url = f'/api/avaliacoes/{avaliacao_id}/anexos/uploads/{upload_id}'
+            ultima = {'Content-Range': f'bytes 100-{len(conteudo) - 1}/{len(conteudo)}'}
+            client.put(url, data=conteudo[:100], headers={'Content-Range': f'bytes 0-99/{len(conteudo)}'})
+            
+            def falhar(session):
+                raise RuntimeError('falha simulada no commit')
+            event.listen(Session, 'before_commit', falhar)
+            try:
+                assert client.put(url, data=conteudo[100:], headers=ultima).status_code == 500
+            finally:
+                event.remove(Session, 'before_commit', falhar)
+            
+            sha256 = hashlib.sha256(conteudo).hexdigest()
+            objeto = tmp_path / 'objetos' / sha256[:2] / sha256[2:4] / sha256
+            assert (tmp_path / 'uploads' / upload_id).exists()
+            assert objeto.exists() == (sha256 == existente['sha256'])
+            assert json.loads(client.get(url).data)['recebidos'] == 100
+            
+            response = client.put(url, data=conteudo[100:], headers=ultima)
+            assert response.status_code == 201
+            assert objeto.read_bytes() == conteudo
+            assert not (tmp_path / 'uploads' / upload_id).exists()
+        db.session.expire_all()
+        assert db.session.get(ObjetoAnexo, existente['sha256']).referencias == 2
+    
+    def test_download_com_range_e_etag(self, client, avaliacao_id):
+        """Testar download com Range, ETag forte do hash, cache longo e X-Accel-Redirect"""
+        conteudo = bytes(range(256)) * 8
+        anexo = self.enviar(client, avaliacao_id, conteudo)
+        url = anexo['url_download']
+        assert url == f'/api/avaliacoes/{avaliacao_id}/anexos/{anexo["id"]}/arquivo'
+        
+        response = client.get(url)
+        assert response.status_code == 200
+        assert response.data == conteudo
+        assert response.headers['ETag'] == f'"{anexo["sha256"]}"'
+        assert response.headers['Accept-Ranges'] == 'bytes'
+        assert response.headers['Cache-Control'] == 'private, max-age=31536000, immutable'
+        assert response.mimetype == 'application/pdf'
+        assert response.headers['Content-Disposition'] == 'inline; filename=exame.pdf'
+        assert response.headers['X-Content-Type-Options'] == 'nosniff'
+        response.close()
+        
+        response = client.get(url, headers={'Range': 'bytes=1000-1099'})
+        assert response.status_code == 206
+        assert response.data == conteudo[1000:1100]
+        assert response.headers['Content-Range'] == f'bytes 1000-1099/{len(conteudo)}'
+        response.close()
+        
+        response = client.get(url, headers={'If-None-Match': f'"{anexo["sha256"]}"'})
+        assert response.status_code == 304
+        assert response.data == b''
+        
+        app.config['ANEXOS_X_ACCEL_REDIRECT'] = '/_anexos/'
+        try:
+            response = client.get(url)
+            assert response.status_code == 200
+            assert response.data == b''
+            assert response.headers['X-Accel-Redirect'] == '/_anexos/' + anexo['url_arquivo']
+            assert response.headers['ETag'] == f'"{anexo["sha256"]}"'
+            assert response.headers['Cache-Control'] == 'private, max-age=31536000, immutable'
+            
+            response = client.get(url, headers={'If-None-Match': f'"{anexo["sha256"]}"'})
+            assert response.status_code == 304
+            assert 'X-Accel-Redirect' not in response.headers
+        finally:
+            app.config['ANEXOS_X_ACCEL_REDIRECT'] = None
+        
+        assert client.get(f'/api/avaliacoes/{avaliacao_id}/anexos/9999/arquivo').status_code == 404
+    
+    def test_download_tipo_nao_exibivel(self, client, avaliacao_id):
+        """Testar que tipos fora da lista (ex.: HTML) são baixados como octet-stream, nunca abertos"""
+        response = client.post(f'/api/avaliacoes/{avaliacao_id}/anexos', data=json.dumps({
+            'nome_arquivo': 'exame.html', 'tipo_arquivo': 'text/html', 'tamanho_bytes': 0
+        }), content_type='application/json')
+        url = json.loads(response.data)['url_download']
+        
+        response = client.get(url)
+        assert response.status_code == 200
+        assert response.mimetype == 'application/octet-stream'
+        assert response.headers['Content-Disposition'].startswith('attachment')
+        assert response.headers['X-Content-Type-Options'] == 'nosniff'
+        assert response.headers['Content-Security-Policy'] == 'sandbox'
+        response.close()
+        
+        app.config['ANEXOS_X_ACCEL_REDIRECT'] = '/_anexos/'
+        try:
+            response = client.get(url)
+            assert response.mimetype == 'application/octet-stream'
+            assert response.headers['Content-Disposition'].startswith('attachment')
+            assert response.headers['Content-Security-Policy'] == 'sandbox'
+        finally:
+            app.config['ANEXOS_X_ACCEL_REDIRECT'] = None
+    
+    def test_miniaturas_e_previas(self, client, avaliacao_id, tmp_path):
+        """Testar geração de miniaturas e prévias no pool de processos, por hash e sem refazer"""
+        Image = pytest.importorskip('PIL.Image')
+        pytest.importorskip('pypdfium2')
+        
+        foto = io.BytesIO()
+        Image.new('RGBA', (2000, 1500), (200, 30, 30, 128)).save(foto, 'PNG')
+        pdf = io.BytesIO()
+        Image.new('RGB', (600, 800), 'white').save(pdf, 'PDF')
+        anexo_foto = self.enviar(client, avaliacao_id, foto.getvalue())
+        anexo_pdf = self.enviar(client, avaliacao_id, pdf.getvalue())
+        anexo_texto = self.enviar(client, avaliacao_id, b'relatorio em texto')
+        assert anexo_foto['derivados'] is None
+        
+        assert GeradorDerivados(app, workers=2).processar_pendentes() == 3
+        db.session.expire_all()
+        assert DerivadosService.pendentes() == []
+        
+        anexos = {item['id']: item for item in json.loads(client.get(f'/api/avaliacoes/{avaliacao_id}').data)['anexos']}
+        derivados = anexos[anexo_foto['id']]['derivados']
+        assert derivados['miniatura']['largura'] == 256 and derivados['miniatura']['altura'] == 192
+        assert derivados['previa']['largura'] == 1280 and derivados['previa']['altura'] == 960
+        assert max(anexos[anexo_pdf['id']]['derivados']['previa'][lado] for lado in ('largura', 'altura')) == 1280
+        assert anexos[anexo_texto['id']]['derivados'] == {}
+        
+        miniatura = tmp_path / (anexo_foto['url_arquivo'] + '.miniatura.jpg')
+        assert miniatura.stat().st_size == derivados['miniatura']['tamanho_bytes']
+        response = client.get(derivados['miniatura']['url'])
+        assert response.status_code == 200
+        assert response.mimetype == 'image/jpeg'
+        assert response.headers['ETag'] == f'"{anexo_foto["sha256"]}.miniatura"'
+        assert response.data == miniatura.read_bytes()
+        response.close()
+        assert client.get(anexos[anexo_texto['id']]['url_download'] + '/miniatura').status_code == 404
+        
+        # Reenvio do mesmo conteúdo já nasce com os derivados; nada a gerar
+        repetido = self.enviar(client, avaliacao_id, foto.getvalue())
+        assert repetido['derivados']['previa']['tamanho_bytes'] == derivados['previa']['tamanho_bytes']
+        assert GeradorDerivados(app, workers=1).processar_pendentes() == 0
+        
+        # Arquivos já gravados não são refeitos
+        modificado = miniatura.stat().st_mtime_ns
+        os.utime(miniatura, ns=(modificado - 10 ** 9, modificado - 10 ** 9))
+        db.session.execute(db.update(ObjetoAnexo).values(derivados=None))
+        db.session.commit()
+        assert GeradorDerivados(app, workers=1).processar_pendentes() == 3
+        assert miniatura.stat().st_mtime_ns == modificado - 10 ** 9
+        
+        client.delete(f'/api/avaliacoes/{avaliacao_id}/anexos/{anexo_foto["id"]}')
+        assert miniatura.exists()
+        client.delete(f'/api/avaliacoes/{avaliacao_id}/anexos/{repetido["id"]}')
+        assert not miniatura.exists()
+        assert not list(miniatura.parent.iterdir())
+    
+    def test_cancelar_upload(self, client, avaliacao_id, tmp_path):
+        """Testar cancelamento do upload e remoção do arquivo parcial"""
+        response = client.post(f'/api/avaliacoes/{avaliacao_id}/anexos', data=json.dumps({
+            'nome_arquivo': 'foto.jpg', 'tamanho_bytes': 100
+        }), content_type='application/json')
+        upload_id = json.loads(response.data)['upload_id']
+        url = f'/api/avaliacoes/{avaliacao_id}/anexos/uploads/{upload_id}'
+        client.put(url, data=b'x' * 50, headers={'Content-Range': 'bytes 0-49/100'})
+        assert (tmp_path / 'uploads' / upload_id).stat().st_size == 50
+        
+        assert client.delete(url).status_code == 200
+        assert not (tmp_path / 'uploads' / upload_id).exists()
+        assert UploadAnexo.query.count() == 0
+        
+        response = client.post(f'/api/avaliacoes/{avaliacao_id}/anexos', data=json.dumps({
+            'nome_arquivo': 'foto.jpg'
+        }), content_type='application/json')
+        assert response.status_code == 400
+    
+    def test_limpar_uploads_abandonados(self, client, avaliacao_id, tmp_path):
+        """Testar remoção de uploads sem atividade e de parciais sem upload, preservando os recentes"""
+        ids = []
+        for _ in range(2):
+            response = client.post(f'/api/avaliacoes/{avaliacao_id}/anexos', data=json.dumps({
+                'nome_arquivo': 'foto.jpg', 'tamanho_bytes': 100
+            }), content_type='application/json')
+            ids.append(json.loads(response.data)['upload_id'])
+            client.put(f'/api/avaliacoes/{avaliacao_id}/anexos/uploads/{ids[-1]}', data=b'x' * 50,
+                       headers={'Content-Range': 'bytes 0-49/100'})
+        abandonado, recente = ids
+        db.session.execute(db.update(UploadAnexo).where(UploadAnexo.id == abandonado)
+                           .values(data_atualizacao=datetime.utcnow() - timedelta(hours=100)))
+        db.session.commit()
+        orfao = tmp_path / 'uploads' / 'orfao'
+        orfao.write_bytes(b'x')
+        antigo = (datetime.now() - timedelta(hours=100)).timestamp()
+        os.utime(orfao, (antigo, antigo))
+        (tmp_path / 'uploads' / 'orfao-recente').write_bytes(b'x')
+        
+        resultado = app.test_cli_runner().invoke(comando_limpar_uploads, [])
+        assert resultado.exit_code == 0, resultado.output
+        assert '1 uploads abandonados removidos' in resultado.output
+        assert sorted(p.name for p in (tmp_path / 'uploads').iterdir()) == sorted([recente, 'orfao-recente'])
+        db.session.expire_all()
+        assert [upload.id for upload in UploadAnexo.query.all()] == [recente]
+        
+        resultado = app.test_cli_runner().invoke(comando_limpar_uploads, ['--horas', '200'])
+        assert '0 uploads abandonados removidos' in resultado.output
+
+class TestEvolucoes:
+    """Testes para evoluções e seus procedimentos"""
+    
+    @pytest.fixture
+    def paciente_evolucao(self, client, fisioterapeuta_teste):
+        paciente = Paciente(nome_completo='Paciente Evolução', data_nascimento=datetime(1985, 4, 2).date(),
+                            fisioterapeuta_id=fisioterapeuta_teste.id)
+        procedimentos = [Procedimento(nome=f'Procedimento {i:02d}') for i in range(25)]
+        db.session.add(paciente)
+        db.session.add_all(procedimentos)
+        db.session.commit()
+        return paciente, [procedimento.id for procedimento in procedimentos]
+    
+    def _comandos(self, client, metodo, url, dados):
+        db.session.expire_all()
+        comandos = []
+        def contar(conn, cursor, statement, parameters, context, executemany):
+            comandos.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', contar)
+        try:
+            if dados is None:
+                response = client.open(url, method=metodo)
+            else:
+                response = client.open(url, method=metodo, data=json.dumps(dados), content_type='application/json')
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', contar)
+        assert response.status_code in (200, 201), response.data
+        return json.loads(response.data), len(comandos)
+    
+    def test_procedimentos_em_lote(self, client, paciente_evolucao):
+        """Testar número constante de comandos ao criar e sincronizar procedimentos por diferença"""
+        paciente, procedimentos = paciente_evolucao
+        base = {'paciente_id': paciente.id, 'data_sessao': '2025-05-05T09:00:00'}
+        
+        _, com_dois = self._comandos(client, 'POST', '/api/evolucoes', {**base, 'procedimentos_ids': procedimentos[:2]})
+        data, com_vinte = self._comandos(client, 'POST', '/api/evolucoes', {
+            **base, 'procedimentos_ids': [*procedimentos[:20], 99999]
+        })
+        assert com_vinte == com_dois
+        assert [p['procedimento_id'] for p in data['procedimentos']] == procedimentos[:20]
+        assert data['procedimentos'][0]['procedimento']['nome'] == 'Procedimento 00'
+        vinculos = {p['procedimento_id']: p['id'] for p in data['procedimentos']}
+        
+        # Remove 5, altera a observação de 1 e inclui 3; os demais vínculos ficam intactos
+        pedidos = [{'procedimento_id': procedimentos[5], 'observacoes': 'Carga aumentada'},
+                   *procedimentos[6:20], *procedimentos[20:23]]
+        data, comandos = self._comandos(client, 'PUT', f"/api/evolucoes/{data['id']}", {'procedimentos_ids': pedidos})
+        assert comandos <= com_vinte + 3
+        atualizados = {p['procedimento_id']: p for p in data['procedimentos']}
+        assert set(atualizados) == set(procedimentos[5:23])
+        assert all(atualizados[i]['id'] == vinculos[i] for i in procedimentos[5:20])
+        assert atualizados[procedimentos[5]]['observacoes'] == 'Carga aumentada'
+        assert ProcedimentoEvolucao.query.filter_by(evolucao_id=data['id']).count() == 18
+        
+        # Sem alterações nos vínculos, nenhum comando sobre procedimentos_evolucoes é enviado
+        comandos = []
+        def capturar(conn, cursor, statement, parameters, context, executemany):
+            comandos.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', capturar)
+        try:
+            client.put(f"/api/evolucoes/{data['id']}", data=json.dumps({'procedimentos_ids': pedidos}),
+                       content_type='application/json')
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', capturar)
+        assert not any(c.startswith(('INSERT INTO procedimentos_evolucoes', 'DELETE FROM procedimentos_evolucoes',
+                                     'UPDATE procedimentos_evolucoes')) for c in comandos)
+
+    def test_vinculos_repetidos(self, client, paciente_evolucao):
+        """Testar que vínculos repetidos do mesmo procedimento são reduzidos a um na sincronização"""
+        paciente, procedimentos = paciente_evolucao
+        data, _ = self._comandos(client, 'POST', '/api/evolucoes', {
+            'paciente_id': paciente.id, 'data_sessao': '2025-05-05T09:00:00', 'procedimentos_ids': procedimentos[:1]
+        })
+        db.session.add_all([
+            ProcedimentoEvolucao(evolucao_id=data['id'], procedimento_id=procedimentos[0], observacoes='Repetido'),
+            ProcedimentoEvolucao(evolucao_id=data['id'], procedimento_id=procedimentos[1]),
+            ProcedimentoEvolucao(evolucao_id=data['id'], procedimento_id=procedimentos[1]),
+        ])
+        db.session.commit()
+        primeiro = data['procedimentos'][0]['id']
+        
+        data, _ = self._comandos(client, 'PUT', f"/api/evolucoes/{data['id']}", {
+            'procedimentos_ids': [{'procedimento_id': procedimentos[0], 'observacoes': 'Carga leve'}]
+        })
+        assert [(p['id'], p['observacoes']) for p in data['procedimentos']] == [(primeiro, 'Carga leve')]
+        assert ProcedimentoEvolucao.query.filter_by(evolucao_id=data['id']).count() == 1
+    
+    def test_ids_de_procedimento_em_texto(self, client, paciente_evolucao):
+        """Testar ids numéricos enviados como texto e 400 para ids que não são inteiros"""
+        paciente, procedimentos = paciente_evolucao
+        base = {'paciente_id': paciente.id, 'data_sessao': '2025-05-05T09:00:00'}
+        
+        data, _ = self._comandos(client, 'POST', '/api/evolucoes', {
+            **base, 'procedimentos_ids': [str(procedimentos[0]), {'procedimento_id': str(procedimentos[1])}]
+        })
+        assert [p['procedimento_id'] for p in data['procedimentos']] == procedimentos[:2]
+        
+        data, _ = self._comandos(client, 'PUT', f"/api/evolucoes/{data['id']}", {
+            'procedimentos_ids': [str(procedimentos[1]), procedimentos[1]]
+        })
+        assert [p['procedimento_id'] for p in data['procedimentos']] == procedimentos[1:2]
+        
+        for invalido in ['abc', 1.5, True, [1]]:
+            response = client.post('/api/evolucoes', data=json.dumps({**base, 'procedimentos_ids': [invalido]}),
+                                   content_type='application/json')
+            assert response.status_code == 400
+            response = client.put(f"/api/evolucoes/{data['id']}", data=json.dumps({'procedimentos_ids': [invalido]}),
+                                  content_type='application/json')
+            assert response.status_code == 400
+        assert Evolucao.query.count() == 1
+        assert ProcedimentoEvolucao.query.filter_by(evolucao_id=data['id']).count() == 1
+    
+    def test_listagem_paginada_com_catalogo(self, client, paciente_evolucao):
+        """Testar cursor (data_sessao, id), carregamento em lote e catálogo sem repetição"""
+        paciente, procedimentos = paciente_evolucao
+        datas = ['2025-05-01T09:00:00', '2025-05-02T09:00:00', '2025-05-02T09:00:00',
+                 '2025-05-03T09:00:00', '2025-05-04T09:00:00']
+        ids = [self._comandos(client, 'POST', '/api/evolucoes', {
+            'paciente_id': paciente.id, 'data_sessao': data, 'procedimentos_ids': procedimentos[:3]
+        })[0]['id'] for data in datas]
+        
+        paginas = []
+        url = f'/api/evolucoes?paciente_id={paciente.id}&limit=2'
+        cursor = None
+        while True:
+            data, comandos = self._comandos(client, 'GET', url + (f'&cursor={cursor}' if cursor else ''), None)
+            # Evoluções, vínculos e catálogo: três consultas por página
+            assert comandos == 3
+            paginas.append(data)
+            cursor = data['next_cursor']
+            if not cursor:
+                break
+        
+        listadas = [e['id'] for pagina in paginas for e in pagina['evolucoes']]
+        assert listadas == [ids[4], ids[3], ids[2], ids[1], ids[0]]
+        primeira = paginas[0]
+        assert set(primeira['procedimentos']) == {str(i) for i in procedimentos[:3]}
+        assert primeira['procedimentos'][str(procedimentos[0])]['nome'] == 'Procedimento 00'
+        assert 'procedimento' not in primeira['evolucoes'][0]['procedimentos'][0]
+        
+        assert client.get('/api/evolucoes?cursor=invalido').status_code == 400
+
+class TestAgendamentos:
+    """Testes para agenda e detecção de conflitos de horário"""
+    
+    @pytest.fixture
+    def paciente_agenda(self, client, fisioterapeuta_teste):
+        paciente = Paciente(nome_completo='Paciente Agenda', data_nascimento=datetime(1990, 1, 1).date(),
+                            fisioterapeuta_id=fisioterapeuta_teste.id)
+        db.session.add(paciente)
+        db.session.commit()
+        return paciente
+    
+    def _agendar(self, client, paciente_id, data_hora, duracao=60, **extras):
+        return client.post('/api/agendamentos',
+                           data=json.dumps({'paciente_id': paciente_id, 'data_hora': data_hora,
+                                            'duracao_minutos': duracao, **extras}),
+                           content_type='application/json')
+    
+    def test_sobreposicao_por_duracao(self, client, paciente_agenda):
+        """Testar recusa de sessões que se sobrepõem pela duração"""
+        response = self._agendar(client, paciente_agenda.id, '2025-06-02T10:00:00')
+        assert response.status_code == 201
+        primeiro_id = json.loads(response.data)['id']
+        
+        response = self._agendar(client, paciente_agenda.id, '2025-06-02T10:30:00')
+        assert response.status_code == 409
+        assert [c['id'] for c in json.loads(response.data)['conflitos']] == [primeiro_id]
+        
+        response = self._agendar(client, paciente_agenda.id, '2025-06-02T09:30:00', duracao=30)
+        assert response.status_code == 201
+        response = self._agendar(client, paciente_agenda.id, '2025-06-02T11:00:00')
+        assert response.status_code == 201
+        segundo_id = json.loads(response.data)['id']
+        
+        # Mover a sessão das 11h para 10h45 passa a sobrepor a das 10h
+        response = client.put(f'/api/agendamentos/{segundo_id}',
+                              data=json.dumps({'data_hora': '2025-06-02T10:45:00'}),
+                              content_type='application/json')
+        assert response.status_code == 409
+        
+        # Sessão cancelada libera o horário
+        client.delete(f'/api/agendamentos/{primeiro_id}')
+        response = self._agendar(client, paciente_agenda.id, '2025-06-02T10:30:00', duracao=30)
+        assert response.status_code == 201
+    
+    def test_conflito_restrito_ao_fisioterapeuta(self, client, paciente_agenda):
+        """Testar que fisioterapeutas diferentes podem atender no mesmo horário"""
+        outro = Fisioterapeuta(nome='Dra. Outra', email='outra@fisio.com',
+                               senha_hash=AuthService.hash_password('senha123'), crefito='CREFITO-OUTRA')
+        db.session.add(outro)
+        db.session.commit()
+        
+        assert self._agendar(client, paciente_agenda.id, '2025-06-03T14:00:00').status_code == 201
+        response = self._agendar(client, paciente_agenda.id, '2025-06-03T14:00:00', fisioterapeuta_id=outro.id)
+        assert response.status_code == 201
+    
+    def test_gatilho_impede_sobreposicao_fora_da_api(self, client, paciente_agenda):
+        """Testar que o banco recusa sobreposição mesmo sem passar pela rota"""
+        db.session.add(Agendamento(paciente_id=paciente_agenda.id, data_hora=datetime(2025, 6, 4, 8, 0),
+                                   duracao_minutos=90))
+        db.session.commit()
+        
+        db.session.add(Agendamento(paciente_id=paciente_agenda.id, data_hora=datetime(2025, 6, 4, 9, 0)))
+        with pytest.raises(IntegrityError):
+            db.session.commit()
+        db.session.rollback()
+        
+        consulta = select(Agendamento.id).where(*AgendaService.filtro_sobreposicao(
+            paciente_agenda.fisioterapeuta_id, datetime(2025, 6, 4, 9, 0), datetime(2025, 6, 4, 10, 0)
+        )).compile(db.engine, compile_kwargs={'literal_binds': True})
+        plano = db.session.connection().exec_driver_sql(f'EXPLAIN QUERY PLAN {consulta}').fetchall()
+        assert 'ix_agendamentos_ocupacao' in str(plano)
+    
+    def test_duracao_invalida(self, client, paciente_agenda):
+        """Testar validação da duração da sessão"""
+        response = self._agendar(client, paciente_agenda.id, '2025-06-05T10:00:00', duracao=0)
+        assert response.status_code == 400
+    
+    def test_horarios_livres(self, client, paciente_agenda):
+        """Testar janelas livres dentro do expediente, descontando sessões ativas"""
+        fisioterapeuta_id = paciente_agenda.fisioterapeuta_id
+        assert self._agendar(client, paciente_agenda.id, '2025-06-09T09:00:00', duracao=90).status_code == 201
+        assert self._agendar(client, paciente_agenda.id, '2025-06-09T11:15:00', duracao=30).status_code == 201
+        assert self._agendar(client, paciente_agenda.id, '2025-06-09T15:00:00', status='cancelado').status_code == 201
+        assert self._agendar(client, paciente_agenda.id, '2025-06-09T16:00:00-03:00').status_code == 201
+        
+        response = client.get('/api/agendamentos/horarios-livres?data_inicio=2025-06-09&data_fim=2025-06-09'
+                              f'&duracao_minutos=45&fisioterapeuta_id={fisioterapeuta_id}')
+        assert response.status_code == 200
+        data = json.loads(response.data)
+        assert [f['fisioterapeuta_id'] for f in data['fisioterapeutas']] == [fisioterapeuta_id]
+        # 10h30-11h15 tem exatamente 45 minutos; 11h45-12h não comporta a sessão
+        assert data['fisioterapeutas'][0]['horarios'] == [
+            {'inicio': '2025-06-09T08:00:00', 'fim': '2025-06-09T09:00:00'},
+            {'inicio': '2025-06-09T10:30:00', 'fim': '2025-06-09T11:15:00'},
+            {'inicio': '2025-06-09T13:00:00', 'fim': '2025-06-09T16:00:00'},
+            {'inicio': '2025-06-09T17:00:00', 'fim': '2025-06-09T18:00:00'},
+        ]
+        
+        # Domingo fora do expediente e início no meio do período
+        response = client.get('/api/agendamentos/horarios-livres?data_inicio=2025-06-08T00:00:00'
+                              '&data_fim=2025-06-09T08:30:00&duracao_minutos=30')
+        horarios = json.loads(response.data)['fisioterapeutas'][0]['horarios']
+        assert horarios == [{'inicio': '2025-06-09T08:00:00', 'fim': '2025-06-09T08:30:00'}]
+        
+        # Datas com Z ou offset: vale a hora informada, como na gravação dos agendamentos
+        response = client.get('/api/agendamentos/horarios-livres?data_inicio=2025-06-09T08:00:00Z'
+                              '&data_fim=2025-06-09T09:30:00-03:00&duracao_minutos=30')
+        assert response.status_code == 200
+        data = json.loads(response.data)
+        assert (data['data_inicio'], data['data_fim']) == ('2025-06-09T08:00:00', '2025-06-09T09:30:00')
+        assert data['fisioterapeutas'][0]['horarios'] == [{'inicio': '2025-06-09T08:00:00', 'fim': '2025-06-09T09:00:00'}]
+    
+    def test_horarios_livres_validacao(self, client, paciente_agenda):
+        """Testar parâmetros obrigatórios da busca de horários livres"""
+        url = '/api/agendamentos/horarios-livres?data_inicio=2025-06-09&data_fim=2025-06-13'
+        assert client.get(url).status_code == 400
+        assert client.get(url + '&duracao_minutos=0').status_code == 400
+        assert client.get(url + '&duracao_minutos=60&fisioterapeuta_id=9999').status_code == 404
+        assert client.get('/api/agendamentos/horarios-livres?data_inicio=2025-06-01'
+                          '&data_fim=2025-08-01&duracao_minutos=60').status_code == 400
+
+    def test_serie_recorrente(self, client, paciente_agenda):
+        """Testar série 2x por semana: ocorrências em conflito são puladas, as demais criadas juntas"""
+        # Quarta da 3ª semana já ocupada
+        assert self._agendar(client, paciente_agenda.id, '2025-06-18T10:30:00').status_code == 201
+        
+        consultas = []
+        def contar(conn, cursor, statement, parameters, context, executemany):
+            consultas.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', contar)
+        try:
+            response = client.post('/api/agendamentos/series',
+                                   data=json.dumps({'paciente_id': paciente_agenda.id,
+                                                    'data_hora': '2025-06-02T10:00:00',
+                                                    'duracao_minutos': 50,
+                                                    'regra': 'RRULE:FREQ=WEEKLY;BYDAY=MO,WE;COUNT=20'}),
+                                   content_type='application/json')
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', contar)
+        
+        assert response.status_code == 201
+        data = json.loads(response.data)
+        assert len(data['agendamentos']) == 19
+        assert [c['data_hora'] for c in data['conflitos']] == ['2025-06-18T10:00:00']
+        assert data['agendamentos'][0]['data_hora'] == '2025-06-02T10:00:00'
+        assert data['agendamentos'][-1]['data_hora'] == '2025-08-06T10:00:00'
+        assert {a['serie_id'] for a in data['agendamentos']} == {data['serie']['id']}
+        # Uma consulta de sobreposição e um único INSERT em lote para as ocorrências
+        assert sum('data_hora_fim >' in consulta for consulta in consultas) == 1
+        assert sum(consulta.startswith('INSERT INTO agendamentos') for consulta in consultas) == 1
+        
+        # Alterar a duração das ocorrências a partir de julho
+        serie_id = data['serie']['id']
+        response = client.put(f'/api/agendamentos/series/{serie_id}',
+                              data=json.dumps({'duracao_minutos': 40, 'a_partir_de': '2025-07-01T00:00:00'}),
+                              content_type='application/json')
+        assert response.status_code == 200
+        assert json.loads(response.data)['atualizados'] == 11
+        
+        ocorrencias = json.loads(client.get(f'/api/agendamentos/series/{serie_id}').data)['agendamentos']
+        assert ocorrencias[0]['data_hora_fim'] == '2025-06-02T10:50:00'
+        assert ocorrencias[-1]['data_hora_fim'] == '2025-08-06T10:40:00'
+        
+        # Cancelar toda a série libera os horários
+        response = client.put(f'/api/agendamentos/series/{serie_id}',
+                              data=json.dumps({'status': 'cancelado', 'a_partir_de': '2025-01-01T00:00:00'}),
+                              content_type='application/json')
+        assert json.loads(response.data)['atualizados'] == 19
+        assert self._agendar(client, paciente_agenda.id, '2025-06-02T10:00:00').status_code == 201
+    
+    def test_serie_com_fuso(self, client, paciente_agenda):
+        """Testar série iniciada com data_hora em UTC ('Z') e agendamento já existente no período"""
+        assert self._agendar(client, paciente_agenda.id, '2026-11-09T10:30:00').status_code == 201
+        for regra in ['FREQ=WEEKLY;COUNT=3', 'FREQ=WEEKLY;UNTIL=20261116T103000Z']:
+            response = client.post('/api/agendamentos/series',
+                                   data=json.dumps({'paciente_id': paciente_agenda.id,
+                                                    'data_hora': '2026-11-02T10:30:00Z', 'regra': regra}),
+                                   content_type='application/json')
+            assert response.status_code == 201, response.data
+            data = json.loads(response.data)
+            assert [c['data_hora'] for c in data['conflitos']] == ['2026-11-09T10:30:00']
+            assert [a['data_hora'] for a in data['agendamentos']] == ['2026-11-02T10:30:00', '2026-11-16T10:30:00']
+            client.put(f"/api/agendamentos/series/{data['serie']['id']}",
+                       data=json.dumps({'status': 'cancelado', 'a_partir_de': '2026-01-01T00:00:00'}),
+                       content_type='application/json')
+    
+    def test_serie_regra_invalida(self, client, paciente_agenda):
+        """Testar recusa de regras fora do subconjunto suportado"""
+        for regra in ['FREQ=MONTHLY;COUNT=3', 'FREQ=WEEKLY', 'FREQ=DAILY;BYDAY=MO;COUNT=2', 'FREQ=WEEKLY;COUNT=500']:
+            response = client.post('/api/agendamentos/series',
+                                   data=json.dumps({'paciente_id': paciente_agenda.id,
+                                                    'data_hora': '2025-06-02T10:00:00', 'regra': regra}),
+                                   content_type='application/json')
+            assert response.status_code == 400, regra
+
+    def test_feed_ics(self, client, paciente_agenda):
+        """Testar feed iCalendar do fisioterapeuta com ETag, Last-Modified e 304"""
+        fisioterapeuta_id = paciente_agenda.fisioterapeuta_id
+        amanha = (datetime.now() + timedelta(days=1)).strftime('%Y-%m-%dT10:00:00')
+        depois = (datetime.now() + timedelta(days=2)).strftime('%Y-%m-%dT10:00:00')
+        response = self._agendar(client, paciente_agenda.id, amanha, duracao=45,
+                                 observacoes='Trazer exames; usar roupa leve, tênis')
+        primeiro_id = json.loads(response.data)['id']
+        segundo_id = json.loads(self._agendar(client, paciente_agenda.id, depois).data)['id']
+        
+        url = f'/api/agendamentos/fisioterapeutas/{fisioterapeuta_id}/agenda.ics'
+        response = client.get(url)
+        assert response.status_code == 200
+        assert response.mimetype == 'text/calendar'
+        corpo = response.data.decode('utf-8')
+        assert corpo.startswith('BEGIN:VCALENDAR\r\n') and corpo.endswith('END:VCALENDAR\r\n')
+        assert corpo.count('BEGIN:VEVENT') == 2
+        assert f'UID:agendamento-{primeiro_id}@fisiogestao' in corpo
+        assert 'DESCRIPTION:Trazer exames\\; usar roupa leve\\, tênis' in corpo
+        assert all(len(linha.encode('utf-8')) <= 75 for linha in corpo.split('\r\n'))
+        etag = response.headers['ETag']
+        ultima_alteracao = response.headers['Last-Modified']
+        
+        response = client.get(url, headers={'If-None-Match': etag})
+        assert response.status_code == 304 and response.data == b''
+        response = client.get(url, headers={'If-Modified-Since': ultima_alteracao})
+        assert response.status_code == 304
+        
+        # Cancelamento muda a versão e aparece como STATUS:CANCELLED
+        client.delete(f'/api/agendamentos/{primeiro_id}')
+        response = client.get(url, headers={'If-None-Match': etag})
+        assert response.status_code == 200
+        assert response.headers['ETag'] != etag
+        assert 'STATUS:CANCELLED' in response.data.decode('utf-8')
+        
+        # O nome do paciente vai no evento: renomear também muda a versão
+        etag = response.headers['ETag']
+        paciente_agenda.nome_completo = 'Paciente Renomeado'
+        db.session.commit()
+        response = client.get(url, headers={'If-None-Match': etag})
+        assert response.status_code == 200
+        assert 'Paciente Renomeado' in response.data.decode('utf-8')
+        
+        # Falta também sai como cancelada, não como pendente (TENTATIVE)
+        client.patch('/api/agendamentos/lote', data=json.dumps({'ids': [segundo_id], 'status': 'faltou'}),
+                     content_type='application/json')
+        corpo = client.get(url).data.decode('utf-8')
+        assert 'STATUS:TENTATIVE' not in corpo
+        assert corpo.count('STATUS:CANCELLED') == 2
+        
+        assert client.get('/api/agendamentos/fisioterapeutas/9999/agenda.ics').status_code == 404
+    
+    def test_status_em_lote(self, client, paciente_agenda):
+        """Testar fechamento do dia: um UPDATE, transições validadas e auditoria em lote"""
+        ids = [json.loads(self._agendar(client, paciente_agenda.id, f'2025-06-10T{8 + i:02d}:00:00').data)['id']
+               for i in range(4)]
+        client.delete(f'/api/agendamentos/{ids[3]}')
+        
+        consultas = []
+        def contar(conn, cursor, statement, parameters, context, executemany):
+            consultas.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', contar)
+        try:
+            response = client.patch('/api/agendamentos/lote', data=json.dumps({'alteracoes': [
+                {'id': ids[0], 'status': 'realizado'},
+                {'id': ids[1], 'status': 'realizado'},
+                {'id': ids[2], 'status': 'faltou'},
+                {'id': ids[3], 'status': 'realizado'},
+                {'id': 9999, 'status': 'cancelado'},
+            ]}), content_type='application/json')
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', contar)
+        
+        assert response.status_code == 200
+        data = json.loads(response.data)
+        assert data['atualizados'] == 3
+        assert data['por_status'] == {'realizado': 2, 'faltou': 1}
+        assert data['rejeitados'] == [
+            {'id': ids[3], 'motivo': 'transicao_invalida', 'status_atual': 'cancelado'},
+            {'id': 9999, 'motivo': 'nao_encontrado'},
+        ]
+        assert sum(consulta.startswith('UPDATE agendamentos') for consulta in consultas) == 1
+        assert sum(consulta.startswith('INSERT INTO logs_auditoria') for consulta in consultas) == 1
+        
+        db.session.expire_all()
+        assert [db.session.get(Agendamento, i).status for i in ids] == ['realizado', 'realizado', 'faltou', 'cancelado']
+        logs = LogAuditoria.query.filter_by(tabela='agendamentos', acao='UPDATE').all()
+        assert sorted(log.registro_id for log in logs) == ids[:3]
+        
+        # Status final não volta atrás
+        response = client.patch('/api/agendamentos/lote', data=json.dumps({'ids': ids[:2], 'status': 'agendado'}),
+                                content_type='application/json')
+        assert json.loads(response.data)['atualizados'] == 0
+        assert client.patch('/api/agendamentos/lote', data=json.dumps({'ids': ids, 'status': 'x'}),
+                            content_type='application/json').status_code == 400
+    
+    def test_indicadores_resumo_diario(self, client, paciente_agenda, fisioterapeuta_teste, monkeypatch):
+        """Testar resumo diário mantido pelas escritas e indicadores lidos dele"""
+        ids = [json.loads(self._agendar(client, paciente_agenda.id, f'2025-06-09T{8 + i:02d}:00:00').data)['id']
+               for i in range(4)]
+        terca_id = json.loads(self._agendar(client, paciente_agenda.id, '2025-06-10T08:00:00', duracao=30).data)['id']
+        client.delete(f'/api/agendamentos/{ids[3]}')
+        client.patch('/api/agendamentos/lote', data=json.dumps({'alteracoes': [
+            {'id': ids[0], 'status': 'realizado'},
+            {'id': ids[1], 'status': 'faltou'},
+        ]}), content_type='application/json')
+        # Remarcação move a sessão de dia no resumo
+        client.put(f'/api/agendamentos/{terca_id}', data=json.dumps({'data_hora': '2025-06-11T08:00:00'}),
+                   content_type='application/json')
+        
+        def resumo():
+            db.session.expire_all()
+            return {r.dia.isoformat(): r.to_dict() for r in ResumoDiarioAgenda.query.all() if r.total}
+        
+        esperado = resumo()
+        assert set(esperado) == {'2025-06-09', '2025-06-11'}
+        segunda = esperado['2025-06-09']
+        assert (segunda['total'], segunda['ativos'], segunda['realizados'], segunda['faltas'],
+                segunda['cancelados'], segunda['minutos_ocupados']) == (4, 1, 1, 1, 1, 180)
+        assert esperado['2025-06-11']['minutos_ocupados'] == 30
+        
+        # Reconstrução pela linha de comando chega ao mesmo resultado
+        ResumoDiarioAgenda.query.delete()
+        db.session.commit()
+        resultado = app.test_cli_runner().invoke(comando_resumo_agenda, [])
+        assert resultado.exit_code == 0, resultado.output
+        assert resumo() == esperado
+        
+        response = client.get('/api/agendamentos/indicadores?data_inicio=2025-06-09&data_fim=2025-06-15'
+                              f'&fisioterapeuta_id={fisioterapeuta_teste.id}')
+        assert response.status_code == 200
+        fisioterapeuta = json.loads(response.data)['fisioterapeutas'][0]
+        por_dia = {item['dia_semana']: item for item in fisioterapeuta['por_dia_semana']}
+        assert por_dia[0]['capacidade_minutos'] == 540
+        assert por_dia[0]['taxa_ocupacao'] == round(180 / 540, 4)
+        assert por_dia[0]['taxa_cancelamento'] == 0.25
+        assert por_dia[0]['taxa_faltas'] == 0.5
+        assert por_dia[1]['total'] == 0 and por_dia[1]['taxa_cancelamento'] is None
+        assert fisioterapeuta['geral']['total'] == 5
+        assert fisioterapeuta['geral']['capacidade_minutos'] == 5 * 540 + 240
+        
+        # Sem os gatilhos (bancos que não são SQLite) os indicadores vêm direto dos agendamentos
+        ResumoDiarioAgenda.query.delete()
+        db.session.commit()
+        monkeypatch.setattr(IndicadoresAgendaService, 'resumo_mantido_por_gatilhos', staticmethod(lambda: False))
+        response = client.get('/api/agendamentos/indicadores?data_inicio=2025-06-09&data_fim=2025-06-15'
+                              f'&fisioterapeuta_id={fisioterapeuta_teste.id}')
+        assert json.loads(response.data)['fisioterapeutas'][0] == fisioterapeuta
+        
+        assert client.get('/api/agendamentos/indicadores?data_inicio=2025-06-15&data_fim=2025-06-09').status_code == 400
+        assert client.get('/api/agendamentos/indicadores?data_inicio=2025-06-09').status_code == 400
+    
+    def _contar_consultas(self, client, url):
+        consultas = []
+        def contar(conn, cursor, statement, parameters, context, executemany):
+            consultas.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', contar)
+        try:
+            response = client.get(url)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', contar)
+        assert response.status_code == 200, response.data
+        return json.loads(response.data), len(consultas)
+    
+    def test_listagem_sem_n_mais_um(self, client, fisioterapeuta_teste):
+        """Testar número constante de consultas na listagem e no calendário do mês"""
+        pacientes = [Paciente(nome_completo=f'Paciente {i:02d}', data_nascimento=datetime(1990, 1, 1).date(),
+                              fisioterapeuta_id=fisioterapeuta_teste.id, endereco_residencial='Rua A, 1')
+                     for i in range(50)]
+        db.session.add_all(pacientes)
+        db.session.commit()
+        pacientes_ids = [paciente.id for paciente in pacientes]
+        fisioterapeuta_id = fisioterapeuta_teste.id
+        
+        inicio = datetime(2025, 3, 1, 7, 0)
+        def popular(total):
+            db.session.execute(Agendamento.__table__.delete())
+            db.session.execute(Agendamento.__table__.insert(), [
+                {'paciente_id': pacientes_ids[i % 50], 'fisioterapeuta_id': fisioterapeuta_id,
+                 'data_hora': inicio + timedelta(minutes=20 * i), 'data_hora_fim': inicio + timedelta(minutes=20 * i + 20),
+                 'duracao_minutos': 20, 'status': 'agendado'}
+                for i in range(total)
+            ])
+            db.session.commit()
+            db.session.expunge_all()
+        
+        urls = [
+            '/api/agendamentos',
+            '/api/agendamentos?include=paciente:id,nome_completo',
+            '/api/agendamentos/calendario?data_inicio=2025-03-01T00:00:00&data_fim=2025-03-31T23:59:59',
+        ]
+        popular(5)
+        poucos = [self._contar_consultas(client, url)[1] for url in urls]
+        popular(2000)
+        resultados = [self._contar_consultas(client, url) for url in urls]
+        
+        assert [total for _, total in resultados] == poucos
+        assert max(poucos) <= 2
+        
+        completo, projetado, calendario = [data for data, _ in resultados]
+        assert len(completo) == len(calendario) == 2000
+        assert completo[0]['paciente']['endereco_residencial'] == 'Rua A, 1'
+        assert projetado[0]['paciente'] == {'id': pacientes_ids[0], 'nome_completo': 'Paciente 00'}
+        assert calendario[0]['title'] == 'Paciente 00' and 'paciente' not in calendario[0]
+    
+    def test_include_invalido(self, client):
+        """Testar recusa de include com recurso ou campo desconhecido"""
+        assert client.get('/api/agendamentos?include=fisioterapeuta').status_code == 400
+        assert client.get('/api/agendamentos?include=paciente:senha').status_code == 400
+
+class TestIndices:
+    """Testes para índices das consultas mais frequentes"""
+    
+    def _planos(self, client, metodo, url, headers):
+        """Executar requisição e devolver os planos (EXPLAIN QUERY PLAN) dos SELECTs"""
+        consultas = []
+        
+        def capturar(conn, cursor, statement, parameters, context, executemany):
+            # INSERT ... SELECT (fila de lembretes) também passa pelo planejador
+            comando = statement.lstrip().upper()
+            if not executemany and (comando.startswith('SELECT') or
+                                    (comando.startswith('INSERT') and 'SELECT' in comando)):
+                consultas.append((statement, parameters))
+        
+        event.listen(db.engine, 'before_cursor_execute', capturar)
+        try:
+            response = client.open(url, method=metodo, headers=headers)
+            # Respostas em streaming só consultam o banco ao ler o corpo
+            response.get_data()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', capturar)
+        
+        assert response.status_code in (200, 202), response.data
+        planos = []
+        for statement, parameters in consultas:
+            linhas = db.session.connection().exec_driver_sql(
+                'EXPLAIN QUERY PLAN ' + statement, parameters
+            ).fetchall()
+            planos.append(' | '.join(linha[-1] for linha in linhas))
+        return planos
+    
+    def test_planos_de_consulta_usam_indices(self, client, token_auth, fisioterapeuta_teste):
+        """Testar que cada endpoint de listagem usa o índice previsto"""
+        paciente = Paciente(nome_completo='Paciente Índice', data_nascimento=datetime(1990, 1, 1).date(),
+                            fisioterapeuta_id=fisioterapeuta_teste.id)
+        db.session.add(paciente)
+        db.session.commit()
+        
+        headers = {'Authorization': token_auth}
+        casos = [
+            ('GET', f'/api/pacientes?fisioterapeuta_id={fisioterapeuta_teste.id}', 'ix_pacientes_fisioterapeuta_nome'),
+            ('GET', '/api/pacientes?ativo=true', 'ix_pacientes_ativos_nome'),
+            ('GET', f'/api/avaliacoes?paciente_id={paciente.id}', 'ix_avaliacoes_paciente_data'),
+            ('GET', f'/api/evolucoes?paciente_id={paciente.id}', 'ix_evolucoes_paciente_data'),
+            ('GET', f'/api/agendamentos?paciente_id={paciente.id}', 'ix_agendamentos_paciente_data'),
+            ('GET', '/api/agendamentos?status=agendado', 'ix_agendamentos_status_data'),
+            ('GET', '/api/agendamentos/calendario?data_inicio=2025-01-01T00:00:00&data_fim=2025-01-31T23:59:59',
+             'ix_agendamentos_nao_cancelados_data'),
+            ('POST', '/api/agendamentos/lembretes', 'ix_agendamentos_status_data'),
+            ('GET', '/api/agendamentos/horarios-livres?data_inicio=2025-01-06&data_fim=2025-01-10&duracao_minutos=60',
+             'ix_agendamentos_ocupacao'),
+            ('GET', f'/api/agendamentos/fisioterapeutas/{fisioterapeuta_teste.id}/agenda.ics',
+             'ix_agendamentos_fisioterapeuta_atualizacao'),
+            ('GET', f'/api/agendamentos/fisioterapeutas/{fisioterapeuta_teste.id}/agenda.ics',
+             'ix_agendamentos_ocupacao'),
+            ('GET', '/api/agendamentos/indicadores?data_inicio=2025-01-01&data_fim=2025-12-31',
+             'ix_agenda_resumo_dia'),
+            ('GET', f'/api/pacientes/{paciente.id}/linha-do-tempo', 'ix_avaliacoes_paciente_data'),
+            ('GET', f'/api/pacientes/{paciente.id}/linha-do-tempo', 'ix_evolucoes_paciente_data'),
+            ('GET', f'/api/pacientes/{paciente.id}/linha-do-tempo', 'ix_agendamentos_paciente_data'),
+            ('GET', '/api/sincronizacao/alteracoes', 'ix_log_alteracoes_fisioterapeuta'),
+            ('GET', '/api/cif/coorte?codigo=b280&qualificador_min=3', 'ix_avaliacoes_cif_codigo'),
+            ('GET', f'/api/lgpd/relatorio-tratamento/{paciente.id}', 'ix_logs_auditoria_registro'),
+        ]
+        
+        for metodo, url, indice in casos:
+            planos = self._planos(client, metodo, url, headers)
+            assert any(re.search(rf'INDEX {indice}\b', plano) for plano in planos), (url, planos)
+    
+    def test_migracao_cria_indices_em_banco_existente(self):
+        """Testar migração versionada sobre banco criado antes dos índices"""
+        engine = create_engine('sqlite://')
+        db.metadata.create_all(engine)
+        with engine.begin() as conn:
+            indices = conn.exec_driver_sql(
+                "SELECT name FROM sqlite_master WHERE type = 'index' AND name LIKE 'ix_%'"
+            ).scalars().all()
+            for indice in indices:
+                conn.exec_driver_sql(f'DROP INDEX {indice}')
+        
+        assert aplicar_migracoes(engine) == [versao for versao, _, _ in MIGRACOES]
+        assert aplicar_migracoes(engine) == []
+        
+        with engine.connect() as conn:
+            recriados = conn.exec_driver_sql(
+                "SELECT name FROM sqlite_master WHERE type = 'index' AND name LIKE 'ix_%'"
+            ).scalars().all()
+            assert set(recriados) == set(indices)
+            assert versao_atual(conn) == MIGRACOES[-1][0]
+
+class ServidorSMTPTeste(socketserver.ThreadingTCPServer):
+    """Servidor SMTP mínimo em memória para testar o canal de e-mail"""
+    allow_reuse_address = True
+    daemon_threads = True
+    
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), ManipuladorSMTPTeste)
+        self.mensagens = []
+        self.conexoes = 0
+        # Destinatário -> resposta SMTP de recusa (ex.: '550 ...')
+        self.recusas = {}
+
+
+class ManipuladorSMTPTeste(socketserver.StreamRequestHandler):
+    def responder(self, linha):
+        self.wfile.write(f'{linha}\r\n'.encode())
+    
+    def handle(self):
+        self.server.conexoes += 1
+        self.responder('220 teste')
+        destinatarios = []
+        while True:
+            linha = self.rfile.readline().decode().rstrip('\r\n')
+            comando = linha[:4].upper()
+            if not linha or comando == 'QUIT':
+                self.responder('221 tchau')
+                return
+            if comando in ('EHLO', 'HELO'):
+                self.responder('250 teste')
+            elif comando == 'MAIL':
+                destinatarios = []
+                self.responder('250 ok')
+            elif comando == 'RCPT':
+                destinatario = linha.split(':', 1)[1].strip().strip('<>')
+                recusa = self.server.recusas.get(destinatario)
+                if recusa:
+                    self.responder(recusa)
+                else:
+                    destinatarios.append(destinatario)
+                    self.responder('250 ok')
+            elif comando == 'DATA':
+                self.responder('354 fim com .')
+                corpo = []
+                while (dados := self.rfile.readline().decode().rstrip('\r\n')) != '.':
+                    corpo.append(dados)
+                self.server.mensagens.append((destinatarios, '\n'.join(corpo)))
+                self.responder('250 aceito')
+            else:
+                self.responder('250 ok')
+
+
+class TestSincronizacao:
+    """Testes para o feed de alterações da sincronização incremental"""
+    
+    def _feed(self, client, token_auth, cursor=None, limite=100):
+        url = f'/api/sincronizacao/alteracoes?limit={limite}' + (f'&cursor={cursor}' if cursor else '')
+        response = client.get(url, headers={'Authorization': token_auth})
+        assert response.status_code == 200, response.data
+        return json.loads(response.data)
+    
+    def test_feed_incremental_com_exclusoes(self, client, token_auth, fisioterapeuta_teste):
+        """Testar alterações desde o cursor, uma vez por registro, com marcadores de exclusão"""
+        paciente = Paciente(nome_completo='Paciente Tablet', data_nascimento=datetime(1960, 1, 1).date(),
+                            fisioterapeuta_id=fisioterapeuta_teste.id)
+        db.session.add(paciente)
+        db.session.commit()
+        evolucoes = [json.loads(client.post('/api/evolucoes', data=json.dumps({
+            'paciente_id': paciente.id, 'data_sessao': f'2025-02-0{dia}T10:00:00'
+        }), content_type='application/json').data)['id'] for dia in (1, 2)]
+        agendamento_id = json.loads(client.post('/api/agendamentos', data=json.dumps({
+            'paciente_id': paciente.id, 'data_hora': '2025-02-10T10:00:00'
+        }), content_type='application/json').data)['id']
+        
+        # Primeira sincronização em páginas
+        primeira = self._feed(client, token_auth, limite=2)
+        assert primeira['tem_mais']
+        resto = self._feed(client, token_auth, primeira['cursor'])
+        assert not resto['tem_mais']
+        itens = primeira['alteracoes'] + resto['alteracoes']
+        assert [(i['tipo'], i['id']) for i in itens] == [
+            ('paciente', paciente.id), ('evolucao', evolucoes[0]), ('evolucao', evolucoes[1]),
+            ('agendamento', agendamento_id)
+        ]
+        cursor = resto['cursor']
+        assert self._feed(client, token_auth, cursor)['alteracoes'] == []
+        
+        # Duas edições valem uma entrada; exclusão vira marcador; status em lote (Core) também entra
+        for texto in ('Melhora parcial', 'Melhora importante'):
+            client.put(f'/api/evolucoes/{evolucoes[0]}', data=json.dumps({'resposta_paciente': texto}),
+                       content_type='application/json')
+        client.delete(f'/api/evolucoes/{evolucoes[1]}')
+        client.patch('/api/agendamentos/lote', data=json.dumps({'ids': [agendamento_id], 'status': 'realizado'}),
+                     content_type='application/json')
+        
+        delta = self._feed(client, token_auth, cursor)
+        assert [(i['tipo'], i['id'], i['excluido']) for i in delta['alteracoes']] == [
+            ('evolucao', evolucoes[0], False), ('evolucao', evolucoes[1], True), ('agendamento', agendamento_id, False)
+        ]
+        assert delta['alteracoes'][0]['dados']['resposta_paciente'] == 'Melhora importante'
+        assert delta['alteracoes'][1]['dados'] is None
+        assert delta['alteracoes'][2]['dados']['status'] == 'realizado'
+        
+        # Transferência: o fisioterapeuta anterior recebe exclusões, o novo recebe tudo
+        outro = Fisioterapeuta(nome='Dr. Novo', email='novo@fisio.com',
+                               senha_hash=AuthService.hash_password('senha123'), crefito='CREFITO-NOVO')
+        db.session.add(outro)
+        db.session.commit()
+        token_outro = f'Bearer {AuthService.generate_token(outro.id)}'
+        assert self._feed(client, token_outro)['alteracoes'] == []
+        
+        paciente.fisioterapeuta_id = outro.id
+        db.session.commit()
+        antigo = self._feed(client, token_auth, delta['cursor'])['alteracoes']
+        assert {(i['tipo'], i['id']) for i in antigo if i['excluido']} == {
+            ('paciente', paciente.id), ('evolucao', evolucoes[0]), ('agendamento', agendamento_id)
+        }
+        novo = self._feed(client, token_outro)['alteracoes']
+        assert {(i['tipo'], i['id']) for i in novo} == {
+            ('paciente', paciente.id), ('evolucao', evolucoes[0]), ('agendamento', agendamento_id)
+        }
+        assert not any(i['excluido'] for i in novo)
+        
+        assert client.get('/api/sincronizacao/alteracoes?cursor=x', headers={'Authorization': token_auth}).status_code == 400
+        assert client.get('/api/sincronizacao/alteracoes').status_code == 401
+
+class TestLembretes:
+    """Testes para a fila e o envio de lembretes"""
+    
+    @pytest.fixture
+    def servidor_smtp(self):
+        servidor = ServidorSMTPTeste()
+        thread = threading.Thread(target=servidor.serve_forever, daemon=True)
+        thread.start()
+        yield servidor
+        servidor.shutdown()
+        servidor.server_close()
+    
+    @pytest.fixture
+    def agenda_amanha(self, client, fisioterapeuta_teste):
+        """Três pacientes com sessão amanhã; apenas dois consentiram com comunicação"""
+        amanha = datetime.combine(datetime.now().date() + timedelta(days=1), datetime.min.time())
+        pacientes = [
+            Paciente(nome_completo='Ana Consentiu', email='ana@teste.com', consentimento_comunicacao=True,
+                     data_nascimento=datetime(1990, 1, 1).date(), fisioterapeuta_id=fisioterapeuta_teste.id),
+            Paciente(nome_completo='Bruno Recusou', email='bruno@teste.com', consentimento_comunicacao=False,
+                     data_nascimento=datetime(1990, 1, 1).date(), fisioterapeuta_id=fisioterapeuta_teste.id),
+            Paciente(nome_completo='Carla Consentiu', email='carla@teste.com', consentimento_comunicacao=True,
+                     data_nascimento=datetime(1990, 1, 1).date(), fisioterapeuta_id=fisioterapeuta_teste.id),
+        ]
+        db.session.add_all(pacientes)
+        db.session.flush()
+        for i, paciente in enumerate(pacientes):
+            db.session.add(Agendamento(paciente_id=paciente.id, data_hora=amanha + timedelta(hours=8 + i)))
+        db.session.commit()
+        return pacientes
+    
+    def _canais(self, servidor_smtp):
+        return criar_canais({'email': {'tipo': 'smtp', 'host': '127.0.0.1',
+                                       'porta': servidor_smtp.server_address[1], 'por_segundo': 1000}})
+    
+    def test_enfileirar_respeita_consentimento(self, client, agenda_amanha):
+        """Testar que a fila só recebe pacientes com consentimento, sem duplicar"""
+        response = client.post('/api/agendamentos/lembretes')
+        assert response.status_code == 202
+        assert json.loads(response.data)['total_enfileirados'] == 2
+        
+        destinos = {item.destino for item in LembreteOutbox.query.all()}
+        assert destinos == {'ana@teste.com', 'carla@teste.com'}
+        
+        response = client.post('/api/agendamentos/lembretes')
+        assert json.loads(response.data)['total_enfileirados'] == 0
+    
+    def test_despachante_envia_em_lote(self, client, agenda_amanha, servidor_smtp):
+        """Testar envio pelo pool de workers, uma conexão SMTP por lote"""
+        canais = self._canais(servidor_smtp)
+        LembreteService.enfileirar(datetime.now().date() + timedelta(days=1), canais)
+        db.session.commit()
+        
+        despachante = DespachanteLembretes(app, canais, workers_por_canal=1)
+        assert despachante.processar_pendentes() == 2
+        
+        assert sorted(destinatarios for destinatarios, _ in servidor_smtp.mensagens) == [
+            ['ana@teste.com'], ['carla@teste.com']
+        ]
+        assert servidor_smtp.conexoes == 1
+        assert 'Ana Consentiu' in servidor_smtp.mensagens[0][1] or 'Ana Consentiu' in servidor_smtp.mensagens[1][1]
+        
+        db.session.expire_all()
+        assert {item.status for item in LembreteOutbox.query.all()} == {'enviado'}
+        avisados = {a.paciente_id: a.lembrete_enviado for a in Agendamento.query.all()}
+        assert avisados == {agenda_amanha[0].id: True, agenda_amanha[1].id: False, agenda_amanha[2].id: True}
+        
+        # Nada vencido: nova rodada não reenvia
+        assert despachante.processar_pendentes() == 0
+    
+    def test_falhas_temporarias_e_definitivas(self, client, agenda_amanha, servidor_smtp):
+        """Testar nova tentativa com backoff para 4xx e descarte para 5xx"""
+        servidor_smtp.recusas = {'ana@teste.com': '451 tente depois', 'carla@teste.com': '550 inexistente'}
+        canais = self._canais(servidor_smtp)
+        LembreteService.enfileirar(datetime.now().date() + timedelta(days=1), canais)
+        db.session.commit()
+        
+        antes = datetime.utcnow()
+        assert DespachanteLembretes(app, canais, workers_por_canal=1).processar_pendentes() == 2
+        
+        db.session.expire_all()
+        itens = {item.destino: item for item in LembreteOutbox.query.all()}
+        assert itens['carla@teste.com'].status == 'falhou'
+        temporario = itens['ana@teste.com']
+        assert temporario.status == 'pendente'
+        assert temporario.tentativas == 1
+        assert temporario.proxima_tentativa >= antes + LembreteService.backoff(1)
+        assert LembreteService.backoff(3) == 4 * LembreteService.backoff(1)
+    
+    def test_reserva_confere_agendamento_e_paciente(self, client, agenda_amanha, servidor_smtp):
+        """Testar que a reserva usa o cadastro atual e cancela sessões remarcadas"""
+        canais = self._canais(servidor_smtp)
+        amanha = datetime.now().date() + timedelta(days=1)
+        LembreteService.enfileirar(amanha, canais)
+        db.session.commit()
+        
+        ana, _, carla = agenda_amanha
+        agendamento_ana = Agendamento.query.filter_by(paciente_id=ana.id).one()
+        agendamento_ana.data_hora += timedelta(hours=5)
+        carla.email = 'carla.nova@teste.com'
+        db.session.commit()
+        
+        assert DespachanteLembretes(app, canais, workers_por_canal=1).processar_pendentes() == 1
+        assert [destinatarios for destinatarios, _ in servidor_smtp.mensagens] == [['carla.nova@teste.com']]
+        db.session.expire_all()
+        item_ana = LembreteOutbox.query.filter_by(agendamento_id=agendamento_ana.id).one()
+        assert item_ana.status == 'cancelado'
+        assert item_ana.ultimo_erro == 'Agendamento remarcado'
+        
+        # Remarcada dentro do dia: volta à fila com o novo horário
+        assert LembreteService.enfileirar(amanha, canais) == 1
+        db.session.commit()
+        assert DespachanteLembretes(app, canais, workers_por_canal=1).processar_pendentes() == 1
+        assert agendamento_ana.data_hora.strftime('%H:%M') in servidor_smtp.mensagens[1][1]
+    
+    def test_reserva_cancela_sem_consentimento_ou_sessao_inativa(self, client, agenda_amanha, servidor_smtp):
+        """Testar que consentimento retirado e sessão cancelada não recebem lembrete já enfileirado"""
+        canais = self._canais(servidor_smtp)
+        LembreteService.enfileirar(datetime.now().date() + timedelta(days=1), canais)
+        db.session.commit()
+        
+        ana, _, carla = agenda_amanha
+        ana.consentimento_comunicacao = False
+        Agendamento.query.filter_by(paciente_id=carla.id).one().status = 'cancelado'
+        db.session.commit()
+        
+        assert DespachanteLembretes(app, canais, workers_por_canal=1).processar_pendentes() == 0
+        assert servidor_smtp.mensagens == []
+        db.session.expire_all()
+        assert {item.destino: (item.status, item.ultimo_erro) for item in LembreteOutbox.query.all()} == {
+            'ana@teste.com': ('cancelado', 'Consentimento de comunicação retirado'),
+            'carla@teste.com': ('cancelado', 'Agendamento cancelado')
+        }
+
 class TestLGPD:
     """Testes para conformidade com LGPD"""
     